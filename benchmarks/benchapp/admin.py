@@ -0,0 +1,23 @@
+from django.contrib import admin
+
+from dynfilters.filters import DynamicFilter
+
+from .models import Item
+
+
+@admin.register(Item)
+class ItemAdmin(admin.ModelAdmin):
+    list_display = ('name', 'code', 'number')
+    list_filter = (DynamicFilter,)
+
+    dynfilters_fields = [
+        'name',
+        'code',
+        'number',
+        'flag',
+        'created',
+        'category__name',
+        'tags__name',
+        'reviews__score',
+        ('name|code', 'Name or code'),
+    ]
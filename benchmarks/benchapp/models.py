@@ -0,0 +1,24 @@
+from django.db import models
+
+
+class Category(models.Model):
+    name = models.CharField(max_length=32)
+
+
+class Tag(models.Model):
+    name = models.CharField(max_length=32)
+
+
+class Item(models.Model):
+    name = models.CharField(max_length=64)
+    code = models.CharField(max_length=16, db_index=True)
+    number = models.IntegerField()
+    flag = models.BooleanField()
+    created = models.DateField()
+    category = models.ForeignKey(Category, on_delete=models.CASCADE)
+    tags = models.ManyToManyField(Tag)
+
+
+class Review(models.Model):
+    item = models.ForeignKey(Item, related_name='reviews', on_delete=models.CASCADE)
+    score = models.IntegerField()
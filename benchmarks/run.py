@@ -0,0 +1,296 @@
+"""
+Benchmarks filter compilation and execution against an in-memory SQLite
+database, with synthetic data and filters of growing size.
+
+    python benchmarks/run.py --output before.json
+    python benchmarks/run.py --output after.json --compare before.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import statistics
+import sqlite3
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import django
+from django.conf import settings
+
+
+def configure():
+    settings.configure(
+        DEBUG=False,
+        SECRET_KEY='benchmarks',
+        USE_TZ=True,
+        DATABASES={
+            'default': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': ':memory:',
+            },
+        },
+        INSTALLED_APPS=[
+            'django.contrib.admin',
+            'django.contrib.auth',
+            'django.contrib.contenttypes',
+            'django.contrib.messages',
+            'django.contrib.sessions',
+            'adminsortable2',
+            'dynfilters',
+            'benchmarks.benchapp',
+        ],
+        ROOT_URLCONF='benchmarks.benchapp.urls',
+        DEFAULT_AUTO_FIELD='django.db.models.AutoField',
+        CACHES={
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+        },
+    )
+    django.setup()
+
+
+WORDS = ['alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf', 'hotel']
+
+
+def populate(rnd, rows):
+    from benchmarks.benchapp.models import Category, Item, Review, Tag
+
+    categories = Category.objects.bulk_create([Category(name=w) for w in WORDS])
+    tags = Tag.objects.bulk_create([Tag(name=w) for w in WORDS])
+
+    items = Item.objects.bulk_create([
+        Item(
+            name=' '.join(rnd.sample(WORDS, 3)),
+            code=f'C{i % 1000:04d}',
+            number=rnd.randint(0, 1000),
+            flag=rnd.random() < 0.5,
+            created=datetime.date(2000, 1, 1) + datetime.timedelta(days=rnd.randint(0, 7000)),
+            category=rnd.choice(categories),
+        )
+        for i in range(rows)
+    ])
+
+    Item.tags.through.objects.bulk_create([
+        Item.tags.through(item=item, tag=tag)
+        for item in items
+        for tag in rnd.sample(tags, 2)
+    ])
+
+    Review.objects.bulk_create([
+        Review(item=item, score=rnd.randint(1, 5))
+        for item in items
+        for _ in range(rnd.randint(0, 3))
+    ])
+
+
+def random_term(rnd, op):
+    from dynfilters.models import DynamicFilterTerm
+
+    field, lookup, value = rnd.choice([
+        ('name', 'icontains', rnd.choice(WORDS)),
+        ('code', '=', f'C{rnd.randint(0, 999):04d}'),
+        ('code', 'in', ','.join(f'C{rnd.randint(0, 999):04d}' for _ in range(3))),
+        ('number', 'gt', str(rnd.randint(0, 1000))),
+        ('flag', 'istrue', None),
+        ('created', 'year', str(rnd.randint(2000, 2019))),
+        ('category__name', '=', rnd.choice(WORDS)),
+        ('tags__name', '=', rnd.choice(WORDS)),
+        ('reviews__score', 'gte', str(rnd.randint(1, 5))),
+        ('name|code', 'istartswith', rnd.choice(WORDS)),
+    ])
+
+    return DynamicFilterTerm(op=op, field=field, lookup=lookup, value=value)
+
+# A filter of 'size' terms, with operators and parentheses.
+def create_filter(rnd, user, size):
+    from dynfilters.models import DynamicFilterExpr, DynamicFilterTerm
+
+    expr = DynamicFilterExpr.objects.create(name=f'size {size}', model='benchapp.Item', user=user)
+
+    terms = []
+    depth = 0
+    for i in range(size):
+        if i:
+            terms.append(DynamicFilterTerm(op=rnd.choice('&|')))
+
+        if depth < 3 and rnd.random() < 0.1:
+            terms.append(DynamicFilterTerm(op='('))
+            depth += 1
+
+        terms.append(random_term(rnd, rnd.choice('--!')))
+
+        if depth and rnd.random() < 0.2:
+            terms.append(DynamicFilterTerm(op=')'))
+            depth -= 1
+
+    terms.extend(DynamicFilterTerm(op=')') for _ in range(depth))
+
+    for order, term in enumerate(terms):
+        term.filter = expr
+        term.order = order
+
+    DynamicFilterTerm.objects.bulk_create(terms)
+
+    return expr
+
+
+def measure(func, repeat):
+    timings = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+
+    return {
+        'median_ms': round(statistics.median(timings), 3),
+        'min_ms': round(min(timings), 3),
+    }
+
+def count_queries(func):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    with CaptureQueriesContext(connection) as context:
+        func()
+
+    return len(context)
+
+
+def bench_filter(expr, user, repeat):
+    from django.contrib import admin
+    from django.contrib.messages.storage.cookie import CookieStorage
+    from django.core.signals import request_finished
+    from django.db import connection
+    from django.test import RequestFactory
+
+    from benchmarks.benchapp.models import Item
+    from dynfilters import compiler, optimizer, shunting_yard
+    from dynfilters.cache import compiled_filters
+    from dynfilters.filters import DynamicFilter
+    from dynfilters.models import DynamicFilterExpr
+
+    model_admin = admin.site._registry[Item]
+
+    def compile_terms():
+        shunting_yard.evaluate(expr.normalized_terms())
+
+    def compile_ast():
+        optimizer.optimize(compiler.compile_terms(expr.normalized_terms()))
+
+    def changelist(cold):
+        def run():
+            if cold:
+                compiled_filters.clear()
+
+            request = RequestFactory().get('/', {'filter': expr.pk})
+            request.user = user
+            request._messages = CookieStorage(request)
+
+            spec = DynamicFilter(request, {'filter': [str(expr.pk)]}, Item, model_admin)
+            queryset = spec.queryset(request, model_admin.get_queryset(request))
+
+            queryset.count()
+            list(queryset[:100])
+
+            # Removes the execute wrappers installed for the request.
+            request_finished.send(sender=__name__)
+            assert not connection.dynfilters_wrappers, connection.dynfilters_wrappers
+
+        return run
+
+    expr.compile()
+    expr.save(update_fields=['ast'])
+    expr = DynamicFilterExpr.objects.get(pk=expr.pk)
+
+    return {
+        'terms': expr.dynamicfilterterm_set.count(),
+        'compile': measure(compile_terms, repeat),
+        'compile_ast': measure(compile_ast, repeat),
+        'queryset_cold': measure(changelist(cold=True), repeat),
+        'queryset_warm': measure(changelist(cold=False), repeat),
+        'queries_cold': count_queries(changelist(cold=True)),
+        'queries_warm': count_queries(changelist(cold=False)),
+        'sql_length': len(str(
+            Item.objects.filter(expr.as_q()).query
+        )),
+    }
+
+
+def compare(results, baseline):
+    previous = {r['size']: r for r in baseline['results']}
+
+    for result in results['results']:
+        before = previous.get(result['size'])
+        if before is None:
+            continue
+
+        for key in ('compile', 'compile_ast', 'queryset_cold', 'queryset_warm'):
+            if key not in before:
+                continue
+
+            old, new = before[key]['median_ms'], result[key]['median_ms']
+            change = (new - old) / old * 100 if old else 0
+            print(f"size={result['size']:<5} {key:<15} {old:>10.3f} ms -> {new:>10.3f} ms  ({change:+.1f}%)")
+
+        for key in ('queries_cold', 'queries_warm'):
+            if before.get(key) != result.get(key):
+                print(f"size={result['size']:<5} {key:<15} {before.get(key)} -> {result.get(key)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 50, 100, 200])
+    parser.add_argument('--rows', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write the results to this JSON file.')
+    parser.add_argument('--compare', help='Compare the results to this JSON file.')
+    args = parser.parse_args()
+
+    configure()
+
+    from django.contrib.auth.models import User
+    from django.core.management import call_command
+
+    call_command('migrate', run_syncdb=True, verbosity=0)
+
+    rnd = random.Random(args.seed)
+    user = User.objects.create(username='benchmarks', is_staff=True, is_superuser=True)
+
+    populate(rnd, args.rows)
+
+    results = {
+        'meta': {
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'rows': args.rows,
+            'repeat': args.repeat,
+            'seed': args.seed,
+        },
+        'results': [
+            {'size': size, **bench_filter(create_filter(rnd, user, size), user, args.repeat)}
+            for size in args.sizes
+        ],
+    }
+
+    output = json.dumps(results, indent=2)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
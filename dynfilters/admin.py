@@ -2,18 +2,20 @@ from furl import furl
 
 from django import forms
 from django.apps import apps
-from django.contrib import admin
+from django.contrib import admin, messages
 from django.shortcuts import redirect
 from django.urls import reverse
 from django.utils.html import format_html, format_html_join
 
 from adminsortable2.admin import SortableAdminBase, SortableInlineAdminMixin
 
+from . import materialize
 from .models import (
     DynamicFilterExpr,
     DynamicFilterTerm,
     DynamicFilterColumn,
     DynamicFilterColumnSortOrder,
+    DynamicFilterSlowLog,
 )
 
 from .forms import (
@@ -50,6 +52,21 @@ class DynamicFilterTermInline(SortableInlineAdminMixin, DynamicFilterInline):
     verbose_name = 'Search Criteria'
     verbose_name_plural = 'Search Criterias'
 
+    class Media:
+        js = ('js/dynfilters/facets.js',)
+
+    # Values are suggested from the most frequent values of the field.
+    def formfield_for_dbfield(self, db_field, **kwargs):
+        obj = kwargs['request'].parent_object
+
+        if db_field.name == 'value' and obj:
+            kwargs['widget'] = forms.TextInput(attrs={
+                'data-dynfilters-facets': reverse('dynfilters_facets', args=(obj.pk,)),
+                'autocomplete': 'off',
+            })
+
+        return super().formfield_for_dbfield(db_field, **kwargs)
+
 
 class DynamicFilterColumnInline(SortableInlineAdminMixin, DynamicFilterInline):
     model = DynamicFilterColumn
@@ -66,10 +83,11 @@ class DynamicFilterColumnSortOrderInline(SortableInlineAdminMixin, DynamicFilter
 @admin.register(DynamicFilterExpr)
 class DynamicFilterExprAdmin(SortableAdminBase, admin.ModelAdmin):
     form = DynamicFilterExprForm
-    inlines = [DynamicFilterTermInline]#, DynamicFilterColumnInline, DynamicFilterColumnSortOrderInline]
+    inlines = [DynamicFilterTermInline, DynamicFilterColumnInline, DynamicFilterColumnSortOrderInline]
 
     list_per_page = 50
-    list_display = ('name', 'model', 'user', 'is_global')
+    list_display = ('name', 'model', 'user', 'is_global', 'materialized', 'refreshed_at')
+    actions = ['refresh_results']
 
     def get_form(self, request, obj=None, **kwargs):
         request.parent_object = obj
@@ -84,6 +102,20 @@ class DynamicFilterExprAdmin(SortableAdminBase, admin.ModelAdmin):
 
         return super().formfield_for_dbfield(db_field,**kwargs)
 
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+
+        # Terms are final at this point, compile them once for all.
+        obj = form.instance
+        obj.compile()
+        obj.save(update_fields=['ast'])
+
+    @admin.action(description='Refresh the results of selected materialized filters')
+    def refresh_results(self, request, queryset):
+        for obj in queryset.filter(materialized=True):
+            count = materialize.refresh(obj)
+            self.message_user(request, f'{obj.name}: {count} rows.', messages.SUCCESS)
+
     def response_add(self, request, obj, post_url_continue=None):
         response = super().response_add(request, obj, post_url_continue)
         
@@ -93,3 +125,17 @@ class DynamicFilterExprAdmin(SortableAdminBase, admin.ModelAdmin):
         response = super().response_change(request, obj)
 
         return redirect_to_referer_next(request, response)
+
+
+@admin.register(DynamicFilterSlowLog)
+class DynamicFilterSlowLogAdmin(admin.ModelAdmin):
+    list_per_page = 50
+    list_display = ('name', 'model', 'term_count', 'load_ms', 'normalize_ms', 'compile_ms', 'execute_ms', 'total_ms', 'created_at')
+    list_filter = ('model',)
+    date_hierarchy = 'created_at'
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class DynfiltersConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'dynfilters'
+
+    def ready(self):
+        from . import signals
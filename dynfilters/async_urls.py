@@ -0,0 +1,14 @@
+from django.urls import path
+
+from . import async_views as views
+
+# Same names as urls.py, include either of them.
+urlpatterns = [
+    path('<str:model_name>/add/', views.dynfilters_add, name='dynfilters_add'),
+    path('<int:id>/share/', views.dynfilters_share, name='dynfilters_share'),
+    path('<int:id>/change/', views.dynfilters_change, name='dynfilters_change'),
+    path('<int:id>/delete/', views.dynfilters_delete, name='dynfilters_delete'),
+    path('<int:id>/refresh/', views.dynfilters_refresh, name='dynfilters_refresh'),
+    path('<int:id>/export/<str:format>/', views.dynfilters_export, name='dynfilters_export'),
+    path('<int:id>/facets/', views.dynfilters_facets, name='dynfilters_facets'),
+]
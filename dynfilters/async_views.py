@@ -0,0 +1,154 @@
+# Async versions of the views, for ASGI deployments, see async_urls.py.
+# Filters are loaded and exported with the async ORM API. Permissions,
+# cloning and refreshing, which rely on transactions or on sync code
+# of the admin, run in the sync thread.
+
+from asgiref.sync import sync_to_async
+from django.contrib import messages
+from django.core.exceptions import FieldError, PermissionDenied, ValidationError
+from django.http import Http404, HttpResponseNotAllowed, JsonResponse, StreamingHttpResponse
+from django.utils.text import slugify
+
+from . import materialize
+from .clone import clone_filter
+from .export import EXPORT_ERRORS, FORMATS, aget_export_columns, aget_export_queryset, aiter_lines
+from .facets import aget_facets, get_facet_fields, get_limit
+from .model_helpers import get_model_admin, get_model_obj
+from .models import DynamicFilterExpr
+from .url_helpers import (
+    redirect_to_referer,
+    redirect_to_changelist,
+    redirect_to_change,
+)
+
+
+async def get_user(request):
+    if hasattr(request, 'auser'):
+        return await request.auser()
+
+    # Django < 5.0, the lazy user is loaded on first access.
+    user = request.user
+    await sync_to_async(lambda: user.pk)()
+
+    return user
+
+async def check_view_permission(request, expr):
+    model_admin = get_model_admin(expr)
+    if model_admin is None or not await sync_to_async(model_admin.has_view_permission)(request):
+        raise PermissionDenied
+
+    return model_admin
+
+async def check_change_permission(request, expr):
+    model_admin = get_model_admin(expr)
+    if model_admin is None or not await sync_to_async(model_admin.has_change_permission)(request):
+        raise PermissionDenied
+
+    return model_admin
+
+async def dynfilters_add(request, model_name):
+    try:
+        get_model_obj(model_name)
+    except (LookupError, ValueError):
+        messages.error(request, 'This type of model is unknown.')
+        return redirect_to_referer(request)
+
+    expr = await DynamicFilterExpr.objects.acreate(
+        model=model_name,
+        user=await get_user(request),
+    )
+
+    return redirect_to_change(request, expr.id, follow=True)
+
+async def dynfilters_share(request, id):
+    try:
+        expr = await DynamicFilterExpr.objects.aget(pk=id)
+    except DynamicFilterExpr.DoesNotExist:
+        messages.error(request, 'This filter does not exist.')
+        return redirect_to_changelist(request)
+
+    clone = await sync_to_async(clone_filter)(expr, {'user': await get_user(request)})
+
+    return redirect_to_change(request, clone.id)
+
+async def dynfilters_change(request, id):
+    return redirect_to_change(request, id, follow=True)
+
+async def dynfilters_delete(request, id):
+    try:
+        expr = await DynamicFilterExpr.objects.aget(pk=id)
+    except DynamicFilterExpr.DoesNotExist:
+        messages.error(request, 'This filter does not exist.')
+        return redirect_to_referer(request)
+
+    await expr.adelete()
+
+    return redirect_to_referer(request)
+
+async def dynfilters_refresh(request, id):
+    # require_POST only wraps async views from Django 5.0.
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+
+    try:
+        expr = await DynamicFilterExpr.objects.aget(pk=id, materialized=True)
+    except DynamicFilterExpr.DoesNotExist:
+        messages.error(request, 'This filter does not exist, or is not materialized.')
+        return redirect_to_referer(request)
+
+    await check_change_permission(request, expr)
+
+    count = await sync_to_async(materialize.refresh)(expr)
+    messages.success(request, f'The filter was refreshed, {count} rows.')
+
+    return redirect_to_referer(request)
+
+async def dynfilters_export(request, id, format):
+    if format not in FORMATS:
+        raise Http404('Unknown export format.')
+
+    try:
+        expr = await DynamicFilterExpr.objects.aget(pk=id)
+    except DynamicFilterExpr.DoesNotExist:
+        messages.error(request, 'This filter does not exist.')
+        return redirect_to_changelist(request)
+
+    model_admin = await check_view_permission(request, expr)
+
+    content_type, format_columns = FORMATS[format]
+
+    columns = await aget_export_columns(expr, model_admin)
+
+    try:
+        rows = await aget_export_queryset(request, expr, model_admin, columns)
+    except EXPORT_ERRORS as e:
+        messages.error(request, f'This filter cannot be exported: {e}')
+        return redirect_to_referer(request)
+
+    response = StreamingHttpResponse(aiter_lines(format_columns, columns, rows), content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="{slugify(expr.name)}.{format}"'
+
+    return response
+
+async def dynfilters_facets(request, id):
+    try:
+        expr = await DynamicFilterExpr.objects.aget(pk=id)
+    except DynamicFilterExpr.DoesNotExist:
+        raise Http404('This filter does not exist.')
+
+    model_admin = await check_view_permission(request, expr)
+
+    field = request.GET.get('field')
+    fields = get_facet_fields(model_admin, field)
+    if fields is None:
+        return JsonResponse({'error': 'Unknown field.'}, status=400)
+
+    # The user is part of the cache key.
+    await get_user(request)
+
+    try:
+        facets = await aget_facets(request, expr, model_admin, fields, get_limit(request), request.GET.get('scoped') == '1')
+    except (FieldError, ValidationError, ValueError, TypeError) as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    return JsonResponse({'field': field, 'facets': facets})
@@ -0,0 +1,172 @@
+# Evaluate many filters over the same queryset at once, e.g. to report
+# which of the global filters each row matches. Each filter becomes a
+# boolean Case/When annotation, so that the rows are read in a single
+# query, and its matches are returned as a bitmap over the primary keys:
+#
+#   bitmaps = DynamicFilterExpr.as_bitmaps(exprs, Person.objects.all())
+#   both = bitmaps[a.pk] & ~bitmaps[b.pk]
+#   list(both)  -> primary keys
+#
+# Bitmaps are Python ints, bit i standing for the i-th primary key of
+# the queryset, so that combining them costs a few machine operations
+# per 64 rows, with no query.
+
+from django.db.models import BooleanField, Case, Value, When
+
+from .cache import compiled_filters
+from .conf import get_setting
+
+
+# Primary keys of a queryset, in order, and their positions in bitmaps.
+class PkUniverse:
+    def __init__(self, pks, positions=None):
+        self.pks = list(pks)
+        self.positions = positions or {pk: i for i, pk in enumerate(self.pks)}
+
+    def __len__(self):
+        return len(self.pks)
+
+    @property
+    def mask(self):
+        return (1 << len(self.pks)) - 1
+
+
+class PkBitmap:
+    """
+    Set of primary keys of a universe, stored as the bits of an int.
+
+    Bitmaps of the same universe support &, |, ^, - and ~ (the rows of
+    the universe not in the bitmap), and iterate over primary keys.
+    """
+
+    __slots__ = ('universe', 'bits')
+
+    def __init__(self, universe, bits=0):
+        self.universe = universe
+        self.bits = bits
+
+    @classmethod
+    def from_pks(cls, universe, pks):
+        bits = 0
+        for pk in pks:
+            bits |= 1 << universe.positions[pk]
+
+        return cls(universe, bits)
+
+    def _check(self, other):
+        if not isinstance(other, PkBitmap):
+            return NotImplemented
+
+        if other.universe is not self.universe:
+            raise ValueError('Bitmaps of different querysets cannot be combined.')
+
+        return other
+
+    def __and__(self, other):
+        if (other := self._check(other)) is NotImplemented:
+            return other
+        return PkBitmap(self.universe, self.bits & other.bits)
+
+    def __or__(self, other):
+        if (other := self._check(other)) is NotImplemented:
+            return other
+        return PkBitmap(self.universe, self.bits | other.bits)
+
+    def __xor__(self, other):
+        if (other := self._check(other)) is NotImplemented:
+            return other
+        return PkBitmap(self.universe, self.bits ^ other.bits)
+
+    def __sub__(self, other):
+        if (other := self._check(other)) is NotImplemented:
+            return other
+        return PkBitmap(self.universe, self.bits & ~other.bits)
+
+    def __invert__(self):
+        return PkBitmap(self.universe, ~self.bits & self.universe.mask)
+
+    def __eq__(self, other):
+        if not isinstance(other, PkBitmap):
+            return NotImplemented
+        return self.universe is other.universe and self.bits == other.bits
+
+    __hash__ = None
+
+    def __bool__(self):
+        return bool(self.bits)
+
+    def __len__(self):
+        return bin(self.bits).count('1')
+
+    def __contains__(self, pk):
+        i = self.universe.positions.get(pk)
+        return i is not None and bool(self.bits >> i & 1)
+
+    def __iter__(self):
+        bits, pks = self.bits, self.universe.pks
+
+        while bits:
+            low = bits & -bits
+            yield pks[low.bit_length() - 1]
+            bits ^= low
+
+    def __repr__(self):
+        return f'<PkBitmap: {len(self)} of {len(self.universe)}>'
+
+
+# The condition is a subquery of the rows matched by filter(q), rather
+# than 'q' itself: conditions on multi-valued relations would otherwise
+# be evaluated row by row of the joins, and negated ones would not match
+# as they do in filter().
+def as_annotation(q, model):
+    if not q:
+        return Value(True) # no terms, matches everything
+
+    return Case(
+        When(pk__in=model._base_manager.filter(q).values('pk'), then=Value(True)),
+        default=Value(False),
+        output_field=BooleanField(),
+    )
+
+def set_bit(bitmap, i):
+    bitmap[i >> 3] |= 1 << (i & 7)
+
+# Bitmaps of the rows of 'queryset' matched by each of 'exprs', keyed
+# by filter id. Rows are read once, in primary key order.
+def as_bitmaps(exprs, queryset):
+    exprs = list(exprs)
+    names = [f'dynfilter_{i}' for i in range(len(exprs))]
+
+    queryset = queryset.order_by('pk').annotate(**{
+        name: as_annotation(compiled_filters.get(expr), queryset.model)
+        for name, expr in zip(names, exprs)
+    })
+
+    rows = queryset.values_list('pk', *names).iterator(chunk_size=get_setting('EXPORT_CHUNK_SIZE'))
+
+    pks, positions = [], {}
+    bitmaps = [bytearray() for expr in exprs]
+
+    for pk, *matches in rows:
+        # Multi-valued relations joined in the queryset itself repeat
+        # rows, which match when any of their repetitions do.
+        i = positions.get(pk)
+
+        if i is None:
+            i = positions[pk] = len(pks)
+            pks.append(pk)
+
+            if not i & 7:
+                for bitmap in bitmaps:
+                    bitmap.append(0)
+
+        for bitmap, match in zip(bitmaps, matches):
+            if match:
+                set_bit(bitmap, i)
+
+    universe = PkUniverse(pks, positions)
+
+    return {
+        expr.pk: PkBitmap(universe, int.from_bytes(bitmap, 'little'))
+        for expr, bitmap in zip(exprs, bitmaps)
+    }
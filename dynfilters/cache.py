@@ -0,0 +1,143 @@
+from collections import OrderedDict
+from threading import Lock
+from uuid import uuid4
+
+from django.core.cache import caches
+
+from .conf import get_setting
+
+
+class CompiledFilterCache:
+    """
+    LRU of compiled Q objects, keyed by filter id + version.
+
+    When DYNFILTERS_COMPILED_CACHE names a Django cache, compiled filters
+    are also stored there so that they can be shared between workers.
+    Since the version changes whenever the filter or one of its terms is
+    saved, stale entries are never returned, they simply age out.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _shared_cache(self):
+        alias = get_setting('COMPILED_CACHE')
+        return caches[alias] if alias else None
+
+    def _shared_key(self, key):
+        return 'dynfilters:q:%s:%s' % key
+
+    def _get_local(self, key):
+        with self._lock:
+            q = self._entries.get(key)
+            if q is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+
+            return q
+
+    def _set_local(self, key, q):
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = q
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > get_setting('COMPILED_CACHE_SIZE'):
+                self._entries.popitem(last=False)
+
+    def get(self, obj, timings=None):
+        key = (obj.pk, obj.version)
+
+        q = self._get_local(key)
+        if q is not None:
+            return q
+
+        shared = self._shared_cache()
+        q = shared.get(self._shared_key(key)) if shared else None
+
+        if q is None:
+            q = obj.as_q(timings)
+
+            if shared:
+                shared.set(
+                    self._shared_key(key), 
+                    q, 
+                    get_setting('COMPILED_CACHE_TIMEOUT'),
+                )
+
+        self._set_local(key, q)
+
+        return q
+
+    async def aget(self, obj, timings=None):
+        key = (obj.pk, obj.version)
+
+        q = self._get_local(key)
+        if q is not None:
+            return q
+
+        shared = self._shared_cache()
+        q = await shared.aget(self._shared_key(key)) if shared else None
+
+        if q is None:
+            q = await obj.aas_q(timings)
+
+            if shared:
+                await shared.aset(
+                    self._shared_key(key), 
+                    q, 
+                    get_setting('COMPILED_CACHE_TIMEOUT'),
+                )
+
+        self._set_local(key, q)
+
+        return q
+
+    def invalidate(self, pk):
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == pk]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._entries),
+                'maxsize': get_setting('COMPILED_CACHE_SIZE'),
+            }
+
+
+compiled_filters = CompiledFilterCache()
+
+
+# Sidebar filter lists are cached under the current generation of their
+# models, which changes whenever a filter on the model or one of its
+# terms is saved or deleted.
+def get_lookups_generation_key(model_name):
+    return f'dynfilters:lookups:generation:{model_name}'
+
+def get_lookups_generation(model_names):
+    cache = caches[get_setting('LOOKUPS_CACHE')]
+    keys = [get_lookups_generation_key(name) for name in model_names]
+
+    generations = cache.get_many(keys)
+
+    for key in keys:
+        if key not in generations:
+            generations[key] = cache.get_or_set(key, lambda: uuid4().hex, None)
+
+    return ':'.join(generations[key] for key in keys)
+
+def bump_lookups_generation(model_name):
+    cache = caches[get_setting('LOOKUPS_CACHE')]
+    cache.set(get_lookups_generation_key(model_name), uuid4().hex, None)
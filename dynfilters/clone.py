@@ -1,3 +1,8 @@
+from copy import copy
+
+from django.db import transaction
+from django.db.models.base import ModelState
+
 # https://stackoverflow.com/a/61729857/2893408
 # https://github.com/morlandi/test-django-clone
 
@@ -37,3 +42,38 @@ def clone_object(obj, attrs={}):
                     clone_object(child, attrs)
 
     return clone
+
+# Clone a filter along with its terms, columns and sort orders, 
+# using a fixed number of queries whatever the size of the filter.
+def clone_filter(expr, attrs={}):
+    related_sets = [
+        expr.dynamicfilterterm_set,
+        expr.dynamicfiltercolumn_set,
+        expr.dynamicfiltercolumnsortorder_set,
+    ]
+
+    with transaction.atomic(using=expr._state.db):
+        children = [list(related_set.all()) for related_set in related_sets]
+
+        clone = copy(expr)
+        clone.pk = None
+        clone._state = ModelState()
+        clone.__dict__.pop('_prefetched_objects_cache', None)
+        clone.use_count = 0
+        clone.refreshed_at = clone.refreshed_version = clone.refreshed_watermark = None
+
+        for key, value in attrs.items():
+            setattr(clone, key, value)
+
+        clone.save()
+
+        for related_set, rows in zip(related_sets, children):
+            for row in rows:
+                row.pk = None
+                row._state = ModelState()
+                row.filter = clone
+
+            if rows:
+                related_set.model.objects.bulk_create(rows)
+
+    return clone
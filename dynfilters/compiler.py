@@ -0,0 +1,270 @@
+# Compiles the terms of a filter into a compact AST, which can be stored 
+# as JSON and turned back into a Q object without touching the terms.
+#
+#   []                              no-op
+#   ['-', field, lookup, value]     term, with its parsed value
+#   ['!', field, lookup, value]     negated term
+#   ['@', id]                       reference to another filter
+#   ['&', a, b, ...]                AND
+#   ['|', a, b, ...]                OR
+
+from functools import reduce
+from operator import or_
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Exists, OuterRef, Q
+
+from . import shunting_yard
+from .utils import previous
+
+
+# Make implicit operators explicit, to ensure the ops stack is never empty.
+def normalize(terms, term_class):
+    nterms = []
+
+    for prev, item in previous(terms):
+        if prev:
+            # Add implicit ANDs.
+            if prev.op in ('-', '!', '@', ')') and item.op in ('-', '!', '@', '('):
+                nterms.append(term_class(op='&'))
+
+            # Add no-ops.
+            elif prev.op in ('(', '&', '|') and item.op in (')', '&', '|'):
+                nterms.append(term_class(op=' '))
+
+        nterms.append(item)
+
+    if not nterms:
+        # Add no-op to avoid an empty filter.
+        nterms.append(term_class(op=' '))
+
+    return nterms
+
+# Terms on several fields are expanded, since each field has its own
+# parsed value: NOT(a OR b) == NOT a AND NOT b.
+def as_node(term):
+    if term.op == '@':
+        return ['@', int(term.value)]
+
+    nodes = [
+        [term.op, field, term.lookup, term.get_parsed_value(field)]
+        for field in (term.fields if term.field else [term.field])
+    ]
+
+    if len(nodes) == 1:
+        return nodes[0]
+
+    return ['|' if term.op == '-' else '&', *nodes]
+
+def apply_node(op, a=None, b=None):
+    if op == ' ':
+        return []
+
+    return [op, a, b]
+
+def compile_terms(nterms):
+    return shunting_yard.evaluate(nterms, operand=as_node, apply=apply_node)
+
+def node_terms(node):
+    if not node:
+        return
+
+    if node[0] in ('-', '!'):
+        yield node
+        return
+
+    if node[0] == '@':
+        return # terms of the referenced filter
+
+    for child in node[1:]:
+        yield from node_terms(child)
+
+# Ids of the filters referenced by 'node', not those they reference.
+def node_references(node):
+    if not node or node[0] in ('-', '!'):
+        return
+
+    if node[0] == '@':
+        yield node[1]
+        return
+
+    for child in node[1:]:
+        yield from node_references(child)
+
+# The AST with its references replaced by the ASTs returned by 'resolve'.
+def node_expand(node, resolve):
+    if node and node[0] == '@':
+        return resolve(node[1])
+
+    if node and node[0] in ('&', '|'):
+        return [node[0], *(node_expand(child, resolve) for child in node[1:])]
+
+    return node
+
+def node_fields(node):
+    for op, field, lookup, value in node_terms(node):
+        yield from field.split('|')
+
+# Find the first multi-valued relation (reverse FK or M2M) along a field
+# path. Returns the path leading to it, its model, the lookup going back
+# from that model, and the rest of the path. Returns None if the path is
+# single-valued, or ends on the relation itself.
+def split_multivalued(opts, field):
+    parts = field.split('__')
+
+    for i, name in enumerate(parts[:-1]):
+        try:
+            f = opts.get_field(name)
+        except FieldDoesNotExist:
+            return None
+
+        if not f.is_relation or f.related_model is None:
+            return None
+
+        if f.many_to_many or f.one_to_many:
+            if f.concrete:
+                back = f.related_query_name()
+            elif hasattr(f, 'field'):
+                back = f.field.name
+            else:
+                return None # e.g. GenericRelation
+
+            return parts[:i], f.related_model, back, '__'.join(parts[i + 1:])
+
+        opts = f.related_model._meta
+
+    return None
+
+# Multi-valued relations are looked up with EXISTS subqueries, so that 
+# the changelist query never fans out, and needs no deduplication.
+def field_as_q(term, model, field):
+    split = split_multivalued(model._meta, field)
+
+    if split is None:
+        return Q(**term.get_term(field, model=model))
+
+    prefix, related_model, back, rest = split
+
+    subquery = related_model._default_manager.filter(
+        **{f'{back}__pk': OuterRef('__'.join(prefix + ['pk']))},
+        **term.get_term(field, rest, model),
+    )
+
+    return Q(Exists(subquery))
+
+def term_as_q(term, model=None, multivalued='join'):
+    if model is None or multivalued != 'exists':
+        return term.as_q(model)
+
+    q = reduce(or_, [
+        field_as_q(term, model, field)
+        for field in term.fields
+    ])
+
+    if term.op == '!':
+        return ~q
+
+    return q
+
+# Multi-valued relation looked up by every field of 'node', a term or a
+# subtree of terms, as a hashable (prefix, model, back) key, or None.
+def node_relation(opts, node):
+    if not node or node[0] == '@':
+        return None
+
+    if node[0] in ('-', '!'):
+        fields = node[1].split('|') if node[1] else [node[1]]
+        splits = [split_multivalued(opts, field) for field in fields]
+        if None in splits:
+            return None
+
+        relations = {(tuple(prefix), related_model, back) for prefix, related_model, back, rest in splits}
+    else:
+        relations = {node_relation(opts, child) for child in node[1:]}
+
+    if len(relations) != 1:
+        return None
+
+    return relations.pop()
+
+# 'multivalued' is the strategy used for multi-valued relations of
+# 'model', either 'join' or 'exists'. 'resolve' returns the Q of a 
+# referenced filter, given its id.
+def node_as_q(node, model=None, multivalued='join', resolve=None):
+    from .models import DynamicFilterExpr, DynamicFilterTerm
+
+    if resolve is None:
+        resolve = lambda pk: DynamicFilterExpr.objects.get(pk=pk).as_q()
+
+    def as_term(node):
+        _, field, lookup, value = node
+        fields = field.split('|') if field else [field]
+        return DynamicFilterTerm(op=node[0], field=field, lookup=lookup, typed_value=dict.fromkeys(fields, value))
+
+    # Q of a subtree of terms on the same relation, relative to the
+    # related model.
+    def relative_q(node):
+        if node[0] in ('-', '!'):
+            term = as_term(node)
+
+            q = reduce(or_, [
+                Q(**term.get_term(field, split_multivalued(model._meta, field)[3], model))
+                for field in term.fields
+            ])
+
+            return ~q if term.op == '!' else q
+
+        return reduce(
+            lambda a, b: shunting_yard.apply_q(node[0], a, b), 
+            map(relative_q, node[1:]),
+        )
+
+    # AND-ed terms on the same multi-valued relation have to match the
+    # same related row, as they do when joined. They are looked up with
+    # a single EXISTS subquery. Negated terms are only tied to the row
+    # matched by positive ones, on their own they match no row at all.
+    def and_q(children):
+        qs, groups = [], {}
+
+        for child in children:
+            relation = node_relation(model._meta, child)
+
+            if relation is None:
+                qs.append(as_q(child))
+            else:
+                groups.setdefault(relation, []).append(child)
+
+        for (prefix, related_model, back), group in groups.items():
+            if not any(term[0] == '-' for child in group for term in node_terms(child)):
+                qs.extend(map(as_q, group))
+                continue
+
+            subquery = related_model._default_manager.filter(
+                relative_q(['&', *group]),
+                **{f'{back}__pk': OuterRef('__'.join([*prefix, 'pk']))},
+            )
+            qs.append(Q(Exists(subquery)))
+
+        return reduce(lambda a, b: shunting_yard.apply_q('&', a, b), qs)
+
+    def as_q(node):
+        if not node:
+            return shunting_yard.apply_q(' ')
+
+        op = node[0]
+
+        if op == '@':
+            return resolve(node[1])
+
+        if op in ('-', '!'):
+            return term_as_q(as_term(node), model, multivalued)
+
+        if op == '&' and model is not None and multivalued == 'exists':
+            return and_q(node[1:])
+
+        return reduce(
+            lambda a, b: shunting_yard.apply_q(op, a, b), 
+            map(as_q, node[1:]),
+        )
+
+    return as_q(node)
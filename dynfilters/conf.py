@@ -0,0 +1,59 @@
+from django.conf import settings
+
+
+DEFAULTS = {
+    # Number of compiled Q objects kept in the per-process LRU.
+    'COMPILED_CACHE_SIZE': 256,
+
+    # Alias of a Django cache (see CACHES) used to share compiled Q objects
+    # between workers. None keeps the cache process-local.
+    'COMPILED_CACHE': None,
+    'COMPILED_CACHE_TIMEOUT': None,
+
+    # Alias of the database used to evaluate filters. None lets the
+    # database routers decide, with a 'dynfilter' hint.
+    'DATABASE': None,
+
+    # Refuse filters whose estimated cost (PostgreSQL, MySQL) or number
+    # of full table scans exceed these thresholds. None disables a check.
+    'GUARD_MAX_COST': None,
+    'GUARD_MAX_FULL_SCANS': None,
+
+    # 'refuse' the expensive filters, or just 'warn' about them.
+    'GUARD_ACTION': 'refuse',
+
+    # Per-statement timeout in milliseconds for filtered changelists
+    # (PostgreSQL, MySQL).
+    'STATEMENT_TIMEOUT': None,
+
+    # Number of rows fetched at once when exporting.
+    'EXPORT_CHUNK_SIZE': 2000,
+
+    # Filters taking longer than this, in milliseconds, are recorded
+    # in the slow filter log. None disables the log.
+    'SLOW_FILTER_MS': None,
+
+    # Log the timings of each filter to the 'dynfilters' logger.
+    'LOG_TIMINGS': False,
+
+    # Alias of the Django cache holding the sidebar result counts.
+    'COUNTS_CACHE': 'default',
+
+    # Number of values suggested for the terms, by default and at most,
+    # and how long they are cached (in COUNTS_CACHE), in seconds.
+    'FACETS_LIMIT': 20,
+    'FACETS_MAX_LIMIT': 200,
+    'FACETS_TIMEOUT': 300,
+
+    # Alias of the Django cache holding the sidebar filter lists.
+    'LOOKUPS_CACHE': 'default',
+
+    # Alias of the Django cache counting the runs of each filter, until
+    # the index advisor adds them to use_count. It should be shared by
+    # the workers.
+    'USE_COUNT_CACHE': 'default',
+}
+
+
+def get_setting(name):
+    return getattr(settings, f'DYNFILTERS_{name}', DEFAULTS[name])
@@ -0,0 +1,273 @@
+# Evaluates filters in Python, over objects which are not in the
+# database: model instances, dicts (e.g. webhook payloads, CSV rows),
+# or columns of values. The AST of a filter is turned once into a
+# predicate, which is then applied to any number of objects.
+#
+#   predicate = expr.as_predicate()
+#   matching = [obj for obj in objs if predicate(obj)]
+#
+#   mask = expr.as_mask()
+#   mask({'first_name': [...], 'address__town': [...]})  -> [True, False, ...]
+#
+# Values are compared as the database would, as far as possible: values
+# read from strings (e.g. CSV) are converted to the type of the filter
+# value, comparisons with None are false, multi-valued relations match
+# when any related object does, like EXISTS subqueries.
+
+import datetime
+import decimal
+import uuid
+
+
+# Fetch the values at the end of a lookup path. Related managers and
+# lists fan out, so that several values may be returned.
+def get_values(obj, path):
+    values = [obj]
+
+    for name in path.split('__'):
+        next_values = []
+
+        for value in values:
+            if value is None:
+                continue
+
+            if isinstance(value, dict):
+                value = value.get(name)
+            else:
+                value = getattr(value, name, None)
+
+            if hasattr(value, 'all') and callable(value.all):
+                value = list(value.all()) # related manager
+
+            if isinstance(value, (list, tuple)):
+                next_values.extend(value)
+            else:
+                next_values.append(value)
+
+        values = next_values
+
+    return values
+
+def as_date(value):
+    if isinstance(value, datetime.datetime):
+        return value.date()
+
+    if isinstance(value, datetime.date):
+        return value
+
+    if isinstance(value, str):
+        try:
+            return datetime.date.fromisoformat(value[:10])
+        except ValueError:
+            pass
+
+    return None
+
+# Convert 'value' to the type of 'expected', the value of the term.
+def coerce(value, expected):
+    if value is None or isinstance(expected, (list, dict)) or expected is None:
+        return value
+
+    if hasattr(value, '_meta') and hasattr(value, 'pk'):
+        value = value.pk # related model instance
+
+    if isinstance(expected, bool):
+        if isinstance(value, str):
+            return value.strip().lower() in ('1', 'true', 't', 'yes', 'y', 'on')
+        return bool(value)
+
+    if isinstance(expected, (int, float)):
+        if isinstance(value, str):
+            try:
+                value = float(value)
+            except ValueError:
+                return None
+
+        if isinstance(value, decimal.Decimal):
+            return float(value)
+
+        return value
+
+    if isinstance(value, datetime.datetime) and len(expected) == 10:
+        return value.date().isoformat() # date of a datetime
+
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+
+    if isinstance(value, (decimal.Decimal, uuid.UUID, int, float)):
+        return str(value)
+
+    return value
+
+def lower(value):
+    return None if value is None else str(value).lower()
+
+# Function comparing a single value, for 'lookup' and the value of the
+# term. The comparisons of the database lookups, None never matches.
+def get_matcher(lookup, expected):
+    if lookup in ('isnull', 'isnotnull'):
+        return lambda v: (v is None) == (lookup == 'isnull')
+
+    if lookup in ('istrue', 'isfalse'):
+        return lambda v: coerce(v, expected) is expected
+
+    if lookup == 'icontains':
+        expected = expected.lower()
+        return lambda v: v is not None and expected in lower(v)
+
+    if lookup == 'istartswith':
+        expected = expected.lower()
+        return lambda v: v is not None and lower(v).startswith(expected)
+
+    if lookup == 'iendswith':
+        expected = expected.lower()
+        return lambda v: v is not None and lower(v).endswith(expected)
+
+    if lookup in ('in', 'inset'):
+        sample = expected[0] if expected else None
+        expected = set(expected)
+        return lambda v: v is not None and coerce(v, sample) in expected
+
+    if lookup == 'range':
+        low, high = expected
+        return lambda v: (v := coerce(v, low)) is not None and low <= v <= high
+
+    if lookup in ('year', 'month', 'day'):
+        return lambda v: (d := as_date(v)) is not None and getattr(d, lookup) == expected
+
+    compare = {
+        '=': lambda a, b: a == b,
+        'lt': lambda a, b: a < b,
+        'gt': lambda a, b: a > b,
+        'lte': lambda a, b: a <= b,
+        'gte': lambda a, b: a >= b,
+    }[lookup]
+
+    def match(v):
+        v = coerce(v, expected)
+        return v is not None and compare(v, expected)
+
+    return match
+
+def get_expected(lookup, value):
+    if lookup == 'inset':
+        from .models import DynamicFilterValue
+
+        # Text values, typed like the 'in' values.
+        values = DynamicFilterValue.objects.filter(value_set_id=value['value_set']).values_list('value', flat=True)
+        return [coerce_text(v, value.get('cast')) for v in values]
+
+    return value
+
+def coerce_text(value, cast):
+    if cast and 'Integer' in cast:
+        return int(value)
+
+    if cast in ('FloatField', 'DecimalField'):
+        return float(value)
+
+    return value
+
+def default_resolve(pk):
+    from .models import DynamicFilterExpr
+    return DynamicFilterExpr.objects.get(pk=pk).get_ast()
+
+# Predicate of a term on a single object.
+def term_as_predicate(node):
+    op, field, lookup, value = node
+
+    fields = field.split('|') if field else []
+    match = get_matcher(lookup, get_expected(lookup, value))
+
+    def predicate(obj):
+        return any(
+            match(v)
+            for f in fields
+            for v in get_values(obj, f)
+        )
+
+    if op == '!':
+        return lambda obj: not predicate(obj)
+
+    return predicate
+
+# 'resolve' returns the AST of a referenced filter, given its id.
+def node_as_predicate(node, resolve=default_resolve):
+    if not node:
+        return lambda obj: True
+
+    op = node[0]
+
+    if op == '@':
+        return node_as_predicate(resolve(node[1]), resolve)
+
+    if op in ('-', '!'):
+        return term_as_predicate(node)
+
+    children = [node_as_predicate(child, resolve) for child in node[1:]]
+
+    if op == '&':
+        return lambda obj: all(child(obj) for child in children)
+
+    return lambda obj: any(child(obj) for child in children)
+
+# Mask of a term on columns of values, keyed by field path. A column
+# holds a single value per row, or a list for multi-valued relations.
+def term_as_mask(node):
+    op, field, lookup, value = node
+
+    fields = field.split('|') if field else []
+    match = get_matcher(lookup, get_expected(lookup, value))
+
+    def match_any(value):
+        if isinstance(value, (list, tuple)):
+            return any(match(v) for v in value)
+        return match(value)
+
+    def mask(columns, size):
+        result = [False] * size
+
+        for f in fields:
+            column = columns.get(f)
+            if column is None:
+                column = [None] * size
+            result = [r or match_any(v) for r, v in zip(result, column)]
+
+        if op == '!':
+            return [not r for r in result]
+
+        return result
+
+    return mask
+
+def build_mask(node, resolve):
+    if not node:
+        return lambda columns, size: [True] * size
+
+    op = node[0]
+
+    if op == '@':
+        return build_mask(resolve(node[1]), resolve)
+
+    if op in ('-', '!'):
+        return term_as_mask(node)
+
+    children = [build_mask(child, resolve) for child in node[1:]]
+    combine = all if op == '&' else any
+
+    def mask(columns, size):
+        return [combine(row) for row in zip(*(child(columns, size) for child in children))]
+
+    return mask
+
+# Batch mode: the returned function takes columns of values keyed by 
+# field path, all of the same length, and returns a list of booleans.
+# Columns are evaluated one term at a time, rather than row by row.
+def node_as_mask(node, resolve=default_resolve):
+    mask = build_mask(node, resolve)
+
+    def columns_mask(columns):
+        size = len(next(iter(columns.values()), []))
+        return mask(columns, size)
+
+    return columns_mask
@@ -0,0 +1,107 @@
+import csv
+
+from django.core.exceptions import EmptyResultSet, FieldError, ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .cache import compiled_filters
+from .conf import get_setting
+from .model_helpers import get_dynfilters_using
+
+
+# File-like object which returns what is written to it, so that
+# csv.writer() can be used to produce rows one at a time.
+class Echo:
+    def write(self, value):
+        return value
+
+
+# Display columns of the filter, or else the concrete fields.
+def get_export_columns(expr, model_admin):
+    return expr.get_columns() or get_default_columns(model_admin)
+
+async def aget_export_columns(expr, model_admin):
+    return await expr.aget_columns() or get_default_columns(model_admin)
+
+def get_default_columns(model_admin):
+    return [
+        f.name
+        for f in model_admin.model._meta.concrete_fields
+    ]
+
+# Rows of the export. The query is checked before it is streamed, see
+# check_query(), but only run when the rows are iterated.
+def get_export_queryset(request, expr, model_admin, columns):
+    queryset = (
+        filter_queryset(request, expr, model_admin, compiled_filters.get(expr), expr.get_ordering())
+            .values_list(*columns)
+    )
+    check_query(queryset)
+
+    return queryset.iterator(chunk_size=get_setting('EXPORT_CHUNK_SIZE'))
+
+async def aget_export_queryset(request, expr, model_admin, columns):
+    queryset = (
+        filter_queryset(request, expr, model_admin, await compiled_filters.aget(expr), await expr.aget_ordering())
+            .values(*columns)
+    )
+    check_query(queryset)
+
+    rows = queryset.aiterator(chunk_size=get_setting('EXPORT_CHUNK_SIZE'))
+
+    # values_list() executes its query when the iterator is created,
+    # which aiterator() does in the event loop, so go through values().
+    return (tuple(row[column] for column in columns) async for row in rows)
+
+def filter_queryset(request, expr, model_admin, q, ordering):
+    queryset = model_admin.get_queryset(request)
+
+    using = get_dynfilters_using(model_admin, expr)
+    if using != queryset.db:
+        queryset = queryset.using(using)
+
+    return queryset.filter(q).order_by(*(ordering or ['pk']))
+
+# Errors raised by invalid filters or columns, which would otherwise only
+# be raised once the response has started streaming.
+EXPORT_ERRORS = (FieldError, ValidationError, ValueError, TypeError)
+
+# Compile the SQL of 'queryset', without running it.
+def check_query(queryset):
+    try:
+        queryset.query.get_compiler(queryset.db).as_sql()
+    except EmptyResultSet:
+        pass # matches nothing, which is fine
+
+# Formats return the header line, if any, and a function formatting 
+# a row.
+def format_csv(columns):
+    writer = csv.writer(Echo())
+    return writer.writerow(columns), writer.writerow
+
+def format_jsonl(columns):
+    encoder = DjangoJSONEncoder()
+    return None, lambda row: encoder.encode(dict(zip(columns, row))) + '\n'
+
+def iter_lines(format_columns, columns, rows):
+    header, format_row = format_columns(columns)
+
+    if header is not None:
+        yield header
+
+    for row in rows:
+        yield format_row(row)
+
+async def aiter_lines(format_columns, columns, rows):
+    header, format_row = format_columns(columns)
+
+    if header is not None:
+        yield header
+
+    async for row in rows:
+        yield format_row(row)
+
+
+FORMATS = {
+    'csv': ('text/csv', format_csv),
+    'jsonl': ('application/x-ndjson', format_jsonl),
+}
@@ -0,0 +1,168 @@
+# Most frequent values of a field and their counts, to suggest the values
+# of '=' and 'in' terms instead of guessing them. Each field is counted
+# with a single GROUP BY, optionally among the rows matched by the
+# filter being edited, and the results are cached per model, field and
+# version of the filter. Several fields ('a|b') are counted with a GROUP
+# BY over the UNION ALL of their values, so that a row matching a value
+# through several fields is counted once, as the term 'a|b' matches it.
+
+from hashlib import md5
+
+from asgiref.sync import sync_to_async
+from django.core.cache import caches
+from django.core.exceptions import ValidationError
+from django.db import connections
+from django.db.models import Count, F, TextField
+from django.db.models.functions import Cast
+
+from . import values
+from .cache import compiled_filters
+from .conf import get_setting
+from .model_helpers import get_dynfilters_fields, get_dynfilters_using
+
+
+# Field paths of 'field' ('a|b' for several fields), or None if it is
+# not one of the dynfilters_fields of 'model_admin'.
+def get_facet_fields(model_admin, field):
+    choices = [value for value, label in get_dynfilters_fields(model_admin) if value != '-']
+    allowed = {f for value in choices for f in value.split('|')}
+
+    fields = field.split('|') if field else []
+    if not fields or not set(fields) <= allowed:
+        return None
+
+    return fields
+
+def get_facets_cache_key(request, expr, field, limit, scoped):
+    return 'dynfilters:facets:%s:%s:%s:%s' % (
+        expr.model,
+        request.user.pk,
+        md5(repr((field, limit)).encode()).hexdigest(),
+        f'{expr.pk}:{expr.version}' if scoped else '-',
+    )
+
+def get_base_queryset(request, expr, model_admin, q=None):
+    queryset = model_admin.get_queryset(request)
+
+    using = get_dynfilters_using(model_admin, expr)
+    if using != queryset.db:
+        queryset = queryset.using(using)
+
+    if q is not None:
+        queryset = queryset.filter(q)
+
+    return queryset.order_by()
+
+def get_facets_queryset(request, expr, model_admin, field, limit, q=None):
+    # (value, count) pairs. Rows are counted once per value, even
+    # through multi-valued relations.
+    return (
+        get_base_queryset(request, expr, model_admin, q)
+            .values(field)
+            .annotate(dynfilters_count=Count('pk', distinct=True))
+            .order_by('-dynfilters_count', field)
+            .values_list(field, 'dynfilters_count')
+            [:limit]
+    )
+
+# (value, count) pairs of several fields, counted over the UNION ALL of
+# their values. Values of fields of different types are compared as text.
+def get_union_facets(request, expr, model_admin, fields, limit, q=None):
+    queryset = get_base_queryset(request, expr, model_admin, q)
+
+    compared = [
+        values.get_compared_field(f) if (f := values.get_model_field(queryset.model, field)) else None
+        for field in fields
+    ]
+    mixed = len({f.get_internal_type() if f else None for f in compared}) > 1
+
+    union = [
+        queryset
+            .annotate(dynfilters_pk=F('pk'), dynfilters_value=Cast(field, TextField()) if mixed else F(field))
+            .values_list('dynfilters_pk', 'dynfilters_value')
+        for field in fields
+    ]
+    sql, params = union[0].union(*union[1:], all=True).query.sql_with_params()
+
+    connection = connections[queryset.db]
+    qn = connection.ops.quote_name
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'SELECT {qn("dynfilters_value")}, COUNT(DISTINCT {qn("dynfilters_pk")}) '
+            f'FROM ({sql}) {qn("dynfilters_facets")} '
+            f'GROUP BY {qn("dynfilters_value")} '
+            f'ORDER BY 2 DESC, 1 '
+            f'LIMIT %s',
+            (*params, limit),
+        )
+        rows = cursor.fetchall()
+
+    # Raw rows are not converted by the ORM.
+    if not mixed and compared[0] is not None:
+        rows = [(to_python(compared[0], value), count) for value, count in rows]
+
+    return rows
+
+def to_python(model_field, value):
+    try:
+        return model_field.to_python(value)
+    except ValidationError:
+        return value
+
+def as_facets(rows):
+    return [
+        {'value': value, 'count': count}
+        for value, count in rows
+    ]
+
+def get_facets(request, expr, model_admin, fields, limit, scoped=False):
+    cache = caches[get_setting('COUNTS_CACHE')]
+    cache_key = get_facets_cache_key(request, expr, '|'.join(fields), limit, scoped)
+
+    facets = cache.get(cache_key)
+    if facets is not None:
+        return facets
+
+    q = compiled_filters.get(expr) if scoped else None
+
+    if len(fields) == 1:
+        rows = get_facets_queryset(request, expr, model_admin, fields[0], limit, q)
+    else:
+        rows = get_union_facets(request, expr, model_admin, fields, limit, q)
+
+    facets = as_facets(rows)
+
+    cache.set(cache_key, facets, get_setting('FACETS_TIMEOUT'))
+
+    return facets
+
+async def aget_facets(request, expr, model_admin, fields, limit, scoped=False):
+    cache = caches[get_setting('COUNTS_CACHE')]
+    cache_key = get_facets_cache_key(request, expr, '|'.join(fields), limit, scoped)
+
+    facets = await cache.aget(cache_key)
+    if facets is not None:
+        return facets
+
+    q = await compiled_filters.aget(expr) if scoped else None
+
+    if len(fields) == 1:
+        rows = [row async for row in get_facets_queryset(request, expr, model_admin, fields[0], limit, q)]
+    else:
+        # Raw SQL has no async API.
+        rows = await sync_to_async(get_union_facets)(request, expr, model_admin, fields, limit, q)
+
+    facets = as_facets(rows)
+
+    await cache.aset(cache_key, facets, get_setting('FACETS_TIMEOUT'))
+
+    return facets
+
+def get_limit(request):
+    try:
+        limit = int(request.GET.get('limit', get_setting('FACETS_LIMIT')))
+    except ValueError:
+        limit = get_setting('FACETS_LIMIT')
+
+    return max(1, min(limit, get_setting('FACETS_MAX_LIMIT')))
@@ -1,18 +1,31 @@
+from hashlib import md5
+
 from django.contrib import admin, messages
 from django.contrib.admin import AdminSite
 from django.contrib.auth.models import User
-from django.db.models import Q
+from django.core.cache import caches
+from django.core.exceptions import FieldError, ValidationError
+from django.db import DatabaseError
+from django.db.models import Count, Q
+from django.middleware.csrf import get_token
 from django.urls import reverse
 
+from . import compiler, guard, materialize
+from .cache import compiled_filters, get_lookups_generation
+from .conf import get_setting
+from .guard import FilterTooExpensive
 from .model_helpers import (
     get_model_admin,
     get_qualified_model_names,
-    get_dynfilters_fields,
-    get_dynfilters_select_related,
-    get_dynfilters_prefetch_related,
+    get_dynfilters_using,
+    get_projection,
+    get_relation_plan,
 )
 from .models import DynamicFilterExpr
-from .utils import flatten
+from .pagination import CURSOR_VAR
+from .timing import new_timings, time_queries
+from .utils import timer
+from .wrappers import mark
 
 
 class DynamicFilter(admin.SimpleListFilter):
@@ -23,79 +36,248 @@ class DynamicFilter(admin.SimpleListFilter):
     email_subject = 'Sharing filter'
     email_text = 'Hi,\nI would like to share this filter with you:\n\n'
 
+    # Show the number of matching rows next to each filter.
+    show_counts = False
+    counts_timeout = 60
+
+    # How long the list of filters shown in the sidebar is cached.
+    lookups_timeout = 300
+    lookups_fields = (
+        'id', 'name', 'model', 'is_global', 'version', 'ast',
+        'materialized', 'refreshed_at', 'refreshed_version',
+    )
+
     def __init__(self, request, params, model, model_admin):
         self.request = request
+        self.model_admin = model_admin
         self.model_name = get_qualified_model_names(model._meta)[0]
 
+        # The keyset pagination cursor is not a lookup, claim it.
+        if CURSOR_VAR in params:
+            cursor = params.pop(CURSOR_VAR)
+            if isinstance(cursor, list):
+                cursor = cursor[-1]
+
+            request.dynfilters_cursor = cursor
+
         return super().__init__(request, params, model, model_admin)
 
+    # Materialized filters are refreshed with a POST request.
+    @property
+    def csrf_token(self):
+        return get_token(self.request)
+
     def has_output(self):
         return True
 
     def choices(self, changelist):
         yield {
             "selected": self.value() is None,
-            "query_string": changelist.get_query_string(remove=[self.parameter_name]),
+            "query_string": changelist.get_query_string(remove=[self.parameter_name, CURSOR_VAR]),
             "display": "All",
             "is_global": False,
         }
+
+        counts = self.get_counts() if self.show_counts else {}
+
         for obj, title in self.lookup_choices:
             yield {
                 "selected": self.value() == str(obj.id),
                 "query_string": changelist.get_query_string(
-                    {self.parameter_name: obj.id}
+                    {self.parameter_name: obj.id}, 
+                    remove=[CURSOR_VAR],
                 ),
                 "display": title,
                 "lookup": obj.id,
                 "is_global": obj.is_global,
-                "email_body": self.request.build_absolute_uri(
-                    reverse('dynfilters_share', args=(obj.id,))
-                ),
+                "count": counts.get(obj.id),
+                "materialized": obj.materialized,
+                "refreshed_at": obj.refreshed_at,
+                "is_fresh": materialize.is_fresh(obj),
+                "email_body": self.request.build_absolute_uri(self.share_urls[obj.id]),
             }
 
+    def get_counts(self):
+        objs = [obj for obj, title in self.lookup_choices]
+        if not objs:
+            return {}
+
+        cache = caches[get_setting('COUNTS_CACHE')]
+        cache_key = 'dynfilters:counts:%s:%s:%s' % (
+            self.model_name,
+            self.request.user.pk,
+            md5(repr([(o.id, o.version) for o in objs]).encode()).hexdigest(),
+        )
+
+        counts = cache.get(cache_key)
+        if counts is not None:
+            return counts
+
+        queryset = self.model_admin.get_queryset(self.request)
+
+        using = get_dynfilters_using(self.model_admin)
+        if using != queryset.db:
+            queryset = queryset.using(using)
+
+        aggregates = {}
+        for obj in objs:
+            try:
+                q = compiled_filters.get(obj)
+                queryset.filter(q) # resolve now, to catch invalid filters
+            except (FieldError, ValidationError, ValueError, DatabaseError):
+                continue # buggy filter, skip it
+
+            # Counted over the rows matched by filter(q), since the joins of
+            # multi-valued conditions would fan out together and negated
+            # ones be evaluated row by row of the joins.
+            aggregates[f'f{obj.id}'] = Count(
+                'pk', filter=Q(pk__in=queryset.model._base_manager.filter(q).values('pk')),
+            )
+
+        try:
+            counts = {
+                int(name[1:]): count
+                for name, count in queryset.aggregate(**aggregates).items()
+            } if aggregates else {}
+        except (FieldError, ValidationError, ValueError, DatabaseError):
+            return {} # don't break the page for the sake of counts
+
+        cache.set(cache_key, counts, self.counts_timeout)
+
+        return counts
+
     def lookups(self, request, model_admin):
         model_names = get_qualified_model_names(model_admin.opts)
-        
-        return [
-            (o, o.name)
-            for o in (
-                DynamicFilterExpr
-                    .objects
-                    .filter(model__in=model_names)
-                    .filter(Q(user=request.user) | Q(is_global=True))
-                    .order_by('name')
-                )
+
+        cache = caches[get_setting('LOOKUPS_CACHE')]
+        cache_key = 'dynfilters:lookups:%s:%s:%s' % (
+            request.user.pk,
+            md5(repr(model_names).encode()).hexdigest(),
+            md5(get_lookups_generation(model_names).encode()).hexdigest(),
+        )
+
+        # The rows are loaded as instances of the database they are read
+        # from.
+        using = DynamicFilterExpr.objects.db
+
+        rows = cache.get(cache_key)
+        if rows is None:
+            rows = [
+                (values, reverse('dynfilters_share', args=(values[0],)))
+                for values in (
+                    DynamicFilterExpr
+                        .objects
+                        .using(using)
+                        .filter(model__in=model_names)
+                        .filter(Q(user=request.user) | Q(is_global=True))
+                        .order_by('name')
+                        .values_list(*self.lookups_fields)
+                    )
+            ]
+
+            cache.set(cache_key, rows, self.lookups_timeout)
+
+        # The stored AST is loaded with the other fields, so that the
+        # counts compile the filters without further queries. The fields
+        # left out are deferred.
+        objs = [
+            DynamicFilterExpr.from_db(using, self.lookups_fields, values)
+            for values, url in rows
         ]
 
+        self.share_urls = {obj.id: url for obj, (values, url) in zip(objs, rows)}
+
+        return [(o, o.name) for o in objs]
+
     def queryset(self, request, queryset):
         if self.value() is not None:
-            try:
-                obj = DynamicFilterExpr.objects.get(pk=self.value())
-            except DynamicFilterExpr.DoesNotExist:
-                return queryset # filter no longer exists, ignore
+            timings = new_timings()
+
+            with timer(timings, 'load'):
+                try:
+                    obj = DynamicFilterExpr.objects.get(pk=self.value())
+                except DynamicFilterExpr.DoesNotExist:
+                    return queryset # filter no longer exists, ignore
+
+                columns = obj.get_columns()
+
+            # Compile and store the AST, if the terms changed since.
+            if obj.ast is None:
+                obj.get_ast(timings)
+
+            # Used by the keyset pagination.
+            request.dynfilters_expr = obj
+
+            # Usage statistics, e.g. for the index advisor.
+            obj.count_use()
 
             model_admin = get_model_admin(obj)
+            plan = get_relation_plan(model_admin)
+
+            using = get_dynfilters_using(model_admin, obj)
+            if using != queryset.db:
+                queryset = queryset.using(using)
+
+            select_related = set(plan['select_related'])
+            for field in obj.used_fields():
+                if path := plan['paths'].get(field):
+                    select_related.add(path)
+
+            # Only load the fields displayed by the changelist, when the
+            # filter has display columns.
+            only_fields = None
+            if columns:
+                if projection := get_projection(self.model_admin, request, select_related):
+                    only_fields, related = projection
+                    select_related |= related
 
-            elementary_fields = flatten([
-                f.split('__') 
-                for f, display in get_dynfilters_fields(model_admin)
-                if f != '-'
-            ])
+            # Without arguments, these would follow every relation
+            # and clear the existing prefetches respectively.
+            if select_related:
+                queryset = queryset.select_related(*sorted(select_related))
 
-            queryset = queryset.select_related(*[
-                f 
-                for f in get_dynfilters_select_related(model_admin)
-                if f in elementary_fields
-            ])
+            if only_fields:
+                queryset = queryset.only(*only_fields)
 
-            queryset = queryset.prefetch_related(*[
-                f 
-                for f in get_dynfilters_prefetch_related(model_admin)
-                if f in elementary_fields
-            ])
+            if plan['prefetch_related']:
+                queryset = queryset.prefetch_related(*plan['prefetch_related'])
 
             try:
-                return queryset.filter(obj.as_q())
-            except:
+                # Materialized filters look up their stored results, as
+                # long as they were refreshed since the filter changed.
+                if materialize.is_fresh(obj) and (results := materialize.get_results_subquery(obj, queryset)) is not None:
+                    filtered = queryset.filter(pk__in=results)
+
+                else:
+                    filtered = queryset.filter(compiled_filters.get(obj, timings))
+                    guard.check(filtered, obj)
+
+            except FilterTooExpensive as e:
+                if get_setting('GUARD_ACTION') != 'warn':
+                    messages.error(request, str(e))
+                    return queryset
+
+                messages.warning(request, str(e))
+
+            except FieldError as e:
+                messages.error(request, f'The selected filter refers to an invalid field: {e}')
+                return queryset
+
+            except (ValidationError, ValueError, TypeError) as e:
+                messages.error(request, f'The selected filter has an invalid value: {e}')
+                return queryset
+
+            except Exception:
                 messages.error(request, 'The selected filter is buggy and cannot be applied.')
                 return queryset
+
+            # Only the statements of the filtered queryset are limited
+            # and timed, not the other queries of the changelist.
+            filtered = mark(filtered)
+
+            guard.apply_statement_timeout(request, filtered)
+
+            term_count = len(list(compiler.node_terms(obj.ast)))
+            time_queries(filtered, obj, term_count, timings)
+
+            return filtered
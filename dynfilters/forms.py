@@ -6,14 +6,14 @@ from django.core.exceptions import ValidationError
 
 from adminsortable2.admin import CustomInlineFormSet
 
-from .models import DynamicFilterExpr, DynamicFilterTerm
-from .utils import str_as_date, str_as_date_range
+from . import values
+from .models import DynamicFilterExpr, DynamicFilterTerm, DynamicFilterValueSet
 
 
 class DynamicFilterExprForm(forms.ModelForm):
     class Meta:
         model = DynamicFilterExpr
-        fields = ('name', 'is_global')
+        fields = ('name', 'is_global', 'materialized')
 
 
 class DynamicFilterTermInlineFormSet(CustomInlineFormSet):
@@ -21,7 +21,8 @@ class DynamicFilterTermInlineFormSet(CustomInlineFormSet):
         parenthesis = 0
 
         for form in self.forms:
-            op, deleted = itemgetter('op', 'DELETE')(self.cleaned_data)
+            op = form.cleaned_data.get('op')
+            deleted = form.cleaned_data.get('DELETE')
             
             if deleted:
                 continue # inline object was deleted by user
@@ -41,13 +42,33 @@ class DynamicFilterTermInlineFormSet(CustomInlineFormSet):
 class DynamicFilterTermInlineForm(forms.ModelForm):
     class Meta:
         model = DynamicFilterTerm
-        fields = ('op', 'field', 'lookup', 'value', 'order')
+        fields = ('op', 'field', 'lookup', 'value', 'values', 'values_file', 'order')
+
+    # Values of the 'One of (list)' lookup, pasted or uploaded.
+    values = forms.CharField(
+        required=False, 
+        widget=forms.Textarea(attrs={'rows': 1, 'cols': 20}),
+        help_text='One value per line, or comma separated.',
+    )
+    values_file = forms.FileField(required=False, label='Values file')
+
+    value_list = None
 
     def clean(self):
         errors = {}
 
         op, field, lookup, value = itemgetter('op', 'field', 'lookup', 'value')(self.cleaned_data)
 
+        if op in ('-', '!') and lookup == 'inset' and field != '-':
+            try:
+                self.value_list = self.get_value_list(field)
+            except (ValidationError, ValueError) as e:
+                errors.update({'values': getattr(e, 'messages', str(e))})
+
+            else:
+                if not self.value_list and not self.instance.value_set_id:
+                    errors.update({'values': 'Missing values'})
+
         if op in ('-', '!'):
             if field == '-':
                 errors.update({'field': 'Missing value'})
@@ -56,32 +77,42 @@ class DynamicFilterTermInlineForm(forms.ModelForm):
                 errors.update({'lookup': 'Missing value'})
 
             if not value:
-                if lookup not in ('isnull', 'isnotnull', 'istrue', 'isfalse'):
+                if lookup not in ('isnull', 'isnotnull', 'istrue', 'isfalse', 'inset'):
                     errors.update({'value': 'Missing value'})
 
-            else:
-                if 'date' in field:
-                    if lookup == 'range':
-                        try:
-                            str_as_date_range(value)
-                        except:
-                            errors.update({'value': 'Should be "DD/MM/YYYY, DD/MM/YYYY"'})
-
-                    else:
-                        try:
-                            str_as_date(value)
-                        except:
-                            errors.update({'value': 'Should be "DD/MM/YYYY"'})
-
-
-                if lookup in ('year', 'month', 'day', 'lt', 'gt', 'lte', 'gte'):
-                    try:
-                        float(value)
-                    except:
-                        errors.update({'value': 'Should be a number'})
+            # The value is parsed against the model field of each field.
+            elif field != '-' and lookup not in ('-', 'inset'):
+                try:
+                    for f in field.split('|'):
+                        values.parse_value(self.instance.get_model_field(f), lookup, value)
+                except (ValidationError, ValueError) as e:
+                    errors.update({'value': getattr(e, 'messages', str(e))})
+
+        elif op == '@':
+            if not value:
+                errors.update({'value': 'Missing filter id'})
 
         else:
             pass # will be handled by model clean()
 
         if errors:
             raise ValidationError(errors)
+
+    def get_value_list(self, field):
+        text = self.cleaned_data.get('values') or ''
+
+        if upload := self.cleaned_data.get('values_file'):
+            text += '\n' + upload.read().decode('utf-8-sig')
+
+        if not text.strip():
+            return None
+
+        model_fields = [self.instance.get_model_field(f) for f in field.split('|')]
+        return values.parse_value_list(model_fields, text)
+
+    def save(self, commit=True):
+        if self.value_list:
+            self.instance.value_set = DynamicFilterValueSet.from_values(self.value_list)
+            self.instance.value = values.summarize(self.value_list)
+
+        return super().save(commit)
@@ -0,0 +1,280 @@
+# Guards against filters that are too expensive to run, using the 
+# query plan estimated by the database (EXPLAIN).
+
+import json
+import re
+
+from django.contrib import messages
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.core.exceptions import FieldDoesNotExist
+from django.db import OperationalError, connections, transaction
+
+from . import compiler
+from .conf import get_setting
+from .models import DynamicFilterTerm
+from .wrappers import add_request_wrapper, is_marked
+
+
+# Lookups that cannot use a plain index.
+COSTLY_LOOKUPS = ('icontains', 'iendswith', 'istartswith', 'year', 'month', 'day')
+
+
+class FilterTooExpensive(Exception):
+    pass
+
+
+def walk(plan):
+    if isinstance(plan, dict):
+        yield plan
+        for value in plan.values():
+            yield from walk(value)
+
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from walk(value)
+
+# Names of the tables read by the query, by alias.
+def get_table_aliases(queryset):
+    connection = connections[queryset.db]
+    sql, params = queryset.query.sql_with_params()
+
+    quoted = re.escape(connection.ops.quote_name('TABLE')).replace('TABLE', r'(\w+)')
+
+    return {
+        alias or table: table
+        for table, alias in re.findall(r'\b(?:FROM|JOIN) ' + quoted + r'(?: (\w+))?', sql)
+    }
+
+# Returns the estimated cost (or None if the backend does not provide it)
+# of the query, and its full table scans, as (table, condition) pairs.
+# The condition is the one applied to the scanned rows, when known.
+def explain(queryset):
+    vendor = connections[queryset.db].vendor
+
+    if vendor == 'postgresql':
+        plan = json.loads(queryset.explain(format='json'))
+        return (
+            plan[0]['Plan']['Total Cost'],
+            [
+                (node.get('Relation Name'), node.get('Filter'))
+                for node in walk(plan) 
+                if node.get('Node Type') == 'Seq Scan'
+            ],
+        )
+
+    aliases = get_table_aliases(queryset)
+
+    if vendor == 'mysql':
+        plan = json.loads(queryset.explain(format='json'))
+        return (
+            float(plan['query_block']['cost_info']['query_cost']),
+            [
+                (aliases.get(node.get('table_name'), node.get('table_name')), node.get('attached_condition'))
+                for node in walk(plan) 
+                if node.get('access_type') == 'ALL'
+            ],
+        )
+
+    if vendor == 'sqlite':
+        plan = queryset.explain()
+        return (
+            None,
+            [
+                (aliases.get(name, name), None)
+                for name in re.findall(r'\bSCAN (?:TABLE )?(\w+)', plan)
+                if name not in ('CONSTANT', 'SUBQUERY')
+            ],
+        )
+
+    return None, []
+
+# Table and column of a field path, and whether it is indexed, or None
+# if the path does not end on a concrete field.
+def get_column(opts, field):
+    *path, name = field.split('__')
+
+    try:
+        for part in path:
+            f = opts.get_field(part)
+            if not f.is_relation or f.related_model is None:
+                return None
+
+            opts = f.related_model._meta
+
+        f = opts.get_field(name)
+    except FieldDoesNotExist:
+        return None
+
+    if not f.concrete or f.many_to_many:
+        return None
+
+    indexed = f.primary_key or f.unique or f.db_index or any(
+        index.fields and index.fields[0] == f.name
+        for index in opts.indexes
+    )
+
+    return opts.db_table, f.column, indexed
+
+def describe_term(node):
+    op, field, lookup, value = node
+    lookups = dict(DynamicFilterTerm.LOOKUP_CHOICES)
+
+    if lookup == 'inset':
+        desc = f'{field} {lookups[lookup].lower()}'
+    else:
+        desc = f'{field} {lookups.get(lookup, lookup).lower()} "{value}"'
+
+    if op == '!':
+        return f'NOT {desc}'
+
+    return desc
+
+# Whether the term 'node' is evaluated by one of the full 'scans' of the
+# plan: its column belongs to a scanned table, and either appears in the
+# condition of the scan, or is not indexed (when the condition is unknown).
+def is_scanned(opts, node, scans):
+    op, field, lookup, value = node
+
+    for f in field.split('|'):
+        column = get_column(opts, f)
+        if column is None:
+            continue
+
+        table, name, indexed = column
+
+        for scanned, condition in scans:
+            if scanned != table:
+                continue
+
+            if condition is not None:
+                if name in condition:
+                    return True
+
+            elif not indexed or lookup in COSTLY_LOOKUPS:
+                return True
+
+    return False
+
+# Raises FilterTooExpensive if the estimated cost or number of full
+# scans of 'queryset', filtered with 'obj', is above the thresholds.
+def check(queryset, obj):
+    max_cost = get_setting('GUARD_MAX_COST')
+    max_full_scans = get_setting('GUARD_MAX_FULL_SCANS')
+
+    if max_cost is None and max_full_scans is None:
+        return
+
+    cost, scans = explain(queryset)
+
+    reasons = []
+    if max_cost is not None and cost is not None and cost > max_cost:
+        reasons.append(f'estimated cost {cost:.0f} exceeds {max_cost}')
+
+    if max_full_scans is not None and len(scans) > max_full_scans:
+        reasons.append(f'{len(scans)} full table scans exceed {max_full_scans}')
+
+    if not reasons:
+        return
+
+    # The terms evaluated by the full scans of the plan.
+    opts = queryset.model._meta
+    culprits = [
+        describe_term(node)
+        for node in compiler.node_terms(obj.get_ast())
+        if is_scanned(opts, node, scans)
+    ]
+
+    message = 'The selected filter is too expensive: %s.' % ', '.join(reasons)
+
+    if culprits:
+        message += ' Consider changing: %s.' % '; '.join(culprits)
+
+    raise FilterTooExpensive(message)
+
+def is_timeout(connection, error):
+    cause = error.__cause__
+
+    if connection.vendor == 'postgresql':
+        # psycopg2, psycopg 3
+        return getattr(cause, 'pgcode', None) == '57014' or getattr(cause, 'sqlstate', None) == '57014'
+
+    if connection.vendor == 'mysql':
+        return bool(error.args) and error.args[0] == 3024
+
+    return False
+
+def add_timeout_hint(sql, timeout):
+    return re.sub(r'^\s*SELECT\b', f'SELECT /*+ MAX_EXECUTION_TIME({int(timeout)}) */', sql, count=1, flags=re.IGNORECASE)
+
+
+class StatementTimeout:
+    """
+    Execute wrapper limiting the duration of the statements of the
+    filtered queryset (see wrappers.mark()), for the rest of the request.
+    Other queries of the request, e.g. the unfiltered count of the
+    changelist, are not limited.
+
+    MySQL queries get a MAX_EXECUTION_TIME hint. PostgreSQL ones are run
+    in a transaction (a savepoint within an existing one), with a local
+    statement_timeout which is restored afterwards.
+
+    A cancelled query is reported to the user, and the changelist falls
+    back to the unfiltered rows (IncorrectLookupParameters).
+    """
+
+    def __init__(self, request, connection, timeout):
+        self.request = request
+        self.connection = connection
+        self.timeout = int(timeout)
+
+    def __call__(self, execute, sql, params, many, context):
+        if many or not is_marked(sql):
+            return execute(sql, params, many, context)
+
+        try:
+            if self.connection.vendor == 'mysql':
+                return execute(add_timeout_hint(sql, self.timeout), params, many, context)
+
+            return self.execute_postgresql(execute, sql, params, many, context)
+
+        except OperationalError as e:
+            if not is_timeout(self.connection, e):
+                raise
+
+            messages.error(self.request, f'The selected filter took longer than {self.timeout} ms and was cancelled.')
+            raise IncorrectLookupParameters(str(e)) from e
+
+    def execute_postgresql(self, execute, sql, params, many, context):
+        in_transaction = self.connection.in_atomic_block
+
+        with transaction.atomic(using=self.connection.alias):
+            with self.connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT current_setting('statement_timeout'), set_config('statement_timeout', %s, true)",
+                    [str(self.timeout)],
+                )
+                previous = cursor.fetchone()[0]
+
+            result = execute(sql, params, many, context)
+
+            # SET LOCAL lasts until the end of the enclosing transaction.
+            if in_transaction:
+                with self.connection.cursor() as cursor:
+                    cursor.execute("SELECT set_config('statement_timeout', %s, true)", [previous])
+
+            return result
+
+# Applies DYNFILTERS_STATEMENT_TIMEOUT to the queries of 'queryset', a
+# filtered changelist queryset marked with wrappers.mark(), see
+# StatementTimeout.
+def apply_statement_timeout(request, queryset):
+    timeout = get_setting('STATEMENT_TIMEOUT')
+    if not timeout:
+        return
+
+    connection = connections[queryset.db]
+    if connection.vendor not in ('postgresql', 'mysql'):
+        return # not supported
+
+    wrapper = StatementTimeout(request, connection, timeout)
+    add_request_wrapper(queryset.db, wrapper)
@@ -0,0 +1,254 @@
+from collections import defaultdict
+from hashlib import md5
+
+from django.core.exceptions import FieldDoesNotExist
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.migrations.loader import MigrationLoader
+
+from dynfilters import compiler
+from dynfilters.model_helpers import get_model_obj
+from dynfilters.models import DynamicFilterExpr
+
+
+# Kind of index helping each lookup. Django turns '__year' into a range
+# on the column, but '__month' and '__day' extract the date part, and
+# case-insensitive lookups compare UPPER() values on PostgreSQL, where 
+# LIKE prefixes can only use indexes with the text_pattern_ops operator
+# class (unless the collation is "C"). Other backends compare the column
+# itself, without regard to case.
+INDEX_KINDS = {
+    '=': 'btree',
+    'in': 'btree',
+    'inset': 'btree',
+    'range': 'btree',
+    'year': 'btree',
+    'lt': 'btree',
+    'gt': 'btree',
+    'lte': 'btree',
+    'gte': 'btree',
+    'isnull': 'btree',
+    'isnotnull': 'btree',
+    'istrue': 'btree',
+    'isfalse': 'btree',
+    'istartswith': 'upper',
+    'icontains': 'trigram',
+    'iendswith': 'trigram',
+    'month': 'month',
+    'day': 'day',
+}
+
+INDEX_EXPRESSIONS = {
+    'upper': "OpClass(Upper('%s'), name='text_pattern_ops')",
+    'month': "ExtractMonth('%s')",
+    'day': "ExtractDay('%s')",
+    'trigram': "OpClass(Upper('%s'), name='gin_trgm_ops')",
+}
+
+INDEX_IMPORTS = {
+    'upper': [
+        'from django.contrib.postgres.indexes import OpClass',
+        'from django.db.models.functions import Upper',
+    ],
+    'month': ['from django.db.models.functions import ExtractMonth'],
+    'day': ['from django.db.models.functions import ExtractDay'],
+    'trigram': [
+        'from django.contrib.postgres.indexes import GinIndex',
+        'from django.contrib.postgres.indexes import OpClass',
+        'from django.db.models.functions import Upper',
+    ],
+}
+
+# Kinds of index specific to PostgreSQL, and their replacement elsewhere.
+POSTGRESQL_KINDS = {
+    'upper': 'btree',
+    'trigram': None,
+}
+
+
+# Resolve a field path to the model and concrete field it ends on.
+def resolve_field(model_obj, path):
+    opts = model_obj._meta
+    field = None
+
+    for name in path.split('__'):
+        try:
+            field = opts.get_field(name)
+        except FieldDoesNotExist:
+            return None
+
+        if field.is_relation and field.related_model is not None:
+            if not field.concrete or field.many_to_many:
+                # Reverse or M2M relation, continue on the related model.
+                opts = field.related_model._meta
+                field = None
+                continue
+
+            opts = field.related_model._meta
+
+    if field is None or not field.concrete:
+        return None
+
+    return field.model, field
+
+def is_indexed(model_obj, field):
+    if field.primary_key or field.unique or field.db_index:
+        return True
+
+    return any(
+        list(index.fields) == [field.name]
+        for index in model_obj._meta.indexes
+    )
+
+def index_name(model_obj, field, kind):
+    digest = md5(f'{model_obj._meta.db_table}.{field.name}.{kind}'.encode()).hexdigest()
+    return f'dyn_{field.name[:16]}_{digest[:8]}'
+
+def index_code(model_obj, field, kind):
+    name = index_name(model_obj, field, kind)
+
+    if kind == 'btree':
+        return f"models.Index(fields=['{field.name}'], name='{name}')"
+
+    expression = INDEX_EXPRESSIONS[kind] % field.name
+
+    if kind == 'trigram':
+        return f"GinIndex({expression}, name='{name}')"
+
+    return f"models.Index({expression}, name='{name}')"
+
+
+class Command(BaseCommand):
+    help = 'Suggest indexes from the fields and lookups used by stored dynamic filters.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--model', action='append', default=[],
+            help='Only consider filters on this model (app_label.Model). Can be repeated.',
+        )
+        parser.add_argument(
+            '--min-weight', type=int, default=1,
+            help='Only suggest indexes whose weight is at least this.',
+        )
+        parser.add_argument(
+            '--trigram', action='store_true',
+            help='Suggest PostgreSQL trigram indexes for "Contains" and "Ends with" lookups.',
+        )
+        parser.add_argument(
+            '--migration', action='store_true',
+            help='Print a migration adding the suggested indexes, for each app.',
+        )
+        parser.add_argument(
+            '--database', default=DEFAULT_DB_ALIAS,
+            help='Suggest indexes for the backend of this database.',
+        )
+
+    def handle(self, *args, **options):
+        suggestions = self.get_suggestions(options)
+
+        suggestions = sorted(
+            (
+                (key, usage)
+                for key, usage in suggestions.items()
+                if usage['weight'] >= options['min_weight']
+            ),
+            key=lambda item: -item[1]['weight'],
+        )
+
+        if options['migration']:
+            self.print_migrations(suggestions)
+        else:
+            self.print_suggestions(suggestions)
+
+    # Aggregate the terms of all filters, each weighted by the 
+    # number of times its filter was run (plus one for existing).
+    def get_suggestions(self, options):
+        suggestions = defaultdict(lambda: {'weight': 0, 'lookups': set()})
+        postgresql = connections[options['database']].vendor == 'postgresql'
+
+        # Runs counted since the last time.
+        DynamicFilterExpr.flush_use_counts()
+
+        exprs = DynamicFilterExpr.objects.all()
+        if options['model']:
+            exprs = exprs.filter(model__in=options['model'])
+
+        for expr in exprs.iterator():
+            try:
+                model_obj = get_model_obj(expr.model)
+            except (LookupError, ValueError):
+                continue # model is gone
+
+            weight = expr.use_count + 1
+
+            for op, fields, lookup, value in compiler.node_terms(expr.get_ast()):
+                kind = INDEX_KINDS.get(lookup)
+
+                if not postgresql:
+                    kind = POSTGRESQL_KINDS.get(kind, kind)
+
+                if kind is None or (kind == 'trigram' and not options['trigram']):
+                    continue
+
+                for path in fields.split('|'):
+                    resolved = resolve_field(model_obj, path)
+                    if resolved is None:
+                        continue
+
+                    target_model, field = resolved
+
+                    if kind == 'btree' and is_indexed(target_model, field):
+                        continue
+
+                    usage = suggestions[(target_model, field, kind)]
+                    usage['weight'] += weight
+                    usage['lookups'].add(lookup)
+
+        return suggestions
+
+    def print_suggestions(self, suggestions):
+        if not suggestions:
+            self.stdout.write('No index to suggest.')
+            return
+
+        for (model_obj, field, kind), usage in suggestions:
+            self.stdout.write('%-40s %-8s weight=%-6d lookups=%s' % (
+                f'{model_obj._meta.label}.{field.name}',
+                kind,
+                usage['weight'],
+                ','.join(sorted(usage['lookups'])),
+            ))
+
+    def print_migrations(self, suggestions):
+        loader = MigrationLoader(None, ignore_no_migrations=True)
+
+        by_app = defaultdict(list)
+        for (model_obj, field, kind), usage in suggestions:
+            by_app[model_obj._meta.app_label].append((model_obj, field, kind))
+
+        for app_label, indexes in by_app.items():
+            imports = sorted({
+                line
+                for model_obj, field, kind in indexes
+                for line in INDEX_IMPORTS.get(kind, [])
+            })
+            dependencies = sorted(loader.graph.leaf_nodes(app_label))
+
+            self.stdout.write(f'# {app_label}/migrations/XXXX_dynfilters_indexes.py\n')
+            self.stdout.write('from django.db import migrations, models')
+            for line in imports:
+                self.stdout.write(line)
+
+            self.stdout.write('\n\nclass Migration(migrations.Migration):\n')
+            self.stdout.write('    dependencies = [')
+            for dependency in dependencies:
+                self.stdout.write(f'        {dependency!r},')
+            self.stdout.write('    ]\n')
+
+            self.stdout.write('    operations = [')
+            for model_obj, field, kind in indexes:
+                self.stdout.write('        migrations.AddIndex(')
+                self.stdout.write(f"            model_name='{model_obj._meta.model_name}',")
+                self.stdout.write(f'            index={index_code(model_obj, field, kind)},')
+                self.stdout.write('        ),')
+            self.stdout.write('    ]\n')
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+
+from dynfilters.materialize import refresh
+from dynfilters.models import DynamicFilterExpr
+
+
+class Command(BaseCommand):
+    help = 'Refresh the results of materialized dynamic filters.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--filter', type=int, action='append', default=[],
+            help='Only refresh this filter (id). Can be repeated.',
+        )
+        parser.add_argument(
+            '--model', action='append', default=[],
+            help='Only refresh filters on this model (app_label.Model). Can be repeated.',
+        )
+        parser.add_argument(
+            '--full', action='store_true',
+            help='Evaluate all the rows again, instead of those changed since the previous refresh.',
+        )
+
+    def handle(self, *args, **options):
+        exprs = DynamicFilterExpr.objects.filter(materialized=True)
+
+        if options['filter']:
+            exprs = exprs.filter(pk__in=options['filter'])
+
+        if options['model']:
+            exprs = exprs.filter(model__in=options['model'])
+
+        for expr in exprs.order_by('pk'):
+            try:
+                count = refresh(expr, full=options['full'])
+            except Exception as e:
+                self.stderr.write(f'{expr.pk} {expr.name}: {e}')
+                continue
+
+            if options['verbosity'] >= 1:
+                self.stdout.write(f'{expr.pk} {expr.name}: {count} rows')
@@ -0,0 +1,150 @@
+# Materialized filters store the primary keys of the rows they match in
+# DynamicFilterResult, so that viewers look them up instead of running
+# the filter. The results are refreshed by the dynfilters_refresh
+# command or on demand, and only stand for the filter while its version
+# is the refreshed one.
+#
+# When the model has a watermark field (dynfilters_watermark on the
+# ModelAdmin, 'updated_at' by default), only the rows changed since the
+# previous refresh are evaluated again. Deleted rows need no refresh,
+# since results are joined with the model table. Filters on related rows
+# or referencing other filters are always refreshed in full, since the
+# rows they match change without their watermark changing.
+
+from itertools import islice
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db import router, transaction
+from django.db.models import Max
+from django.db.models.functions import Cast
+from django.utils import timezone
+
+from . import compiler
+from .cache import bump_lookups_generation, compiled_filters
+from .conf import get_setting
+from .model_helpers import (
+    get_dynfilters_using,
+    get_dynfilters_watermark,
+    get_model_admin,
+    get_model_obj,
+)
+from .models import DynamicFilterExpr, DynamicFilterResult
+from .values import get_cast_field
+
+
+def is_fresh(expr):
+    return (
+        expr.materialized and
+        expr.refreshed_at is not None and
+        expr.refreshed_version == expr.version
+    )
+
+def get_watermark(model_obj, model_admin):
+    name = get_dynfilters_watermark(model_admin)
+
+    try:
+        model_obj._meta.get_field(name)
+    except (FieldDoesNotExist, TypeError):
+        return None
+
+    return name
+
+# Whether the rows matched by 'ast' only depend on their own columns, 
+# i.e. no term crosses a relation and no other filter is referenced.
+def uses_own_columns(model_obj, ast):
+    if any(compiler.node_references(ast)):
+        return False
+
+    for path in compiler.node_fields(ast):
+        name, *rest = path.split('__')
+
+        try:
+            f = model_obj._meta.get_field(name)
+        except FieldDoesNotExist:
+            return False
+
+        if f.is_relation and (rest or not f.concrete):
+            return False
+
+    return True
+
+# Subquery of the primary keys matched by 'expr', or None if they cannot
+# be joined with 'queryset' (another database).
+def get_results_subquery(expr, queryset):
+    if router.db_for_read(DynamicFilterResult) != queryset.db:
+        return None
+
+    results = DynamicFilterResult.objects.using(queryset.db).filter(filter=expr)
+
+    if cast := get_cast_field(queryset.model._meta.pk):
+        results = results.annotate(typed=Cast('object_id', output_field=cast))
+        return results.values('typed')
+
+    return results.values('object_id')
+
+def store(expr, pks, using, chunk_size):
+    pks = iter(pks)
+    count = 0
+
+    while chunk := list(islice(pks, chunk_size)):
+        DynamicFilterResult.objects.using(using).bulk_create([
+            DynamicFilterResult(filter=expr, object_id=str(pk)) 
+            for pk in chunk
+        ])
+        count += len(chunk)
+
+    return count
+
+# Evaluate 'expr' again, only on the rows changed since the previous
+# refresh when possible, unless 'full'. Returns the number of matching
+# rows stored.
+def refresh(expr, full=False):
+    model_obj = get_model_obj(expr.model)
+    model_admin = get_model_admin(expr)
+
+    queryset = model_obj._default_manager.using(get_dynfilters_using(model_admin, expr))
+    watermark = get_watermark(model_obj, model_admin)
+
+    incremental = (
+        not full and
+        watermark is not None and
+        expr.refreshed_watermark is not None and
+        expr.refreshed_version == expr.version and
+        uses_own_columns(model_obj, expr.get_ast())
+    )
+
+    # Rows changed while refreshing are caught by the next refresh.
+    new_watermark = queryset.aggregate(m=Max(watermark))['m'] if watermark else None
+
+    if incremental:
+        queryset = queryset.filter(**{f'{watermark}__gt': expr.refreshed_watermark})
+
+    chunk_size = get_setting('EXPORT_CHUNK_SIZE')
+    using = router.db_for_write(DynamicFilterResult)
+    q = compiled_filters.get(expr)
+
+    with transaction.atomic(using=using):
+        results = DynamicFilterResult.objects.using(using).filter(filter=expr)
+
+        if incremental:
+            changed = [str(pk) for pk in queryset.values_list('pk', flat=True)]
+
+            for i in range(0, len(changed), chunk_size):
+                results.filter(object_id__in=changed[i:i + chunk_size]).delete()
+
+        else:
+            results.delete()
+
+        pks = queryset.filter(q).values_list('pk', flat=True).iterator(chunk_size=chunk_size)
+        count = store(expr, pks, using, chunk_size)
+
+        DynamicFilterExpr.objects.filter(pk=expr.pk).update(
+            refreshed_at=timezone.now(),
+            refreshed_version=expr.version,
+            refreshed_watermark=new_watermark or expr.refreshed_watermark,
+        )
+
+    # The sidebar shows when filters were refreshed.
+    bump_lookups_generation(expr.model)
+
+    return count
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dynfilters', '0006_alter_dynamicfilterexpr_is_global'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dynamicfilterexpr',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='dynamicfilterexpr',
+            name='version',
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dynfilters', '0007_dynamicfilterexpr_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dynamicfilterexpr',
+            name='ast',
+            field=models.JSONField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,109 @@
+from django.db import migrations
+
+
+# Frozen copies of the compiler at the time of this migration, so that
+# later changes to dynfilters.compiler do not change what it does.
+
+# Make implicit operators explicit, to ensure the ops stack is never empty.
+def normalize(terms, term_class):
+    nterms = []
+    prev = None
+
+    for item in terms:
+        if prev:
+            # Add implicit ANDs.
+            if prev.op in ('-', '!', ')') and item.op in ('-', '!', '('):
+                nterms.append(term_class(op='&'))
+
+            # Add no-ops.
+            elif prev.op in ('(', '&', '|') and item.op in (')', '&', '|'):
+                nterms.append(term_class(op=' '))
+
+        nterms.append(item)
+        prev = item
+
+    if not nterms:
+        # Add no-op to avoid an empty filter.
+        nterms.append(term_class(op=' '))
+
+    return nterms
+
+
+# Terms with their raw values.
+def as_node(term):
+    return [term.op, term.field, term.lookup, term.value]
+
+
+def apply_node(op, a=None, b=None):
+    if op == ' ':
+        return []
+
+    return [op, a, b]
+
+
+# Shunting-yard evaluation of the normalized terms into an AST.
+def compile_terms(tokens):
+    def precedence(op):
+        if op == ' ': return 3 # no-op
+        if op == '&': return 2 # AND
+        if op == '|': return 1 # OR
+        return 0
+
+    def pop_and_apply_op():
+        op = ops.pop()
+
+        if op == ' ':
+            return apply_node(op)
+
+        b = values.pop()
+        a = values.pop()
+
+        return apply_node(op, a, b)
+
+    values = []
+    ops = []
+
+    for token in tokens:
+        if token.op == '(':
+            ops.append(token.op)
+
+        elif token.op in ('-', '!'):
+            values.append(as_node(token))
+
+        elif token.op == ')':
+            while ops and ops[-1] != '(':
+                values.append(pop_and_apply_op())
+
+            ops.pop()
+
+        else:
+            while ops and precedence(ops[-1]) >= precedence(token.op):
+                values.append(pop_and_apply_op())
+
+            ops.append(token.op)
+
+    while ops:
+        values.append(pop_and_apply_op())
+
+    return values[-1]
+
+
+def compile_ast(apps, schema_editor):
+    DynamicFilterExpr = apps.get_model('dynfilters', 'DynamicFilterExpr')
+    DynamicFilterTerm = apps.get_model('dynfilters', 'DynamicFilterTerm')
+
+    for expr in DynamicFilterExpr.objects.all():
+        terms = DynamicFilterTerm.objects.filter(filter=expr).order_by('order')
+        expr.ast = compile_terms(normalize(terms, DynamicFilterTerm))
+        expr.save(update_fields=['ast'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dynfilters', '0008_dynamicfilterexpr_ast'),
+    ]
+
+    operations = [
+        migrations.RunPython(compile_ast, migrations.RunPython.noop),
+    ]
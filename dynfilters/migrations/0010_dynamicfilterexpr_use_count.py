@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dynfilters', '0009_compile_dynamicfilterexpr_ast'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dynamicfilterexpr',
+            name='use_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:47
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dynfilters', '0010_dynamicfilterexpr_use_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DynamicFilterSlowLog',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=128)),
+                ('model', models.CharField(max_length=64)),
+                ('term_count', models.PositiveIntegerField()),
+                ('load_ms', models.FloatField(default=0)),
+                ('normalize_ms', models.FloatField(default=0)),
+                ('compile_ms', models.FloatField(default=0)),
+                ('execute_ms', models.FloatField(default=0)),
+                ('total_ms', models.FloatField(db_index=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('filter', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='dynfilters.dynamicfilterexpr')),
+            ],
+            options={
+                'verbose_name': 'Slow filter',
+                'verbose_name_plural': 'Slow filters',
+                'ordering': ('-created_at',),
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dynfilters', '0011_dynamicfilterslowlog'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dynamicfilterterm',
+            name='typed_value',
+            field=models.JSONField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,268 @@
+import datetime
+import decimal
+import uuid
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db import migrations, models
+from django.utils import timezone
+
+
+# Frozen copies of the value parsing and of the compiler at the time of
+# this migration, so that later changes to dynfilters.values and
+# dynfilters.compiler do not change what it does.
+
+DATE_INPUT_FORMATS = ('%d/%m/%Y', '%Y-%m-%d')
+
+BOOLEAN_LOOKUPS = {
+    'isnull': True,
+    'istrue': True,
+    'isnotnull': False,
+    'isfalse': False,
+}
+
+TEXT_LOOKUPS = ('icontains', 'istartswith', 'iendswith')
+
+DATE_PART_LOOKUPS = ('year', 'month', 'day')
+
+
+# Historical model of the filter, or None if it is gone.
+def get_model_obj(apps, qmodel_name):
+    try:
+        return apps.get_model(*qmodel_name.split('.'))
+    except (LookupError, ValueError):
+        return None
+
+
+def get_model_field(model, path):
+    opts = model._meta
+    f = None
+
+    for name in path.split('__'):
+        if f is not None:
+            if not f.is_relation or f.related_model is None:
+                return None
+
+            opts = f.related_model._meta
+
+        try:
+            f = opts.get_field(name)
+        except FieldDoesNotExist:
+            return None
+
+    if f.is_relation and not f.concrete:
+        return None # reverse relation, compared by pk
+
+    return f
+
+
+def get_compared_field(model_field):
+    if isinstance(model_field, models.ForeignObject):
+        return model_field.target_field
+
+    if model_field.is_relation:
+        return model_field.related_model._meta.pk
+
+    return model_field
+
+
+def parse_date(value):
+    for fmt in DATE_INPUT_FORMATS:
+        try:
+            return datetime.datetime.strptime(value.strip(), fmt).date()
+        except ValueError:
+            pass
+
+    raise ValidationError('Should be "DD/MM/YYYY"')
+
+
+def as_json(value):
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+
+    if isinstance(value, (decimal.Decimal, uuid.UUID)):
+        return str(value)
+
+    return value
+
+
+def parse_scalar(model_field, value):
+    if model_field is None:
+        return value
+
+    model_field = get_compared_field(model_field)
+
+    if isinstance(model_field, models.DateField): # and DateTimeField
+        return as_json(parse_date(value))
+
+    return as_json(model_field.to_python(value))
+
+
+def parse_value(model_field, lookup, value):
+    if lookup in BOOLEAN_LOOKUPS:
+        return BOOLEAN_LOOKUPS[lookup]
+
+    if value is None:
+        return None
+
+    if lookup in TEXT_LOOKUPS:
+        return value
+
+    if lookup in DATE_PART_LOOKUPS:
+        try:
+            return int(value)
+        except ValueError:
+            raise ValidationError('Should be a number')
+
+    if lookup == 'in':
+        return [parse_scalar(model_field, v.strip()) for v in value.split(',')]
+
+    if lookup == 'range':
+        values = value.split(',')
+
+        if len(values) != 2:
+            raise ValidationError('Should be two values separated by a comma')
+
+        return [parse_scalar(model_field, v.strip()) for v in values]
+
+    return parse_scalar(model_field, value)
+
+
+# Make implicit operators explicit, to ensure the ops stack is never empty.
+def normalize(terms, term_class):
+    nterms = []
+    prev = None
+
+    for item in terms:
+        if prev:
+            # Add implicit ANDs.
+            if prev.op in ('-', '!', ')') and item.op in ('-', '!', '('):
+                nterms.append(term_class(op='&'))
+
+            # Add no-ops.
+            elif prev.op in ('(', '&', '|') and item.op in (')', '&', '|'):
+                nterms.append(term_class(op=' '))
+
+        nterms.append(item)
+        prev = item
+
+    if not nterms:
+        # Add no-op to avoid an empty filter.
+        nterms.append(term_class(op=' '))
+
+    return nterms
+
+
+# Terms with their parsed values. Terms on several fields are expanded,
+# since each field has its own parsed value: NOT(a OR b) == NOT a AND NOT b.
+def as_node(term):
+    nodes = [
+        [
+            term.op,
+            field,
+            term.lookup,
+            (term.typed_value or {}).get(field, parse_value(None, term.lookup, term.value)),
+        ]
+        for field in (term.field.split('|') if term.field else [term.field])
+    ]
+
+    if len(nodes) == 1:
+        return nodes[0]
+
+    return ['|' if term.op == '-' else '&', *nodes]
+
+
+def apply_node(op, a=None, b=None):
+    if op == ' ':
+        return []
+
+    return [op, a, b]
+
+
+# Shunting-yard evaluation of the normalized terms into an AST.
+def compile_terms(tokens):
+    def precedence(op):
+        if op == ' ': return 3 # no-op
+        if op == '&': return 2 # AND
+        if op == '|': return 1 # OR
+        return 0
+
+    def pop_and_apply_op():
+        op = ops.pop()
+
+        if op == ' ':
+            return apply_node(op)
+
+        b = values.pop()
+        a = values.pop()
+
+        return apply_node(op, a, b)
+
+    values = []
+    ops = []
+
+    for token in tokens:
+        if token.op == '(':
+            ops.append(token.op)
+
+        elif token.op in ('-', '!'):
+            values.append(as_node(token))
+
+        elif token.op == ')':
+            while ops and ops[-1] != '(':
+                values.append(pop_and_apply_op())
+
+            ops.pop()
+
+        else:
+            while ops and precedence(ops[-1]) >= precedence(token.op):
+                values.append(pop_and_apply_op())
+
+            ops.append(token.op)
+
+    while ops:
+        values.append(pop_and_apply_op())
+
+    return values[-1]
+
+
+def parse_typed_values(apps, schema_editor):
+    DynamicFilterExpr = apps.get_model('dynfilters', 'DynamicFilterExpr')
+    DynamicFilterTerm = apps.get_model('dynfilters', 'DynamicFilterTerm')
+
+    for expr in DynamicFilterExpr.objects.all():
+        model_obj = get_model_obj(apps, expr.model)
+
+        for term in DynamicFilterTerm.objects.filter(filter=expr, op__in=('-', '!')):
+            if not term.field:
+                continue
+
+            try:
+                term.typed_value = {
+                    field: parse_value(
+                        get_model_field(model_obj, field) if model_obj else None,
+                        term.lookup,
+                        term.value,
+                    )
+                    for field in term.field.split('|')
+                }
+            except (ValidationError, ValueError):
+                term.typed_value = None # evaluated as strings
+
+            term.save(update_fields=['typed_value'])
+
+        # Compile the AST again, with the parsed values.
+        terms = DynamicFilterTerm.objects.filter(filter=expr).order_by('order')
+        expr.ast = compile_terms(normalize(terms, DynamicFilterTerm))
+        expr.updated_at = timezone.now()
+        expr.save(update_fields=['ast', 'updated_at'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dynfilters', '0012_dynamicfilterterm_typed_value'),
+    ]
+
+    operations = [
+        migrations.RunPython(parse_typed_values, migrations.RunPython.noop),
+    ]
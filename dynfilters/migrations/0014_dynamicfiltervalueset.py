@@ -0,0 +1,48 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:54
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dynfilters', '0013_parse_dynamicfilterterm_typed_value'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DynamicFilterValueSet',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Value set',
+                'verbose_name_plural': 'Value sets',
+            },
+        ),
+        migrations.AlterField(
+            model_name='dynamicfilterterm',
+            name='lookup',
+            field=models.CharField(choices=[('-', '---------'), ('=', 'Equals'), ('icontains', 'Contains'), ('istartswith', 'Starts with'), ('iendswith', 'Ends with'), ('in', 'One of'), ('inset', 'One of (list)'), ('-', '---------'), ('range', 'Date Range'), ('year', 'Date Year'), ('month', 'Date Month'), ('day', 'Date Day'), ('-', '---------'), ('isnull', 'Is NULL'), ('isnotnull', 'Is not NULL'), ('istrue', 'Is TRUE'), ('isfalse', 'Is FALSE'), ('-', '---------'), ('lt', 'Less Than'), ('gt', 'Greater Than'), ('lte', 'Less Than or Equal To'), ('gte', 'Greater Than or Equal To')], default='-', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='dynamicfilterterm',
+            name='value_set',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to='dynfilters.dynamicfiltervalueset'),
+        ),
+        migrations.CreateModel(
+            name='DynamicFilterValue',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.CharField(max_length=255)),
+                ('value_set', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='dynfilters.dynamicfiltervalueset')),
+            ],
+            options={
+                'verbose_name': 'Value',
+                'verbose_name_plural': 'Values',
+                'indexes': [models.Index(fields=['value_set', 'value'], name='dynfilters__value_s_aceef1_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:57
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dynfilters', '0014_dynamicfiltervalueset'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dynamicfilterexpr',
+            name='materialized',
+            field=models.BooleanField(default=False, help_text='Store the matching rows, and refresh them periodically.', verbose_name='Materialize?'),
+        ),
+        migrations.AddField(
+            model_name='dynamicfilterexpr',
+            name='refreshed_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='dynamicfilterexpr',
+            name='refreshed_version',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='dynamicfilterexpr',
+            name='refreshed_watermark',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.CreateModel(
+            name='DynamicFilterResult',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.CharField(max_length=64)),
+                ('filter', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='dynfilters.dynamicfilterexpr')),
+            ],
+            options={
+                'verbose_name': 'Result',
+                'verbose_name_plural': 'Results',
+                'unique_together': {('filter', 'object_id')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dynfilters', '0015_dynamicfilterresult'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='dynamicfilterterm',
+            name='op',
+            field=models.CharField(choices=[('-', '-'), ('!', 'NOT'), ('&', 'AND'), ('|', 'OR'), ('(', '('), (')', ')'), ('@', 'FILTER')], default='-', max_length=1),
+        ),
+    ]
@@ -1,5 +1,13 @@
+from functools import lru_cache
+from types import MappingProxyType
+
 from django.apps import apps
 from django.contrib import admin
+from django.core.exceptions import FieldDoesNotExist
+from django.db import router
+
+from .conf import get_setting
+from .utils import flatten
 
 
 def get_model_name(opts):
@@ -28,23 +36,55 @@ def get_model_obj(qmodel_name):
 
 def get_model_admin(obj):
     model_obj = get_model_obj(obj.model)
-    return admin.site._registry.get(model_obj)
+    return get_model_admins().get(model_obj)
+
+# All the admin sites, the default one first.
+def get_admin_sites():
+    return [admin.site, *[site for site in admin.sites.all_sites if site is not admin.site]]
+
+# ModelAdmins of every admin site, by model. Those with dynamic filters
+# take precedence when a model is registered on several sites. Built on
+# first use, once the admin modules have been autodiscovered; see
+# clear_model_registry() for models registered later on. The cached
+# results are read-only, since they are shared by every caller.
+@lru_cache(maxsize=None)
+def get_model_admins():
+    model_admins = {}
+
+    for site in get_admin_sites():
+        for model_obj, model_admin in site._registry.items():
+            if hasattr(model_admin, 'dynfilters_fields'):
+                model_admins.setdefault(model_obj, model_admin)
+
+    for site in get_admin_sites():
+        for model_obj, model_admin in site._registry.items():
+            model_admins.setdefault(model_obj, model_admin)
 
+    return MappingProxyType(model_admins)
+
+@lru_cache(maxsize=None)
 def get_model_choices():
-    return [
+    return tuple(
         (
             get_qualified_model_name(opts),
             get_model_name(opts)
         )
         for model_obj in apps.get_models()
         if has_dynfilter(model_obj, (opts := model_obj._meta))
-    ]
+    )
+
+def clear_model_registry():
+    get_model_admins.cache_clear()
+    get_model_choices.cache_clear()
+    get_dynfilters_fields.cache_clear()
+    get_relation_plan.cache_clear()
 
 
 def has_dynfilter(model_obj, opts):
-    model_admin = admin.site._registry.get(model_obj)
+    model_admin = get_model_admins().get(model_obj)
     return hasattr(model_admin, 'dynfilters_fields') and not opts.proxy
 
+@lru_cache(maxsize=None)
 def get_dynfilters_fields(model_admin):
     def humanize(f):
         if f == '-':
@@ -62,10 +102,161 @@ def get_dynfilters_fields(model_admin):
         return f
 
     fields = getattr(model_admin, 'dynfilters_fields', [])
-    return [humanize(f) for f in fields]
+    return tuple(humanize(f) for f in fields)
 
 def get_dynfilters_select_related(model_admin):
     return getattr(model_admin, 'dynfilters_select_related', [])
 
 def get_dynfilters_prefetch_related(model_admin):
     return getattr(model_admin, 'dynfilters_prefetch_related', [])
+
+def get_dynfilters_multivalued(model_admin):
+    return getattr(model_admin, 'dynfilters_multivalued', 'exists')
+
+# Field holding the last modification time of the rows, used to
+# refresh materialized filters incrementally.
+def get_dynfilters_watermark(model_admin):
+    return getattr(model_admin, 'dynfilters_watermark', 'updated_at')
+
+# Database used to evaluate the filter 'obj', or the filters of 'model_admin'.
+def get_dynfilters_using(model_admin, obj=None):
+    using = getattr(model_admin, 'dynfilters_using', None) or get_setting('DATABASE')
+
+    if using:
+        return using
+
+    model_obj = get_model_obj(obj.model) if obj else model_admin.model
+    return router.db_for_read(model_obj, dynfilter=obj)
+
+# Longest chain of single-valued relations along a field path,
+# which can be followed with select_related().
+def get_select_related_path(opts, field):
+    path = []
+
+    for name in field.split('__'):
+        try:
+            f = opts.get_field(name)
+        except FieldDoesNotExist:
+            break
+
+        if not (f.is_relation and (f.many_to_one or f.one_to_one)):
+            break
+
+        path.append(name)
+        opts = f.related_model._meta
+
+    return '__'.join(path)
+
+def get_path_prefixes(path):
+    parts = path.split('__')
+    return ['__'.join(parts[:i + 1]) for i in range(len(parts))]
+
+# Whether 'name' is a concrete field, possibly across forward
+# single-valued relations.
+def is_model_field(opts, name):
+    if not isinstance(name, str):
+        return False # callable
+
+    parts = name.split('__')
+
+    for i, part in enumerate(parts):
+        try:
+            f = opts.get_field(part)
+        except FieldDoesNotExist:
+            return False
+
+        if not f.concrete or f.many_to_many:
+            return False
+
+        if i < len(parts) - 1:
+            if not f.is_relation:
+                return False
+
+            opts = f.related_model._meta
+
+    return True
+
+# Fields to load with only() for the changelist, which renders the
+# fields of list_display, along with the relations to follow. Returns 
+# None if the changelist displays values which cannot be traced back to
+# fields (callables, __str__...), unless the ModelAdmin lists the fields
+# they use in dynfilters_only_fields.
+def get_projection(model_admin, request, select_related):
+    opts = model_admin.model._meta
+
+    admin_fields = [
+        *model_admin.get_list_display(request),
+        *(model_admin.get_list_display_links(request, model_admin.get_list_display(request)) or []),
+        *model_admin.list_editable,
+    ]
+
+    if model_admin.date_hierarchy:
+        admin_fields.append(model_admin.date_hierarchy)
+
+    only_fields = getattr(model_admin, 'dynfilters_only_fields', None)
+
+    if only_fields is None:
+        if not all(is_model_field(opts, f) for f in admin_fields):
+            return None
+
+        only_fields = []
+
+    fields = [opts.pk.name, *only_fields]
+    related = set()
+
+    for f in admin_fields:
+        if not is_model_field(opts, f):
+            continue
+
+        if path := get_select_related_path(opts, f):
+            related.add(path)
+
+        # Related objects displayed by the admin are loaded entirely.
+        if any(p in admin_fields for p in get_path_prefixes(f)[:-1]):
+            continue
+
+        fields.append(f)
+
+    # Relations followed by select_related() cannot be deferred.
+    list_select_related = model_admin.list_select_related
+    if isinstance(list_select_related, (list, tuple)):
+        related.update(list_select_related)
+
+    for path in related | set(select_related):
+        fields.extend(get_path_prefixes(path))
+
+    return list(dict.fromkeys(fields)), related
+
+# The relation plan only depends on the ModelAdmin, compute it once.
+@lru_cache(maxsize=None)
+def get_relation_plan(model_admin):
+    fields = list(flatten([
+        f.split('|')
+        for f, display in get_dynfilters_fields(model_admin)
+        if f != '-'
+    ]))
+
+    elementary_fields = set(flatten([f.split('__') for f in fields]))
+
+    paths = {}
+    if model_admin is not None:
+        for f in fields:
+            if path := get_select_related_path(model_admin.model._meta, f):
+                paths[f] = path
+
+    return MappingProxyType({
+        # Relations declared by hand
+        'select_related': tuple(
+            f 
+            for f in get_dynfilters_select_related(model_admin)
+            if f in elementary_fields
+        ),
+        'prefetch_related': tuple(
+            f 
+            for f in get_dynfilters_prefetch_related(model_admin)
+            if f in elementary_fields
+        ),
+
+        # Relations derived from each field
+        'paths': MappingProxyType(paths),
+    })
@@ -1,23 +1,53 @@
+from contextvars import ContextVar
 from functools import reduce
 from operator import or_
 
 from django.apps import apps
 from django.contrib.auth.models import User
-from django.db import connection
+from django.core.cache import caches
+from django.core.exceptions import ValidationError
+from django.db import connections
 from django.db import models
-from django.db.models import Q
+from django.db.models import F, Q
 from django.db.models.deletion import CASCADE, SET_NULL
+from django.db.models.functions import Cast
 from django.db.models.sql.compiler import SQLCompiler
 from django.db.models.sql.query import Query
 from django.utils.translation import gettext_lazy as _
 
-from . import shunting_yard
-from .model_helpers import get_model_obj
-from .utils import (
-    previous,
-    str_as_date, 
-    str_as_date_range, 
+from . import compiler, evaluator, optimizer, values
+from .cache import compiled_filters
+from .conf import get_setting
+from .model_helpers import (
+    get_model_admin,
+    get_model_obj,
+    get_dynfilters_multivalued,
+    get_dynfilters_using,
 )
+from .utils import timer
+
+
+# Filters being compiled, to detect circular references.
+resolving = ContextVar('dynfilters_resolving', default=())
+
+
+def get_use_count_key(pk):
+    return f'dynfilters:uses:{pk}'
+
+def get_column_fields(columns):
+    return [
+        field
+        for column in columns
+        if column.field and column.field != '-'
+        for field in column.field.split('|')
+    ]
+
+def get_sort_order_fields(sort_orders):
+    return [
+        sort_order.field
+        for sort_order in sort_orders
+        if sort_order.field and sort_order.field != '-'
+    ]
 
 
 class DynamicFilterExpr(models.Model):
@@ -29,44 +59,319 @@ class DynamicFilterExpr(models.Model):
     model = models.CharField(max_length=64, db_index=True)
     user = models.ForeignKey(User, on_delete=models.CASCADE, db_index=True)
     is_global = models.BooleanField('Global?', default=False, db_index=True, help_text='Make filter accessible to all.')
+    updated_at = models.DateTimeField(auto_now=True)
+    version = models.PositiveBigIntegerField(default=0, editable=False)
+    ast = models.JSONField(blank=True, null=True, editable=False)
+    use_count = models.PositiveIntegerField(default=0, editable=False)
+
+    # Materialized results, see materialize.py
+    materialized = models.BooleanField('Materialize?', default=False, help_text='Store the matching rows, and refresh them periodically.')
+    refreshed_at = models.DateTimeField(blank=True, null=True, editable=False)
+    refreshed_version = models.BigIntegerField(blank=True, null=True, editable=False)
+    refreshed_watermark = models.DateTimeField(blank=True, null=True, editable=False)
 
     def __str__(self):
         return self.name
 
-    # Make implicit operators explicit, to ensure the ops stack is never empty.
-    def normalized_terms(self):
-        nterms = []
+    # The version changes whenever the filter or one of its terms is
+    # saved. It is incremented by the database, so that concurrent edits
+    # never end up with the same version.
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+
+        if self._state.adding or (update_fields is not None and 'version' not in update_fields):
+            return super().save(*args, **kwargs)
+
+        self.version = F('version') + 1
+        super().save(*args, **kwargs)
+        self.refresh_from_db(fields=['version'])
+
+    # Runs of the filter are counted in a cache, and added to use_count
+    # by flush_use_counts(), so that running a filter writes nothing.
+    def count_use(self):
+        cache = caches[get_setting('USE_COUNT_CACHE')]
+        key = get_use_count_key(self.pk)
+
+        if not cache.add(key, 1, None):
+            try:
+                cache.incr(key)
+            except ValueError:
+                pass # evicted meanwhile, the count is approximate
 
-        for prev, item in previous(self.dynamicfilterterm_set.all()):
-            if prev:
-                # Add implicit ANDs.
-                if prev.op in ('-', '!', ')') and item.op in ('-', '!', '('):
-                    nterms.append(DynamicFilterTerm(op='&'))
+    @classmethod
+    def flush_use_counts(cls, batch_size=1000):
+        cache = caches[get_setting('USE_COUNT_CACHE')]
+        pks = list(cls.objects.values_list('pk', flat=True))
 
-                # Add no-ops.
-                elif prev.op in ('(', '&', '|') and item.op in (')', '&', '|'):
-                    nterms.append(DynamicFilterTerm(op=' '))
+        for i in range(0, len(pks), batch_size):
+            keys = {get_use_count_key(pk): pk for pk in pks[i:i + batch_size]}
 
-            nterms.append(item)
+            for key, count in cache.get_many(keys).items():
+                if not count:
+                    continue
 
-        if not nterms:
-            # Add no-op to avoid an empty filter.
-            nterms.append(DynamicFilterTerm(op=' '))
+                cls.objects.filter(pk=keys[key]).update(use_count=F('use_count') + count)
 
-        return nterms
+                # Runs counted since are kept.
+                try:
+                    cache.decr(key, count)
+                except ValueError:
+                    pass # evicted meanwhile, the runs counted since are lost
 
-    def as_q(self):
-        terms = self.normalized_terms()
-        return shunting_yard.evaluate(terms)
+    # Make implicit operators explicit, to ensure the ops stack is never empty.
+    def normalized_terms(self):
+        return compiler.normalize(self.dynamicfilterterm_set.all(), DynamicFilterTerm)
+
+    # Compile the terms into an optimized AST, which is stored with the filter.
+    def compile(self):
+        self.ast = optimizer.optimize(compiler.compile_terms(self.normalized_terms()))
+        return self.ast
+
+    # The stored AST, or a freshly compiled one if the terms changed since,
+    # which is stored in turn.
+    def get_ast(self, timings=None):
+        if self.ast is not None:
+            return self.ast
+
+        with timer(timings, 'load'):
+            terms = list(self.dynamicfilterterm_set.all())
+
+        self.ast = self.compile_loaded_terms(terms, timings)
+        self.stored_ast_queryset().update(ast=self.ast)
+
+        return self.ast
+
+    # The async variants of the methods below load the filter, its terms 
+    # and references with the async ORM API, the rest is shared.
+    async def aget_ast(self, timings=None):
+        if self.ast is not None:
+            return self.ast
+
+        with timer(timings, 'load'):
+            terms = [term async for term in self.dynamicfilterterm_set.all()]
+
+        self.ast = self.compile_loaded_terms(terms, timings)
+        await self.stored_ast_queryset().aupdate(ast=self.ast)
+
+        return self.ast
+
+    # The filter, unless its terms changed since it was loaded. It is
+    # updated without signals, since storing the AST changes nothing.
+    def stored_ast_queryset(self):
+        return DynamicFilterExpr.objects.filter(pk=self.pk, version=self.version, ast__isnull=True)
+
+    def compile_loaded_terms(self, terms, timings=None):
+        with timer(timings, 'normalize'):
+            nterms = compiler.normalize(terms, DynamicFilterTerm)
+
+        with timer(timings, 'compile'):
+            return optimizer.optimize(compiler.compile_terms(nterms))
 
-    def as_sql(self):
+    # Field paths used by the terms.
+    def used_fields(self):
+        return set(compiler.node_fields(self.get_ast()))
+
+    # The time spent in each phase is added to 'timings', if given.
+    def as_q(self, timings=None):
+        model_obj, multivalued = self.get_compile_options()
+        ast = self.get_ast(timings)
+
+        def resolve(pk):
+            return self.resolve_reference(pk, model_obj, timings)
+
+        return self.compile_ast(ast, model_obj, multivalued, resolve, timings)
+
+    # References are resolved before compiling, since node_as_q() cannot
+    # await.
+    async def aas_q(self, timings=None):
+        model_obj, multivalued = self.get_compile_options()
+        ast = await self.aget_ast(timings)
+
+        token = resolving.set((*resolving.get(), self.pk))
+        try:
+            references = {
+                pk: await self.aresolve_reference(pk, model_obj, timings)
+                for pk in set(compiler.node_references(ast))
+            }
+        finally:
+            resolving.reset(token)
+
+        return self.compile_ast(ast, model_obj, multivalued, references.__getitem__, timings)
+
+    # Model the filter is compiled for, and how multi-valued relations
+    # are looked up.
+    def get_compile_options(self):
+        try:
+            return get_model_obj(self.model), get_dynfilters_multivalued(get_model_admin(self))
+        except (LookupError, ValueError):
+            return None, 'join' # model is gone
+
+    def compile_ast(self, ast, model_obj, multivalued, resolve, timings=None):
+        token = resolving.set((*resolving.get(), self.pk))
+        try:
+            with timer(timings, 'compile'):
+                return compiler.node_as_q(ast, model_obj, multivalued, resolve)
+        finally:
+            resolving.reset(token)
+
+    # Q of the filter 'pk', referenced by this one. Referenced filters are
+    # compiled through the compiled cache, so that filters sharing them
+    # do not compile them again. Materialized ones are looked up.
+    def resolve_reference(self, pk, model_obj, timings=None):
+        self.check_reference(pk)
+
+        try:
+            ref = DynamicFilterExpr.objects.get(pk=pk)
+        except DynamicFilterExpr.DoesNotExist:
+            raise ValueError('A referenced filter no longer exists.')
+
+        q = self.get_reference_results(ref, model_obj)
+        if q is not None:
+            return q
+
+        return compiled_filters.get(ref, timings)
+
+    async def aresolve_reference(self, pk, model_obj, timings=None):
+        self.check_reference(pk)
+
+        try:
+            ref = await DynamicFilterExpr.objects.aget(pk=pk)
+        except DynamicFilterExpr.DoesNotExist:
+            raise ValueError('A referenced filter no longer exists.')
+
+        q = self.get_reference_results(ref, model_obj)
+        if q is not None:
+            return q
+
+        return await compiled_filters.aget(ref, timings)
+
+    def check_reference(self, pk):
+        if pk in resolving.get():
+            raise ValueError('The filter references itself.')
+
+    # Q of the stored results of 'ref', if it is materialized and fresh.
+    def get_reference_results(self, ref, model_obj):
+        from . import materialize
+
+        if ref.model != self.model:
+            raise ValueError('A referenced filter is on another model.')
+
+        if materialize.is_fresh(ref) and model_obj is not None:
+            using = get_dynfilters_using(get_model_admin(self), self)
+            results = materialize.get_results_subquery(ref, model_obj._default_manager.db_manager(using).all())
+
+            if results is not None:
+                return Q(pk__in=results)
+
+        return None
+
+    # Bitmaps of the rows of 'queryset' matched by each of 'exprs', 
+    # evaluated in a single query, see bitmaps.py
+    @classmethod
+    def as_bitmaps(cls, exprs, queryset):
+        from .bitmaps import as_bitmaps
+        return as_bitmaps(exprs, queryset)
+
+    # Number of rows of 'queryset' matched by the filter.
+    async def acount(self, queryset):
+        return await queryset.filter(await compiled_filters.aget(self)).acount()
+
+    # Python predicate of the filter, for objects or dicts in memory.
+    def as_predicate(self):
+        return evaluator.node_as_predicate(self.get_resolved_ast())
+
+    # Same, in batch mode, over columns of values.
+    def as_mask(self):
+        return evaluator.node_as_mask(self.get_resolved_ast())
+
+    # The AST with its references replaced by the ASTs they refer to.
+    def get_resolved_ast(self):
+        token = resolving.set((*resolving.get(), self.pk))
+        try:
+            return compiler.node_expand(self.get_ast(), self.get_ast_resolver())
+        finally:
+            resolving.reset(token)
+
+    # Function returning the AST of a referenced filter, given its id,
+    # with its own references replaced. Circular references are detected
+    # as in as_q().
+    def get_ast_resolver(self):
+        asts = {}
+
+        def resolve(pk):
+            if pk in resolving.get():
+                raise ValueError('The filter references itself.')
+
+            if pk not in asts:
+                try:
+                    ast = DynamicFilterExpr.objects.get(pk=pk).get_ast()
+                except DynamicFilterExpr.DoesNotExist:
+                    raise ValueError('A referenced filter no longer exists.')
+
+                token = resolving.set((*resolving.get(), pk))
+                try:
+                    asts[pk] = compiler.node_expand(ast, resolve)
+                finally:
+                    resolving.reset(token)
+
+            return asts[pk]
+
+        return resolve
+
+    # Ids of the filters referenced by this one, directly or not.
+    def get_references(self):
+        references, pks = set(), {self.pk}
+
+        while pks:
+            values = (
+                DynamicFilterTerm.objects
+                    .filter(filter__in=pks, op='@')
+                    .values_list('value', flat=True)
+            )
+            pks = {int(v) for v in values if v and v.isdigit()} - references
+            references |= pks
+
+        return references
+
+    # Ids of the filters referencing this one, directly or not.
+    def get_dependents(self):
+        dependents, pks = set(), {self.pk}
+
+        while pks:
+            pks = set(
+                DynamicFilterTerm.objects
+                    .filter(op='@', value__in=[str(pk) for pk in pks])
+                    .values_list('filter', flat=True)
+            ) - dependents
+            dependents |= pks
+
+        return dependents
+
+    # Field paths of the display columns.
+    def get_columns(self):
+        return get_column_fields(self.dynamicfiltercolumn_set.all())
+
+    async def aget_columns(self):
+        return get_column_fields([column async for column in self.dynamicfiltercolumn_set.all()])
+
+    # Orderings of the sort orders, descending if prefixed with '-'.
+    def get_ordering(self):
+        return get_sort_order_fields(self.dynamicfiltercolumnsortorder_set.all())
+
+    async def aget_ordering(self):
+        return get_sort_order_fields([sort_order async for sort_order in self.dynamicfiltercolumnsortorder_set.all()])
+
+    def as_sql(self, using=None):
         model_obj = get_model_obj(self.model)
         query = Query(model_obj)
 
+        if using is None:
+            using = get_dynfilters_using(get_model_admin(self), self)
+
         where = self.as_q().resolve_expression(query)
         
-        compiler = query.get_compiler(using='default')
-        query_str, args = where.as_sql(compiler, connection)
+        compiler = query.get_compiler(using=using)
+        query_str, args = where.as_sql(compiler, connections[using])
 
         return query_str % tuple(args)
 
@@ -79,6 +384,7 @@ class DynamicFilterTerm(models.Model):
         ('|', 'OR'),
         ('(', '('),
         (')', ')'),
+        ('@', 'FILTER'),
     ]
 
     LOOKUP_CHOICES = [
@@ -88,6 +394,7 @@ class DynamicFilterTerm(models.Model):
         ('istartswith', 'Starts with'),
         ('iendswith', 'Ends with'),
         ('in', 'One of'),
+        ('inset', 'One of (list)'),
         ('-', '---------'),
         ('range', 'Date Range'),
         ('year', 'Date Year'),
@@ -115,9 +422,19 @@ class DynamicFilterTerm(models.Model):
     field = models.CharField(max_length=64, blank=True, null=True)
     lookup = models.CharField(max_length=16, choices=LOOKUP_CHOICES, default='-')
     value = models.CharField(max_length=100, blank=True, null=True)
+    typed_value = models.JSONField(blank=True, null=True, editable=False)
+    value_set = models.ForeignKey('DynamicFilterValueSet', on_delete=SET_NULL, blank=True, null=True, editable=False)
     bilateral = models.BooleanField(default=False)
     order = models.PositiveSmallIntegerField(default=0, blank=True, db_index=True)
 
+    # The value set referenced in the database is kept, so that it can be
+    # released once the term references another one.
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.loaded_value_set_id = instance.__dict__.get('value_set_id')
+        return instance
+
     @property
     def fields(self):
         return self.field.split('|')
@@ -130,7 +447,7 @@ class DynamicFilterTerm(models.Model):
 
         if self.op in ('-', '!'):
             expr = ' OR '.join([
-                f'{self.get_keypath(field)} {get_operator()} {self.get_value()}'
+                f'{self.get_keypath(field)} {get_operator()} {self.get_value(field)}'
                 for field in self.fields
             ])
 
@@ -139,6 +456,9 @@ class DynamicFilterTerm(models.Model):
 
             return expr
 
+        if self.op == '@':
+            return f'FILTER({self.value})'
+
         return self.op
 
     def clean(self):
@@ -153,6 +473,75 @@ class DynamicFilterTerm(models.Model):
             if self.lookup in ('isnull', 'isnotnull', 'istrue', 'isfalse'):
                 self.value = None
 
+            if self.field not in (None, '-') and self.lookup != '-':
+                self.clean_value()
+
+        elif self.op == '@':
+            # The value is the id of the referenced filter
+            self.field = '-'
+            self.lookup = '-'
+            self.clean_reference()
+
+    def clean_reference(self):
+        try:
+            ref = DynamicFilterExpr.objects.get(pk=int(self.value))
+        except (TypeError, ValueError, DynamicFilterExpr.DoesNotExist):
+            raise ValidationError({'value': 'Should be the id of an existing filter'})
+
+        expr = getattr(self, 'filter', None)
+        if expr is None:
+            return
+
+        if ref.model != expr.model:
+            raise ValidationError({'value': 'Should be a filter on the same model'})
+
+        if expr.pk is not None and (ref.pk == expr.pk or expr.pk in ref.get_references()):
+            raise ValidationError({'value': 'The referenced filter refers to this one'})
+
+    def clean_value(self):
+        try:
+            self.typed_value = self.parse_values()
+        except (ValidationError, ValueError) as e:
+            raise ValidationError({'value': getattr(e, 'messages', str(e))})
+
+    # Invalid values are not saved, they would not match as expected.
+    def save(self, *args, **kwargs):
+        if self.lookup != 'inset':
+            self.value_set = None
+
+        self.clean_value()
+
+        return super().save(*args, **kwargs)
+
+    def get_model_field(self, field):
+        expr = getattr(self, 'filter', None)
+
+        try:
+            model_obj = get_model_obj(expr.model)
+        except (AttributeError, LookupError, ValueError):
+            return None
+
+        return values.get_model_field(model_obj, field)
+
+    # Values of the term, parsed for each of its fields.
+    def parse_values(self):
+        if self.op not in ('-', '!') or not self.field:
+            return None
+
+        if self.lookup == 'inset':
+            return {
+                field: {
+                    'value_set': self.value_set_id,
+                    'cast': values.get_cast_type(self.get_model_field(field)),
+                }
+                for field in self.fields
+            }
+
+        return {
+            field: values.parse_value(self.get_model_field(field), self.lookup, self.value)
+            for field in self.fields
+        }
+
     def get_keypath(self, field):
         if self.lookup in ('=', 'istrue', 'isfalse'):
             return field
@@ -160,32 +549,50 @@ class DynamicFilterTerm(models.Model):
         if self.lookup in ('isnull', 'isnotnull'):
             return f'{field}__isnull'
 
+        if self.lookup == 'inset':
+            return f'{field}__in'
+
         return f'{field}__{self.lookup}'
 
-    def get_value(self):
-        if self.lookup in ('isnull', 'istrue'):
-            return True
+    # Value of the term for 'field', as stored in the AST.
+    def get_parsed_value(self, field=None):
+        if field is None and self.field:
+            field = self.fields[0]
 
-        if self.lookup in ('isnotnull', 'isfalse'):
-            return False
+        if self.typed_value is not None and field in self.typed_value:
+            return self.typed_value[field]
 
-        if self.lookup == 'in':
-            return self.value.split(',')
+        return values.parse_value(None, self.lookup, self.value)
 
-        if self.lookup == 'range':
-            return str_as_date_range(self.value)
+    # Value of the term for 'field', as compared by the database. Fields
+    # are looked up on 'model', or on the model of the filter.
+    def get_value(self, field=None, model=None):
+        value = self.get_parsed_value(field)
 
-        if 'date' in self.field:
-            return str_as_date(self.value)
+        if self.lookup == 'inset' and isinstance(value, dict):
+            if field is None and self.field:
+                field = self.fields[0]
 
-        return self.value
+            if model is not None:
+                model_field = values.get_model_field(model, field)
+            else:
+                model_field = self.get_model_field(field)
+
+            return DynamicFilterValueSet.as_subquery(**value, model_field=model_field)
+
+        return value
+
+    # Lookup of the term on 'field', expressed relative to the 'path' 
+    # it ends with, when given.
+    def get_term(self, field, path=None, model=None):
+        return {self.get_keypath(path or field): self.get_value(field, model)}
 
-    def get_term(self, field):
-        return {self.get_keypath(field): self.get_value()}
+    def as_q(self, model=None):
+        if self.op == '@':
+            return DynamicFilterExpr.objects.get(pk=self.value).as_q()
 
-    def as_q(self):
         q = reduce(or_, [
-            Q(**self.get_term(field))
+            Q(**self.get_term(field, model=model))
             for field in self.fields
         ])
 
@@ -195,6 +602,68 @@ class DynamicFilterTerm(models.Model):
         return q
 
 
+# Values of the 'One of (list)' terms. Sets are never modified, new
+# values make a new set, so that cloned terms can share them.
+class DynamicFilterValueSet(models.Model):
+    class Meta:
+        verbose_name = 'Value set'
+        verbose_name_plural = 'Value sets'
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'Value set {self.pk}'
+
+    @classmethod
+    def from_values(cls, value_list, batch_size=1000):
+        value_set = cls.objects.create()
+
+        DynamicFilterValue.objects.bulk_create(
+            [DynamicFilterValue(value_set=value_set, value=value) for value in value_list],
+            batch_size=batch_size,
+        )
+
+        return value_set
+
+    # Subquery of the values, cast to the type of the compared field. The
+    # cast field is built from 'model_field' when known, so that it keeps
+    # its parameters, e.g. the digits of a DecimalField.
+    @classmethod
+    def as_subquery(cls, value_set, cast=None, model_field=None):
+        queryset = DynamicFilterValue.objects.filter(value_set_id=value_set)
+
+        if cast:
+            output_field = values.get_cast_field(model_field) if model_field is not None else None
+            if output_field is None:
+                output_field = getattr(models, cast)()
+
+            queryset = queryset.annotate(typed=Cast('value', output_field=output_field))
+            return queryset.values('typed')
+
+        return queryset.values('value')
+
+    # Delete the value set 'pk' if no term references it any longer.
+    @classmethod
+    def release(cls, pk):
+        if pk is not None:
+            cls.objects.filter(pk=pk, dynamicfilterterm=None).delete()
+
+
+class DynamicFilterValue(models.Model):
+    class Meta:
+        verbose_name = 'Value'
+        verbose_name_plural = 'Values'
+        indexes = [
+            models.Index(fields=['value_set', 'value']),
+        ]
+
+    value_set = models.ForeignKey(DynamicFilterValueSet, on_delete=CASCADE)
+    value = models.CharField(max_length=255)
+
+    def __str__(self):
+        return self.value
+
+
 class DynamicFilterColumn(models.Model):
     class Meta:
         ordering = ('order',)
@@ -221,3 +690,38 @@ class DynamicFilterColumnSortOrder(models.Model):
 
     def __str__(self):
         return self.field
+
+
+# Primary keys of the rows matched by a materialized filter, as text.
+class DynamicFilterResult(models.Model):
+    class Meta:
+        verbose_name = 'Result'
+        verbose_name_plural = 'Results'
+        unique_together = [('filter', 'object_id')]
+
+    filter = models.ForeignKey(DynamicFilterExpr, on_delete=CASCADE)
+    object_id = models.CharField(max_length=64)
+
+    def __str__(self):
+        return self.object_id
+
+
+class DynamicFilterSlowLog(models.Model):
+    class Meta:
+        ordering = ('-created_at',)
+        verbose_name = 'Slow filter'
+        verbose_name_plural = 'Slow filters'
+
+    filter = models.ForeignKey(DynamicFilterExpr, on_delete=SET_NULL, blank=True, null=True)
+    name = models.CharField(max_length=128)
+    model = models.CharField(max_length=64)
+    term_count = models.PositiveIntegerField()
+    load_ms = models.FloatField(default=0)
+    normalize_ms = models.FloatField(default=0)
+    compile_ms = models.FloatField(default=0)
+    execute_ms = models.FloatField(default=0)
+    total_ms = models.FloatField(db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return self.name
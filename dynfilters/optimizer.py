@@ -0,0 +1,118 @@
+# Rewrites the AST produced by the compiler into an equivalent, 
+# smaller one. Besides binary nodes, the optimized AST may contain 
+# n-ary nodes, e.g. ['&', a, b, c].
+#
+#   - multi-fields terms are expanded, pushing NOT down (De Morgan),
+#   - nested AND/OR are flattened,
+#   - no-ops are dropped,
+#   - identical predicates are deduplicated,
+#   - 'field = a OR field = b' is folded into 'field in (a, b)',
+#     and 'NOT field = a AND NOT field = b' into 'NOT field in (a, b)'.
+
+import json
+
+
+def is_term(node):
+    return bool(node) and node[0] in ('-', '!')
+
+def expand(node):
+    op, field, lookup, value = node
+    fields = field.split('|') if field else [field]
+
+    if len(fields) == 1:
+        return node
+
+    # NOT(a OR b) == NOT a AND NOT b
+    return [
+        '|' if op == '-' else '&',
+        *[[op, f, lookup, value] for f in fields]
+    ]
+
+def is_foldable(node):
+    op, field, lookup, value = node
+
+    if lookup == 'in':
+        return bool(field) and isinstance(value, list)
+
+    return (
+        lookup == '=' and
+        bool(field) and
+        value is not None and
+        not isinstance(value, (list, dict))
+    )
+
+def as_values(node):
+    return list(node[3]) if node[2] == 'in' else [node[3]]
+
+# Fold '=' and 'in' terms on the same field, with the same polarity,
+# into a single 'in' term. 'polarity' is '-' in ORs, '!' in ANDs.
+def fold(children, polarity):
+    folded = []
+    groups = {}
+
+    for child in children:
+        if is_term(child) and child[0] == polarity and is_foldable(child):
+            field = child[1]
+
+            if field in groups:
+                group = groups[field]
+                values = as_values(group)
+                values += [v for v in as_values(child) if v not in values]
+                group[2] = 'in'
+                group[3] = values
+                continue
+
+            child = list(child)
+            groups[field] = child
+
+        folded.append(child)
+
+    return folded
+
+def dedupe(children):
+    seen = set()
+    deduped = []
+
+    for child in children:
+        key = json.dumps(child)
+
+        if key not in seen:
+            seen.add(key)
+            deduped.append(child)
+
+    return deduped
+
+def optimize(node):
+    if not node:
+        return []
+
+    if node[0] == '@':
+        return node # reference to another filter
+
+    if is_term(node):
+        node = expand(node)
+
+        if is_term(node):
+            return node
+
+    op, *children = node
+
+    flattened = []
+    for child in map(optimize, children):
+        if not child:
+            continue # no-op
+
+        if child[0] == op:
+            flattened.extend(child[1:])
+        else:
+            flattened.append(child)
+
+    children = dedupe(fold(flattened, '-' if op == '|' else '!'))
+
+    if not children:
+        return []
+
+    if len(children) == 1:
+        return children[0]
+
+    return [op, *children]
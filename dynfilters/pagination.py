@@ -0,0 +1,139 @@
+# Keyset (seek) pagination for changelists filtered by a dynamic filter.
+# Pages are fetched with 'WHERE key > last_key ORDER BY key LIMIT n' 
+# rather than with an OFFSET, so that deep pages cost as much as the 
+# first one. The position is kept in the 'cursor' query parameter.
+
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+from django.core.exceptions import FieldError, ValidationError
+from django.core.paginator import Paginator
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, Q
+
+
+CURSOR_VAR = 'cursor'
+
+
+def encode_cursor(values):
+    data = json.dumps(values, cls=DjangoJSONEncoder).encode()
+    return urlsafe_b64encode(data).decode()
+
+# The values of the keys, or None if the cursor was tampered with, in
+# which case pages start over.
+def decode_cursor(cursor):
+    try:
+        values = json.loads(urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        return None
+
+    if not isinstance(values, list) or not all(isinstance(v, (str, int, float, bool, type(None))) for v in values):
+        return None
+
+    return values
+
+
+class KeysetPaginator(Paginator):
+    keyset = True
+
+    # 'ordering' is a list of field paths, descending if prefixed with '-'.
+    def __init__(self, object_list, per_page, ordering=(), cursor=None, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+
+        self.keys = [
+            (f[1:], True) if f.startswith('-') else (f, False)
+            for f in ordering
+        ]
+        self.keys.append(('pk', False)) # tie-breaker
+
+        self.cursor = decode_cursor(cursor) if cursor else None
+        self.next_cursor = None
+
+    def get_order_by(self):
+        # NULLs always come last, whatever the backend.
+        return [
+            F(path).desc(nulls_last=True) if desc else F(path).asc(nulls_last=True)
+            for path, desc in self.keys
+        ]
+
+    # Rows strictly after the cursor, in the order of the keys.
+    def get_seek_q(self, values):
+        seek = Q(pk__in=[])
+        equal = Q()
+
+        for (path, desc), value in zip(self.keys, values):
+            if value is None:
+                # Only NULLs may follow a NULL, and they are all equal.
+                after = Q(pk__in=[])
+                same = Q(**{f'{path}__isnull': True})
+            else:
+                lookup = 'lt' if desc else 'gt'
+                after = Q(**{f'{path}__{lookup}': value}) | Q(**{f'{path}__isnull': True})
+                same = Q(**{path: value})
+
+            seek |= equal & after
+            equal &= same
+
+        return seek
+
+    def page(self, number):
+        number = self.validate_number(number)
+
+        names = [f'_dynfilters_key{i}' for i in range(len(self.keys))]
+
+        try:
+            queryset = (
+                self.object_list
+                    .annotate(**{
+                        name: F(path) 
+                        for name, (path, desc) in zip(names, self.keys)
+                    })
+                    .order_by(*self.get_order_by())
+            )
+
+            if self.cursor and len(self.cursor) == len(self.keys):
+                try:
+                    queryset = queryset.filter(self.get_seek_q(self.cursor))
+                except (TypeError, ValueError, ValidationError):
+                    pass # values of the wrong type, start over
+
+        except FieldError:
+            # Sort orders that are not field paths, e.g. on several fields
+            # ('a|b') or on a field since removed: pages use an OFFSET.
+            self.keyset = False
+            return super().page(number)
+
+        object_list = list(queryset[:self.per_page + 1])
+
+        if len(object_list) > self.per_page:
+            object_list = object_list[:self.per_page]
+            self.next_cursor = encode_cursor([
+                getattr(object_list[-1], name) 
+                for name in names
+            ])
+
+        return self._get_page(object_list, number, self)
+
+
+class KeysetPaginationMixin:
+    """
+    ModelAdmin mixin paginating changelists filtered by a dynamic filter
+    with a KeysetPaginator, ordered by the filter sort orders.
+    """
+
+    change_list_template = 'dynfilters/change_list.html'
+
+    def get_paginator(self, request, queryset, per_page, orphans=0, allow_empty_first_page=True):
+        expr = getattr(request, 'dynfilters_expr', None)
+
+        if expr is None:
+            return super().get_paginator(request, queryset, per_page, orphans, allow_empty_first_page)
+
+        return KeysetPaginator(
+            queryset, 
+            per_page, 
+            ordering=expr.get_ordering(),
+            cursor=getattr(request, 'dynfilters_cursor', None),
+            orphans=orphans, 
+            allow_empty_first_page=allow_empty_first_page,
+        )
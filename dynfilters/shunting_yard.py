@@ -1,9 +1,26 @@
 from django.db.models import Q
 
+
+def as_q(token):
+    return token.as_q()
+
+def apply_q(op, a=None, b=None):
+    # no-op
+    if op == ' ': return Q()
+
+    # AND | OR
+    if op == '&': return a & b
+    if op == '|': return a | b
+
 # Function that returns value of
 # expression after evaluation.
 # Adapted from https://www.geeksforgeeks.org/expression-evaluation/
-def evaluate(tokens):
+#
+# By default, the expression is evaluated
+# into Q objects. Other representations
+# can be built by providing 'operand' and
+# 'apply' functions.
+def evaluate(tokens, operand=as_q, apply=apply_q):
     # Function to find precedence 
     # of operators.
     def precedence(op): 
@@ -18,16 +35,15 @@ def evaluate(tokens):
         op = ops.pop()
 
         # no-op
-        if op == ' ': return Q()
+        if op == ' ': return apply(op)
 
         b = values.pop()
         a = values.pop()
 
         # AND | OR
-        if op == '&': return a & b
-        if op == '|':  return a | b
+        return apply(op, a, b)
 
-    # stack to store Q objects.
+    # stack to store values.
     values = []
 
     # stack to store operators.
@@ -41,9 +57,9 @@ def evaluate(tokens):
             ops.append(token.op)
 
         # Current token is a term, push 
-        # it to stack for Q objects.
-        elif token.op == "-" or token.op == '!':
-            values.append(token.as_q())
+        # it to stack for values.
+        elif token.op == "-" or token.op == '!' or token.op == '@':
+            values.append(operand(token))
           
         # Closing brace encountered, 
         # solve entire brace.
@@ -0,0 +1,108 @@
+import logging
+
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .cache import bump_lookups_generation, compiled_filters
+from .conf import get_setting
+from .models import (
+    DynamicFilterExpr, 
+    DynamicFilterSlowLog, 
+    DynamicFilterTerm,
+    DynamicFilterValueSet,
+)
+from .timing import filter_timed
+
+
+logger = logging.getLogger('dynfilters')
+
+
+# Bump the version of the filters referencing 'pk', directly or not, 
+# since their compilation includes it.
+def invalidate_dependents(pk):
+    dependents = DynamicFilterExpr(pk=pk).get_dependents()
+
+    if dependents:
+        (
+            DynamicFilterExpr
+                .objects
+                .filter(pk__in=dependents)
+                .update(version=F('version') + 1, updated_at=timezone.now())
+        )
+
+        for dependent in dependents:
+            compiled_filters.invalidate(dependent)
+
+@receiver(post_save, sender=DynamicFilterExpr)
+@receiver(post_delete, sender=DynamicFilterExpr)
+def invalidate_expr(sender, instance, created=False, **kwargs):
+    compiled_filters.invalidate(instance.pk)
+
+    if not created:
+        invalidate_dependents(instance.pk)
+
+    bump_lookups_generation(instance.model)
+
+@receiver(post_save, sender=DynamicFilterTerm)
+@receiver(post_delete, sender=DynamicFilterTerm)
+def invalidate_term(sender, instance, signal, **kwargs):
+    # Bump the version of the parent filter, so that workers sharing
+    # the compiled cache also stop using the previous compilation.
+    # The stored AST is discarded until the filter is compiled again.
+    (
+        DynamicFilterExpr
+            .objects
+            .filter(pk=instance.filter_id)
+            .update(version=F('version') + 1, updated_at=timezone.now(), ast=None)
+    )
+
+    compiled_filters.invalidate(instance.filter_id)
+    invalidate_dependents(instance.filter_id)
+
+    try:
+        bump_lookups_generation(instance.filter.model)
+    except DynamicFilterExpr.DoesNotExist:
+        pass # deleted with its filter, which bumps it
+
+    # Value sets are shared by cloned terms, drop the one the term no
+    # longer references, unless other terms do.
+    loaded = getattr(instance, 'loaded_value_set_id', None)
+
+    if signal is post_delete:
+        DynamicFilterValueSet.release(instance.value_set_id)
+
+    elif loaded != instance.value_set_id:
+        DynamicFilterValueSet.release(loaded)
+        instance.loaded_value_set_id = instance.value_set_id
+
+@receiver(filter_timed)
+def record_timings(sender, expr, model, term_count, timings, **kwargs):
+    total = sum(timings.values())
+
+    if get_setting('LOG_TIMINGS'):
+        logger.info(
+            'Filter %s on %s took %.1f ms', expr.pk, model, total,
+            extra={
+                'dynfilters': {
+                    'filter': expr.pk,
+                    'model': model,
+                    'term_count': term_count,
+                    'total_ms': total,
+                    **{f'{phase}_ms': ms for phase, ms in timings.items()},
+                },
+            },
+        )
+
+    threshold = get_setting('SLOW_FILTER_MS')
+
+    if threshold is not None and total >= threshold:
+        DynamicFilterSlowLog.objects.create(
+            filter_id=expr.pk,
+            name=expr.name,
+            model=model,
+            term_count=term_count,
+            total_ms=total,
+            **{f'{phase}_ms': ms for phase, ms in timings.items()},
+        )
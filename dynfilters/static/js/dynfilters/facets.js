@@ -0,0 +1,83 @@
+// Suggests values for the 'Equals' and 'One of' terms: the most frequent
+// values of the selected field, fetched from the dynfilters_facets view.
+'use strict';
+(function() {
+    const LOOKUPS = ['=', 'in'];
+    const requests = {};
+
+    // Field and lookup selects of the row of a value input.
+    function getSibling(input, name) {
+        return document.getElementsByName(input.name.replace(/-value$/, '-' + name))[0];
+    }
+
+    function fetchFacets(url, field) {
+        const key = url + '|' + field;
+
+        if (!(key in requests)) {
+            requests[key] = fetch(url + '?' + new URLSearchParams({field: field}), {credentials: 'same-origin'})
+                .then(response => response.ok ? response.json() : {facets: []})
+                .then(data => data.facets)
+                .catch(() => []);
+        }
+
+        return requests[key];
+    }
+
+    function getDatalist(input) {
+        const id = input.id + '-facets';
+        let datalist = document.getElementById(id);
+
+        if (!datalist) {
+            datalist = document.createElement('datalist');
+            datalist.id = id;
+            input.after(datalist);
+            input.setAttribute('list', id);
+        }
+
+        return datalist;
+    }
+
+    function update(input) {
+        const field = getSibling(input, 'field');
+        const lookup = getSibling(input, 'lookup');
+
+        if (!field || !lookup) {
+            return;
+        }
+
+        const datalist = getDatalist(input);
+
+        if (!LOOKUPS.includes(lookup.value) || !field.value || field.value === '-') {
+            datalist.replaceChildren();
+            return;
+        }
+
+        fetchFacets(input.dataset.dynfiltersFacets, field.value).then(facets => {
+            // 'One of' values are comma separated, complete the last one.
+            const prefix = lookup.value === 'in' ? input.value.replace(/[^,]*$/, '') : '';
+
+            datalist.replaceChildren(...facets.filter(facet => facet.value !== null).map(facet => {
+                const option = document.createElement('option');
+                option.value = prefix + facet.value;
+                option.label = `${facet.value} (${facet.count})`;
+                return option;
+            }));
+        });
+    }
+
+    function isValueInput(element) {
+        return element.matches && element.matches('input[data-dynfilters-facets]');
+    }
+
+    document.addEventListener('focusin', event => {
+        if (isValueInput(event.target)) {
+            update(event.target);
+        }
+    });
+
+    document.addEventListener('input', event => {
+        if (isValueInput(event.target) && event.target.value.includes(',')) {
+            update(event.target);
+        }
+    });
+})();
@@ -0,0 +1,22 @@
+from django import template
+
+from ..pagination import CURSOR_VAR
+
+register = template.Library()
+
+
+@register.inclusion_tag('dynfilters/keyset_pagination.html')
+def keyset_pagination(cl):
+    paginator = cl.paginator
+
+    return {
+        'cl': cl,
+        'first_url': (
+            cl.get_query_string(remove=[CURSOR_VAR])
+            if paginator.cursor else None
+        ),
+        'next_url': (
+            cl.get_query_string({CURSOR_VAR: paginator.next_cursor})
+            if paginator.next_cursor else None
+        ),
+    }
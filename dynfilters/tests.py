@@ -1,3 +1,1837 @@
-from django.test import TestCase
+import json
+import random
+from datetime import date
+from importlib import import_module
+from io import StringIO
+from types import SimpleNamespace
+from unittest import skipUnless
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.apps import apps as django_apps
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth.models import Permission, User
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core.cache import caches
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.core.management import call_command
+from django.core.signals import request_finished
+from django.db import connections, models
+from django.db.models import Q
+from django.http import Http404
+from django.forms import inlineformset_factory
+from django.test import AsyncRequestFactory, RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from . import async_views, compiler, evaluator, facets, guard, materialize, model_helpers, optimizer, shunting_yard, values, views
+from .cache import compiled_filters
+from .clone import clone_filter
+from .conf import get_setting
+from .timing import PHASES, filter_timed, new_timings, time_queries
+from .wrappers import add_request_wrapper, mark
+from .filters import DynamicFilter
+from .forms import DynamicFilterTermInlineForm, DynamicFilterTermInlineFormSet
+from .pagination import KeysetPaginator, encode_cursor
+from .models import (
+    DynamicFilterExpr,
+    DynamicFilterTerm,
+    DynamicFilterColumn,
+    DynamicFilterColumnSortOrder,
+    DynamicFilterSlowLog,
+    DynamicFilterValueSet,
+)
+
+
+def term(op, field=None, lookup='-', value=None):
+    return DynamicFilterTerm(op=op, field=field, lookup=lookup, value=value)
+
+
+class CompiledCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create(username='test')
+        cls.expr = DynamicFilterExpr.objects.create(model='dynfilters.Dynamicfilterexpr', user=user)
+        cls.term = DynamicFilterTerm.objects.create(filter=cls.expr, field='name', lookup='=', value='a', order=1)
+
+    def setUp(self):
+        compiled_filters.clear()
+        self.expr.refresh_from_db()
+
+    def test_hits_and_misses(self):
+        q = compiled_filters.get(self.expr)
+        self.assertIs(compiled_filters.get(self.expr), q)
+
+        self.assertEqual(compiled_filters.stats()['hits'], 1)
+        self.assertEqual(compiled_filters.stats()['misses'], 1)
+
+    def test_version(self):
+        version = self.expr.version
+
+        # Saved twice within the same second.
+        self.expr.save()
+        self.assertEqual(self.expr.version, version + 1)
+        self.expr.save()
+        self.assertEqual(self.expr.version, version + 2)
+
+        # Derived fields do not change the version.
+        self.expr.save(update_fields=['ast'])
+        self.assertEqual(self.expr.version, version + 2)
+
+    def test_term_save_and_delete(self):
+        compiled_filters.get(self.expr)
+        version = self.expr.version
+
+        self.term.value = 'b'
+        self.term.save()
+        self.expr.refresh_from_db()
+
+        self.assertEqual(self.expr.version, version + 1)
+        self.assertEqual(compiled_filters.stats()['size'], 0)
+        self.assertEqual(compiled_filters.get(self.expr), Q(name='b'))
+
+        self.term.delete()
+        self.expr.refresh_from_db()
+
+        self.assertEqual(self.expr.version, version + 2)
+        self.assertEqual(compiled_filters.get(self.expr), Q())
+
+    @override_settings(DYNFILTERS_COMPILED_CACHE='default')
+    def test_shared_cache(self):
+        compiled_filters.get(self.expr)
+        compiled_filters.clear() # another worker
+
+        with self.assertNumQueries(0):
+            compiled_filters.get(self.expr)
+
+        # The shared entry of the previous version is not used.
+        self.term.value = 'c'
+        self.term.save()
+        self.expr.refresh_from_db()
+        compiled_filters.clear()
+
+        self.assertEqual(compiled_filters.get(self.expr), Q(name='c'))
+
+
+class RandomTermsMixin:
+    # Random terms, evaluated against the DynamicFilterTerm table itself,
+    # which is conveniently available in every project using dynfilters.
+    FIELDS = ['field', 'value', 'lookup', 'field|value']
+    VALUES = ['a', 'b', 'c', 'd']
+
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create(username='test')
+        cls.expr = DynamicFilterExpr.objects.create(model='dynfilters.Dynamicfilterterm', user=user)
+
+        rows = []
+        for i, field in enumerate(cls.VALUES + [None]):
+            for j, value in enumerate(cls.VALUES + [None]):
+                rows.append(DynamicFilterTerm(
+                    filter=cls.expr,
+                    field=field,
+                    value=value,
+                    lookup=cls.VALUES[(i + j) % len(cls.VALUES)],
+                    order=i * 10 + j,
+                ))
+
+        DynamicFilterTerm.objects.bulk_create(rows)
+
+    def random_term(self, rnd):
+        lookup = rnd.choice(['=', '=', '=', 'in', 'icontains', 'isnull', 'gt'])
+
+        if lookup == 'in':
+            value = ','.join(rnd.sample(self.VALUES, 2))
+        elif lookup == 'isnull':
+            value = None
+        else:
+            value = rnd.choice(self.VALUES)
+
+        return term(rnd.choice('-!'), rnd.choice(self.FIELDS), lookup, value)
+
+    # Generate a syntactically valid sequence of terms, with 
+    # parentheses, explicit and implicit operators, and no-ops.
+    def random_terms(self, rnd, depth=0):
+        terms = []
+
+        for i in range(rnd.randint(1, 4)):
+            if i:
+                op = rnd.choice('&|&| ')
+                if op != ' ':
+                    terms.append(term(op))
+
+            if depth < 3 and rnd.random() < 0.3:
+                terms.append(term('('))
+                terms.extend(self.random_terms(rnd, depth + 1))
+                terms.append(term(')'))
+            else:
+                terms.append(self.random_term(rnd))
+
+        return terms
+
+    def evaluate(self, q):
+        return set(
+            DynamicFilterTerm.objects
+                .filter(filter=self.expr)
+                .filter(q)
+                .values_list('pk', flat=True)
+        )
+
+
+class OptimizerTests(RandomTermsMixin, TestCase):
+    def test_equivalence(self):
+        rnd = random.Random(42)
+
+        for i in range(200):
+            nterms = compiler.normalize(self.random_terms(rnd), DynamicFilterTerm)
+
+            expected = shunting_yard.evaluate(nterms)
+            optimized = compiler.node_as_q(optimizer.optimize(compiler.compile_terms(nterms)))
+
+            self.assertEqual(self.evaluate(optimized), self.evaluate(expected))
+
+    # The AST stored with the filter, read back from the database.
+    def test_stored_ast(self):
+        rnd = random.Random(3)
+
+        for i in range(20):
+            expr = DynamicFilterExpr.objects.create(model=self.expr.model, user=self.expr.user)
+            for order, t in enumerate(self.random_terms(rnd)):
+                t.filter, t.order = expr, order
+                t.save()
+
+            expected = shunting_yard.evaluate(expr.normalized_terms())
+
+            expr.compile()
+            expr.save(update_fields=['ast'])
+            expr = DynamicFilterExpr.objects.get(pk=expr.pk)
+
+            self.assertIsNotNone(expr.ast)
+            with self.assertNumQueries(0):
+                q = expr.as_q()
+
+            self.assertEqual(self.evaluate(q), self.evaluate(expected))
+
+    def test_migration_compiler(self):
+        migration = import_module('dynfilters.migrations.0009_compile_dynamicfilterexpr_ast')
+        rnd = random.Random(4)
+
+        for i in range(50):
+            terms = self.random_terms(rnd)
+
+            self.assertEqual(
+                migration.compile_terms(migration.normalize(terms, DynamicFilterTerm)),
+                shunting_yard.evaluate(
+                    compiler.normalize(terms, DynamicFilterTerm),
+                    operand=migration.as_node,
+                    apply=compiler.apply_node,
+                ),
+            )
+
+    def test_save_related_compiles(self):
+        expr = DynamicFilterExpr.objects.create(model=self.expr.model, user=self.expr.user)
+        DynamicFilterTerm.objects.create(filter=expr, field='value', lookup='=', value='a', order=1)
+        expr.refresh_from_db()
+        self.assertIsNone(expr.ast) # cleared by the term
+
+        request = RequestFactory().post('/')
+        form = SimpleNamespace(instance=expr, save_m2m=lambda: None)
+        admin.site._registry[DynamicFilterExpr].save_related(request, form, [], True)
+
+        expr.refresh_from_db()
+        self.assertEqual(expr.ast, ['-', 'value', '=', 'a'])
+
+    def test_stored_on_first_use(self):
+        expr = DynamicFilterExpr.objects.create(model=self.expr.model, user=self.expr.user)
+        DynamicFilterTerm.objects.create(filter=expr, field='value', lookup='=', value='a', order=1)
+        expr.refresh_from_db()
+
+        # Not stored if the terms changed since the filter was loaded.
+        stale = DynamicFilterExpr.objects.get(pk=expr.pk)
+        DynamicFilterTerm.objects.create(filter=expr, field='value', lookup='=', value='b', order=2)
+        stale.get_ast()
+        expr.refresh_from_db()
+        self.assertIsNone(expr.ast)
+
+        self.assertEqual(expr.get_ast(), ['&', ['-', 'value', '=', 'a'], ['-', 'value', '=', 'b']])
+        expr.refresh_from_db()
+        self.assertEqual(expr.ast, ['&', ['-', 'value', '=', 'a'], ['-', 'value', '=', 'b']])
+
+        with self.assertNumQueries(0):
+            expr.get_ast()
+
+    def test_flatten_and_drop_noops(self):
+        node = ['&', ['&', ['-', 'a', '=', '1'], []], ['&', ['-', 'b', '=', '1'], ['-', 'c', '=', '1']]]
+
+        self.assertEqual(optimizer.optimize(node), [
+            '&', ['-', 'a', '=', '1'], ['-', 'b', '=', '1'], ['-', 'c', '=', '1'],
+        ])
+
+    def test_empty(self):
+        self.assertEqual(optimizer.optimize(['&', [], ['|', [], []]]), [])
+
+    def test_fold_or_into_in(self):
+        node = ['|', ['|', ['-', 'a', '=', '1'], ['-', 'b', '=', '1']], ['-', 'a', 'in', ['2', '3']]]
+
+        self.assertEqual(optimizer.optimize(node), [
+            '|', ['-', 'a', 'in', ['1', '2', '3']], ['-', 'b', '=', '1'],
+        ])
+
+    def test_fold_negated_and_into_in(self):
+        node = ['&', ['!', 'a', '=', '1'], ['!', 'a', '=', '2']]
+
+        self.assertEqual(optimizer.optimize(node), ['!', 'a', 'in', ['1', '2']])
+
+    def test_fold_of_dates(self):
+        node = ['|', ['-', 'birth_date', '=', '2000-01-01'], ['-', 'birth_date', '=', '2000-01-02']]
+
+        self.assertEqual(optimizer.optimize(node), ['-', 'birth_date', 'in', ['2000-01-01', '2000-01-02']])
+
+    def test_no_fold_of_ranges(self):
+        node = ['|', ['-', 'a', 'range', [1, 2]], ['-', 'a', '=', 3]]
+
+        self.assertEqual(optimizer.optimize(node), node)
+
+    def test_dedupe(self):
+        node = ['|', ['-', 'a', 'icontains', '1'], ['-', 'a', 'icontains', '1']]
+
+        self.assertEqual(optimizer.optimize(node), ['-', 'a', 'icontains', '1'])
+
+    def test_push_not_down(self):
+        node = ['!', 'a|b', 'icontains', '1']
+
+        self.assertEqual(optimizer.optimize(node), [
+            '&', ['!', 'a', 'icontains', '1'], ['!', 'b', 'icontains', '1'],
+        ])
+
+
+class EvaluatorTests(RandomTermsMixin, TestCase):
+    # Same terms and rows as the optimizer tests, evaluated in Python.
+
+    def test_matches_database(self):
+        rnd = random.Random(42)
+        rows = list(DynamicFilterTerm.objects.filter(filter=self.expr))
+        columns = {f: [getattr(row, f) for row in rows] for f in ('field', 'value', 'lookup')}
+
+        for i in range(200):
+            nterms = compiler.normalize(self.random_terms(rnd), DynamicFilterTerm)
+            ast = optimizer.optimize(compiler.compile_terms(nterms))
+            expected = self.evaluate(compiler.node_as_q(ast))
+
+            predicate = evaluator.node_as_predicate(ast)
+            self.assertEqual({row.pk for row in rows if predicate(row)}, expected)
+
+            mask = evaluator.node_as_mask(ast)(columns)
+            self.assertEqual({row.pk for row, m in zip(rows, mask) if m}, expected)
+
+    def test_dicts(self):
+        predicate = evaluator.node_as_predicate(['&', 
+            ['-', 'birth_date', 'range', ['2000-01-01', '2000-12-31']],
+            ['-', 'address__town', 'in', ['Paris', 'Lyon']],
+            ['!', 'orders__qty', 'gt', 10],
+        ])
+
+        self.assertTrue(predicate({'birth_date': date(2000, 5, 1), 'address': {'town': 'Lyon'}, 'orders': [{'qty': '2'}]}))
+        self.assertTrue(predicate({'birth_date': '2000-05-01', 'address': {'town': 'Paris'}}))
+        self.assertFalse(predicate({'birth_date': '2001-05-01', 'address': {'town': 'Paris'}}))
+        self.assertFalse(predicate({'birth_date': '2000-05-01', 'address': None}))
+        self.assertFalse(predicate({'birth_date': '2000-05-01', 'address': {'town': 'Lyon'}, 'orders': [{'qty': 1}, {'qty': 12}]}))
+
+    def test_references(self):
+        user = self.expr.user
+        a = DynamicFilterExpr.objects.create(model=self.expr.model, user=user, ast=['-', 'field', '=', 'a'])
+        b = DynamicFilterExpr.objects.create(model=self.expr.model, user=user, ast=['|', ['@', a.pk], ['@', a.pk]])
+        c = DynamicFilterExpr.objects.create(model=self.expr.model, user=user, ast=['&', ['@', b.pk], ['-', 'value', '=', 'b']])
+
+        self.assertEqual(c.get_resolved_ast(), ['&', ['|', a.ast, a.ast], ['-', 'value', '=', 'b']])
+        self.assertTrue(c.as_predicate()({'field': 'a', 'value': 'b'}))
+        self.assertEqual(list(c.as_mask()({'field': ['a', 'a'], 'value': ['b', 'c']})), [True, False])
+
+        # Circular references.
+        DynamicFilterExpr.objects.filter(pk=a.pk).update(ast=['@', c.pk])
+
+        for expr in (a, c):
+            expr.refresh_from_db()
+
+            with self.assertRaisesRegex(ValueError, 'references itself'):
+                expr.as_predicate()
+            with self.assertRaisesRegex(ValueError, 'references itself'):
+                expr.as_mask()
+
+
+class BitmapTests(RandomTermsMixin, TestCase):
+    # Same terms and rows as the optimizer tests, evaluated at once.
+
+    def test_matches_database(self):
+        rnd = random.Random(7)
+        exprs = []
+
+        for i in range(20):
+            expr = DynamicFilterExpr.objects.create(model=self.expr.model, user=self.expr.user)
+            for order, t in enumerate(self.random_terms(rnd)):
+                t.filter, t.order = expr, order
+                t.save()
+            exprs.append(expr)
+
+        queryset = DynamicFilterTerm.objects.filter(filter=self.expr)
+
+        # With their ASTs stored, filters compile without queries, even
+        # on a cold cache.
+        for expr in exprs:
+            expr.compile()
+            expr.save(update_fields=['ast'])
+
+        compiled_filters.clear()
+
+        with self.assertNumQueries(1):
+            bitmaps = DynamicFilterExpr.as_bitmaps(exprs, queryset)
+
+        for expr in exprs:
+            self.assertEqual(set(bitmaps[expr.pk]), self.evaluate(expr.as_q()))
+
+        a, b = bitmaps[exprs[0].pk], bitmaps[exprs[1].pk]
+        everything = set(queryset.values_list('pk', flat=True))
+
+        self.assertEqual(set(a & b), set(a) & set(b))
+        self.assertEqual(set(a | b), set(a) | set(b))
+        self.assertEqual(set(a - b), set(a) - set(b))
+        self.assertEqual(set(~a), everything - set(a))
+        self.assertEqual(len(a), len(set(a)))
+
+    def test_negated_multivalued(self):
+        # Filters on multi-valued relations, joined or not, match the
+        # same rows as filter().
+        user = self.expr.user
+        other = DynamicFilterExpr.objects.create(name='other', model=self.expr.model, user=user)
+        DynamicFilterTerm.objects.create(filter=other, field='field', value='x', order=1)
+
+        queryset = DynamicFilterExpr.objects.all()
+        nodes = [
+            ['!', 'dynamicfilterterm__value', '=', '1'],
+            ['&', ['!', 'dynamicfilterterm__value', '=', '1'], ['-', 'dynamicfilterterm__field', '=', 'a']],
+            ['|', ['!', 'dynamicfilterterm__field', '=', 'a'], ['-', 'name', '=', 'other']],
+        ]
+
+        model_admin = admin.site._registry[DynamicFilterExpr]
+        self.addCleanup(vars(model_admin).pop, 'dynfilters_multivalued', None)
+
+        for multivalued in ('join', 'exists'):
+            model_admin.dynfilters_multivalued = multivalued
+
+            for node in nodes:
+                expr = DynamicFilterExpr.objects.create(model='dynfilters.Dynamicfilterexpr', user=user, ast=node)
+                bitmap = DynamicFilterExpr.as_bitmaps([expr], queryset)[expr.pk]
+
+                with self.subTest(multivalued=multivalued, node=node):
+                    self.assertEqual(set(bitmap), set(queryset.filter(expr.as_q()).values_list('pk', flat=True)))
+
+    def test_empty_filter(self):
+        expr = DynamicFilterExpr.objects.create(model=self.expr.model, user=self.expr.user)
+        queryset = DynamicFilterTerm.objects.filter(filter=self.expr)
+
+        bitmap = DynamicFilterExpr.as_bitmaps([expr], queryset)[expr.pk]
+
+        self.assertEqual(len(bitmap), queryset.count())
+        self.assertFalse(~bitmap)
+
+    def test_different_universes(self):
+        expr = DynamicFilterExpr.objects.create(model=self.expr.model, user=self.expr.user)
+        queryset = DynamicFilterTerm.objects.filter(filter=self.expr)
+
+        a = DynamicFilterExpr.as_bitmaps([expr], queryset)[expr.pk]
+        b = DynamicFilterExpr.as_bitmaps([expr], queryset)[expr.pk]
+
+        with self.assertRaises(ValueError):
+            a & b
+
+
+class MultiValuedTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create(username='test')
+
+        cls.exprs = []
+        for i in range(3):
+            expr = DynamicFilterExpr.objects.create(name=f'expr{i}', model='dynfilters.Dynamicfilterexpr', user=user)
+            DynamicFilterTerm.objects.bulk_create([
+                DynamicFilterTerm(filter=expr, field='a', value=str(i), order=1),
+                DynamicFilterTerm(filter=expr, field='a', value=str(i + 1), order=2),
+            ])
+            cls.exprs.append(expr)
+
+    def as_q(self, node, multivalued):
+        return compiler.node_as_q(node, DynamicFilterExpr, multivalued)
+
+    def test_exists_does_not_fan_out(self):
+        node = ['-', 'dynamicfilterterm__field', '=', 'a']
+
+        pks = list(DynamicFilterExpr.objects.filter(self.as_q(node, 'exists')).values_list('pk', flat=True))
+        self.assertEqual(sorted(pks), [e.pk for e in self.exprs])
+
+        pks = list(DynamicFilterExpr.objects.filter(self.as_q(node, 'join')).values_list('pk', flat=True))
+        self.assertEqual(len(pks), 6)
+
+    def test_exists_matches_join(self):
+        for node in (
+            ['-', 'dynamicfilterterm__value', '=', '1'],
+            ['!', 'dynamicfilterterm__value', '=', '1'],
+            ['|', ['-', 'dynamicfilterterm__value', 'in', ['0', '3']], ['-', 'name', '=', 'expr1']],
+            ['&', ['-', 'dynamicfilterterm__value', '=', '1'], ['!', 'name', '=', 'expr0']],
+            ['&', ['-', 'dynamicfilterterm__value', '=', '1'], ['-', 'dynamicfilterterm__order', '=', 2]],
+            ['&', ['-', 'dynamicfilterterm__value', '=', '1'], ['|', ['-', 'dynamicfilterterm__order', '=', 2], ['-', 'name', '=', 'expr1']]],
+            ['&', ['-', 'dynamicfilterterm__value', '=', '2'], ['!', 'dynamicfilterterm__order', '=', 2]],
+            ['&', ['!', 'dynamicfilterterm__value', '=', '1'], ['!', 'dynamicfilterterm__order', '=', 2]],
+        ):
+            exists = DynamicFilterExpr.objects.filter(self.as_q(node, 'exists'))
+            join = DynamicFilterExpr.objects.filter(self.as_q(node, 'join')).distinct()
+
+            self.assertEqual(set(exists), set(join), node)
+
+    def test_and_on_same_relation(self):
+        # Both terms have to match the same term, only expr0 has a '1'
+        # as its second term.
+        node = ['&', ['-', 'dynamicfilterterm__value', '=', '1'], ['-', 'dynamicfilterterm__order', '=', 2]]
+
+        q = self.as_q(node, 'exists')
+        self.assertEqual(list(DynamicFilterExpr.objects.filter(q)), [self.exprs[0]])
+        self.assertEqual(str(DynamicFilterExpr.objects.filter(q).query).count('EXISTS'), 1)
+
+
+class TypedValueTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create(username='test')
+        cls.expr = DynamicFilterExpr.objects.create(model='dynfilters.Dynamicfilterexpr', user=user)
+
+    def create_term(self, field, lookup, value):
+        return DynamicFilterTerm.objects.create(filter=self.expr, field=field, lookup=lookup, value=value, order=1)
+
+    def test_parsed_against_model_field(self):
+        self.assertEqual(self.create_term('updated_at', '=', '31/01/2020').typed_value, {'updated_at': '2020-01-31'})
+        self.assertEqual(self.create_term('use_count', 'in', '1, 2').typed_value, {'use_count': [1, 2]})
+        self.assertEqual(self.create_term('use_count', 'lt', '10').get_value(), 10)
+        self.assertEqual(self.create_term('user', '=', '1').get_term('user'), {'user': 1})
+
+    def test_no_guess_from_field_name(self):
+        term = self.create_term('name|updated_at', 'in', '01/01/2000')
+        self.assertEqual(term.typed_value, {'name': ['01/01/2000'], 'updated_at': ['2000-01-01']})
+
+    def test_invalid_value(self):
+        term = DynamicFilterTerm(filter=self.expr, field='use_count', lookup='gt', value='many', order=1)
+
+        with self.assertRaises(ValidationError):
+            term.clean()
+
+        with self.assertRaises(ValidationError):
+            term.save()
+
+        self.assertFalse(DynamicFilterTerm.objects.exists())
+
+        for field, lookup, value in (('use_count', 'gt', 'many'), ('name|updated_at', 'in', 'a, b'), ('updated_at', 'range', '01/01/2000')):
+            form = DynamicFilterTermInlineForm(
+                data={'op': '-', 'field': field, 'lookup': lookup, 'value': value, 'order': '1'},
+                instance=DynamicFilterTerm(filter=self.expr),
+            )
+
+            with self.subTest(field=field, lookup=lookup):
+                self.assertFalse(form.is_valid())
+                self.assertIn('value', form.errors)
+
+    def test_migration(self):
+        migration = import_module('dynfilters.migrations.0013_parse_dynamicfilterterm_typed_value')
+        terms = [
+            self.create_term('updated_at', 'range', '31/01/2020, 2020-02-28'),
+            self.create_term('name|use_count', 'in', '1, 2'),
+            self.create_term('user', 'isnull', None),
+        ]
+        DynamicFilterTerm.objects.update(typed_value=None)
+
+        migration.parse_typed_values(django_apps, None)
+
+        for term in terms:
+            typed_value = term.typed_value
+            term.refresh_from_db()
+            self.assertEqual(term.typed_value, typed_value)
+
+        # Compiled by the frozen compiler, as the current one would.
+        self.expr.refresh_from_db()
+        self.assertEqual(optimizer.optimize(self.expr.ast), self.expr.compile())
+
+    def test_ast_holds_parsed_values(self):
+        self.create_term('use_count', 'gte', '2')
+
+        self.assertEqual(self.expr.compile(), ['-', 'use_count', 'gte', 2])
+        self.assertIn('"use_count" >= 2', self.expr.as_sql())
+
+    def test_value_set(self):
+        value_set = DynamicFilterValueSet.from_values([str(i) for i in range(0, 2000, 2)])
+        term = DynamicFilterTerm.objects.create(filter=self.expr, field='use_count', lookup='inset', value_set=value_set, order=1)
+
+        self.assertEqual(term.typed_value, {'use_count': {'value_set': value_set.pk, 'cast': 'PositiveIntegerField'}})
+        self.assertIn('IN (SELECT CAST(', self.expr.as_sql())
+
+        DynamicFilterExpr.objects.filter(pk=self.expr.pk).update(use_count=4)
+        self.assertTrue(DynamicFilterExpr.objects.filter(term.as_q()).exists())
+
+        DynamicFilterExpr.objects.filter(pk=self.expr.pk).update(use_count=5)
+        self.assertFalse(DynamicFilterExpr.objects.filter(term.as_q()).exists())
+
+        term.delete()
+        self.assertFalse(DynamicFilterValueSet.objects.exists())
+
+    def test_value_set_release(self):
+        value_set = DynamicFilterValueSet.from_values(['1'])
+        terms = [
+            DynamicFilterTerm.objects.create(filter=self.expr, field='use_count', lookup='inset', value_set=value_set, order=i)
+            for i in range(2)
+        ]
+
+        # Not referenced yet, e.g. being saved by the form.
+        pending = DynamicFilterValueSet.from_values(['2'])
+        self.create_term('use_count', 'gt', '1').delete()
+        self.assertTrue(DynamicFilterValueSet.objects.filter(pk=pending.pk).exists())
+
+        # Shared by the other term.
+        terms[0].delete()
+        self.assertTrue(DynamicFilterValueSet.objects.filter(pk=value_set.pk).exists())
+
+        # Replaced.
+        term = DynamicFilterTerm.objects.get(pk=terms[1].pk)
+        term.value_set = pending
+        term.save()
+        self.assertFalse(DynamicFilterValueSet.objects.filter(pk=value_set.pk).exists())
+
+        term.lookup = 'gt'
+        term.value = '1'
+        term.save()
+        self.assertFalse(DynamicFilterValueSet.objects.exists())
+
+    def test_cast_field(self):
+        field = models.DecimalField(max_digits=10, decimal_places=2)
+
+        cast = values.get_cast_field(field)
+        self.assertIsInstance(cast, models.DecimalField)
+        self.assertEqual((cast.max_digits, cast.decimal_places), (10, 2))
+        self.assertIsNot(cast, field)
+
+        self.assertIsInstance(values.get_cast_field(DynamicFilterExpr._meta.pk), models.IntegerField)
+        self.assertIsInstance(values.get_cast_field(DynamicFilterTerm._meta.get_field('filter')), models.IntegerField)
+        self.assertIsNone(values.get_cast_field(DynamicFilterExpr._meta.get_field('name')))
+
+        queryset = DynamicFilterValueSet.as_subquery(1, 'DecimalField', model_field=field)
+        self.assertEqual(queryset.query.annotations['typed'].output_field.max_digits, 10)
+
+
+class TermFormSetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create(username='test')
+        cls.expr = DynamicFilterExpr.objects.create(model='dynfilters.Dynamicfilterexpr', user=user)
+
+    def get_formset(self, *terms):
+        FormSet = inlineformset_factory(
+            DynamicFilterExpr, DynamicFilterTerm,
+            form=DynamicFilterTermInlineForm, formset=DynamicFilterTermInlineFormSet,
+            fields=('op', 'field', 'lookup', 'value', 'order'), extra=0,
+        )
+
+        data = {
+            'dynamicfilterterm_set-TOTAL_FORMS': str(len(terms)),
+            'dynamicfilterterm_set-INITIAL_FORMS': '0',
+        }
+        for i, (op, value) in enumerate(terms):
+            data.update({
+                f'dynamicfilterterm_set-{i}-op': op,
+                f'dynamicfilterterm_set-{i}-field': 'name' if op in ('-', '!') else '-',
+                f'dynamicfilterterm_set-{i}-lookup': '=' if op in ('-', '!') else '-',
+                f'dynamicfilterterm_set-{i}-value': value,
+                f'dynamicfilterterm_set-{i}-order': str(i + 1),
+            })
+
+        return FormSet(data=data, instance=self.expr)
+
+    def test_valid(self):
+        formset = self.get_formset(('(', ''), ('-', 'a'), ('|', ''), ('-', 'b'), (')', ''))
+
+        self.assertTrue(formset.is_valid(), formset.errors)
+        formset.save()
+        self.assertEqual(self.expr.dynamicfilterterm_set.count(), 5)
+
+    def test_unbalanced_parenthesis(self):
+        formset = self.get_formset(('(', ''), ('-', 'a'))
+        self.assertFalse(formset.is_valid())
+        self.assertEqual(formset.non_form_errors(), ['Missing closing parenthesis'])
+
+        formset = self.get_formset(('-', 'a'), (')', ''))
+        self.assertFalse(formset.is_valid())
+        self.assertEqual(formset.non_form_errors(), ['Missing opening parenthesis'])
+
+
+class PaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create(username='test')
+        cls.expr = DynamicFilterExpr.objects.create(model='dynfilters.Dynamicfilterterm', user=user)
+
+        DynamicFilterTerm.objects.bulk_create([
+            DynamicFilterTerm(filter=cls.expr, value=value, order=order)
+            for order, value in enumerate(['b', None, 'a', 'b', None, 'c', 'a', 'b', None])
+        ])
+
+    def paginate(self, ordering, per_page=2):
+        queryset = DynamicFilterTerm.objects.filter(filter=self.expr)
+        cursor, pks = None, []
+
+        while True:
+            paginator = KeysetPaginator(queryset, per_page, ordering=ordering, cursor=cursor)
+            page = paginator.page(1)
+            pks += [obj.pk for obj in page]
+
+            cursor = paginator.next_cursor
+            if cursor is None:
+                return pks
+
+    def expected(self, desc=False):
+        terms = DynamicFilterTerm.objects.filter(filter=self.expr).order_by('pk')
+
+        # Ties broken by pk, NULLs last in both directions.
+        values = sorted(t.value for t in terms if t.value is not None)
+        values = list(dict.fromkeys(reversed(values) if desc else values)) + [None]
+
+        return [t.pk for value in values for t in terms if t.value == value]
+
+    def test_ascending(self):
+        self.assertEqual(self.paginate(['value']), self.expected())
+
+    def test_descending(self):
+        self.assertEqual(self.paginate(['-value']), self.expected(desc=True))
+
+    def test_ties(self):
+        queryset = DynamicFilterTerm.objects.filter(filter=self.expr)
+        pks = list(queryset.order_by('pk').values_list('pk', flat=True))
+
+        self.assertEqual(self.paginate([], per_page=1), pks)
+        self.assertEqual(self.paginate(['filter'], per_page=4), pks)
+
+    def test_invalid_cursor(self):
+        queryset = DynamicFilterTerm.objects.filter(filter=self.expr)
+        first = [obj.pk for obj in KeysetPaginator(queryset, 2, ordering=['value']).page(1)]
+
+        for cursor in ('nope', encode_cursor(3), encode_cursor({'a': 1}), encode_cursor([1]), encode_cursor([[1], 2]), encode_cursor(['x', 'y'])):
+            paginator = KeysetPaginator(queryset, 2, ordering=['value'], cursor=cursor)
+
+            with self.subTest(cursor=cursor):
+                self.assertEqual([obj.pk for obj in paginator.page(1)], first)
+
+
+    def test_invalid_ordering(self):
+        queryset = DynamicFilterTerm.objects.filter(filter=self.expr).order_by('pk')
+        pks = list(queryset.values_list('pk', flat=True))
+
+        for ordering in (['value|field'], ['nope'], ['-filter__nope']):
+            paginator = KeysetPaginator(queryset, 2, ordering=ordering, cursor=encode_cursor(['a', 1]))
+
+            with self.subTest(ordering=ordering):
+                self.assertEqual([obj.pk for obj in paginator.page(2)], pks[2:4])
+                self.assertFalse(paginator.keyset)
+                self.assertIsNone(paginator.next_cursor)
+
+
+class MaterializeTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='test')
+        cls.expr = DynamicFilterExpr.objects.create(name='materialized', model='dynfilters.Dynamicfilterexpr', user=cls.user, materialized=True)
+        DynamicFilterTerm.objects.create(filter=cls.expr, field='name', lookup='istartswith', value='match', order=1)
+
+        cls.rows = [
+            DynamicFilterExpr.objects.create(name=name, model='x.Y', user=cls.user)
+            for name in ('match1', 'match2', 'other')
+        ]
+
+    def refresh(self, **kwargs):
+        self.expr.refresh_from_db()
+        count = materialize.refresh(self.expr, **kwargs)
+        self.expr.refresh_from_db()
+
+        return count
+
+    def test_refresh(self):
+        self.assertFalse(materialize.is_fresh(self.expr))
+        self.assertEqual(self.refresh(), 2)
+        self.assertTrue(materialize.is_fresh(self.expr))
+
+        results = materialize.get_results_subquery(self.expr, DynamicFilterExpr.objects.all())
+        self.assertEqual(
+            set(DynamicFilterExpr.objects.filter(pk__in=results)),
+            set(self.rows[:2]),
+        )
+
+    def test_refresh_view(self):
+        request = RequestFactory().get('/')
+        request.user = self.user
+        self.assertEqual(views.dynfilters_refresh(request, self.expr.pk).status_code, 405)
+
+        # Viewers may not refresh the results.
+        viewer = User.objects.create(username='viewer', is_staff=True)
+        viewer.user_permissions.add(Permission.objects.get(codename='view_dynamicfilterexpr'))
+
+        request = RequestFactory().post('/')
+        request.user = viewer
+        with self.assertRaises(PermissionDenied):
+            views.dynfilters_refresh(request, self.expr.pk)
+
+        request = RequestFactory().post('/', headers={'referer': '/admin/'})
+        request.user = User.objects.create(username='admin', is_staff=True, is_superuser=True)
+        request._messages = CookieStorage(request)
+
+        response = views.dynfilters_refresh(request, self.expr.pk)
+
+        self.assertEqual(response.url, '/admin/')
+        self.assertEqual([m.message for m in request._messages], ['The filter was refreshed, 2 rows.'])
+
+    def test_incremental_refresh(self):
+        self.refresh()
+
+        other = self.rows[2]
+        other.name = 'match3'
+        other.save()
+
+        self.assertEqual(self.refresh(), 1)
+        self.assertEqual(self.expr.dynamicfilterresult_set.count(), 3)
+
+        self.assertEqual(self.refresh(full=True), 3)
+
+    def test_full_refresh_on_relations(self):
+        expr = DynamicFilterExpr.objects.create(name='related', model='dynfilters.Dynamicfilterexpr', user=self.user, materialized=True)
+        DynamicFilterTerm.objects.create(filter=expr, field='dynamicfilterterm__order', lookup='=', value='7', order=1)
+        DynamicFilterTerm.objects.bulk_create([DynamicFilterTerm(filter=self.rows[0], order=1)])
+
+        self.expr = expr
+        self.assertEqual(self.refresh(), 0)
+
+        # Changes to related rows leave the watermark of the rows as is.
+        DynamicFilterTerm.objects.filter(filter=self.rows[0]).update(order=7)
+
+        self.assertEqual(self.refresh(), 1)
+        self.assertEqual(list(expr.dynamicfilterresult_set.values_list('object_id', flat=True)), [str(self.rows[0].pk)])
+
+    def test_full_refresh_on_references(self):
+        expr = DynamicFilterExpr.objects.create(name='reference', model='dynfilters.Dynamicfilterexpr', user=self.user, materialized=True)
+        DynamicFilterTerm.objects.create(filter=expr, op='@', value=str(self.expr.pk), order=1)
+
+        self.expr = expr
+        self.assertEqual(self.refresh(), 2)
+        self.assertEqual(self.refresh(), 2)
+
+    def test_uses_own_columns(self):
+        model_obj = DynamicFilterExpr
+
+        self.assertTrue(materialize.uses_own_columns(model_obj, ['&', ['-', 'name', '=', 'a'], ['-', 'user', '=', 1]]))
+        self.assertFalse(materialize.uses_own_columns(model_obj, ['-', 'user__username', '=', 'a']))
+        self.assertFalse(materialize.uses_own_columns(model_obj, ['!', 'dynamicfilterterm__value', '=', 'a']))
+        self.assertFalse(materialize.uses_own_columns(model_obj, ['|', ['-', 'name', '=', 'a'], ['@', 1]]))
+
+    def test_outdated_when_filter_changes(self):
+        self.refresh()
+
+        DynamicFilterTerm.objects.create(filter=self.expr, field='name', lookup='iendswith', value='1', order=2)
+        self.expr.refresh_from_db()
+
+        self.assertFalse(materialize.is_fresh(self.expr))
+
+
+class ReferenceTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create(username='test')
+
+        cls.base = DynamicFilterExpr.objects.create(name='match1', model='dynfilters.Dynamicfilterexpr', user=user)
+        DynamicFilterTerm.objects.create(filter=cls.base, field='name', lookup='istartswith', value='match', order=1)
+
+        cls.expr = DynamicFilterExpr.objects.create(name='match2', model='dynfilters.Dynamicfilterexpr', user=user)
+        DynamicFilterTerm.objects.create(filter=cls.expr, op='@', value=str(cls.base.pk), order=1)
+        DynamicFilterTerm.objects.create(filter=cls.expr, field='name', lookup='iendswith', value='2', order=2)
+
+        DynamicFilterExpr.objects.create(name='other2', model='dynfilters.Dynamicfilterexpr', user=user)
+
+    def setUp(self):
+        compiled_filters.clear()
+
+    def evaluate(self, expr):
+        expr.refresh_from_db()
+        return set(DynamicFilterExpr.objects.filter(compiled_filters.get(expr)).values_list('name', flat=True))
+
+    def test_reference(self):
+        self.assertEqual(self.expr.compile(), ['&', ['@', self.base.pk], ['-', 'name', 'iendswith', '2']])
+        self.assertEqual(self.evaluate(self.expr), {'match2'})
+
+        # The referenced filter was compiled once, for both.
+        self.evaluate(self.base)
+        self.assertEqual(compiled_filters.stats()['misses'], 2)
+
+    def test_circular_reference(self):
+        term = DynamicFilterTerm(filter=self.base, op='@', value=str(self.expr.pk), order=2)
+
+        with self.assertRaises(ValidationError):
+            term.clean()
+
+    def test_referenced_filter_changes(self):
+        self.evaluate(self.expr)
+        version = self.expr.version
+
+        DynamicFilterTerm.objects.filter(filter=self.base).update(value='other')
+        DynamicFilterTerm.objects.get(filter=self.base).save()
+
+        self.assertEqual(self.evaluate(self.expr), {'other2'})
+        self.assertNotEqual(self.expr.version, version)
+
+
+class AsyncTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='test', is_staff=True, is_superuser=True)
+
+        cls.base = DynamicFilterExpr.objects.create(name='match1', model='dynfilters.Dynamicfilterexpr', user=cls.user)
+        DynamicFilterTerm.objects.create(filter=cls.base, field='name', lookup='istartswith', value='match', order=1)
+
+        cls.expr = DynamicFilterExpr.objects.create(name='match2', model='dynfilters.Dynamicfilterexpr', user=cls.user)
+        DynamicFilterTerm.objects.create(filter=cls.expr, op='@', value=str(cls.base.pk), order=1)
+        DynamicFilterTerm.objects.create(filter=cls.expr, field='name', lookup='iendswith', value='2', order=2)
+        DynamicFilterColumn.objects.create(filter=cls.expr, field='name', order=1)
+
+        DynamicFilterExpr.objects.create(name='other2', model='dynfilters.Dynamicfilterexpr', user=cls.user)
+
+    def setUp(self):
+        compiled_filters.clear()
+
+    async def test_aas_q(self):
+        self.expr.ast = None
+
+        q = await self.expr.aas_q()
+
+        self.assertEqual(q, await sync_to_async(self.expr.as_q)())
+        self.assertEqual(await self.expr.acount(DynamicFilterExpr.objects.all()), 1)
+
+    async def test_circular_reference(self):
+        expr = await DynamicFilterExpr.objects.acreate(name='loop', model='dynfilters.Dynamicfilterexpr', user=self.user)
+        await DynamicFilterTerm.objects.acreate(filter=expr, op='@', value=str(expr.pk), order=1)
+
+        with self.assertRaises(ValueError):
+            await expr.aas_q()
+
+    async def test_export(self):
+        request = AsyncRequestFactory().get('/')
+        request.user = self.user
+
+        response = await async_views.dynfilters_export(request, self.expr.pk, 'csv')
+        content = b''.join([chunk async for chunk in response.streaming_content])
+
+        self.assertEqual(content.decode().split(), ['name', 'match2'])
+
+        response = await async_views.dynfilters_export(request, self.expr.pk, 'jsonl')
+        content = b''.join([chunk async for chunk in response.streaming_content])
+
+        self.assertEqual(content.decode(), '{"name": "match2"}\n')
+
+    async def test_refresh(self):
+        await DynamicFilterExpr.objects.filter(pk=self.base.pk).aupdate(materialized=True)
+
+        request = AsyncRequestFactory().get('/')
+        request.user = self.user
+        response = await async_views.dynfilters_refresh(request, self.base.pk)
+        self.assertEqual(response.status_code, 405)
+
+        request = AsyncRequestFactory().post('/', headers={'referer': '/admin/'})
+        request.user = self.user
+        request._messages = CookieStorage(request)
+
+        response = await async_views.dynfilters_refresh(request, self.base.pk)
+
+        self.assertEqual(response.url, '/admin/')
+        self.assertEqual([m.message for m in request._messages], ['The filter was refreshed, 2 rows.'])
+
+    async def test_add_unknown_model(self):
+        for model_name in ('x.Y', 'nope', 'a.b.c'):
+            request = AsyncRequestFactory().get('/', headers={'referer': '/admin/'})
+            request.user = self.user
+            request._messages = CookieStorage(request)
+
+            response = await async_views.dynfilters_add(request, model_name)
+
+            with self.subTest(model_name=model_name):
+                self.assertEqual(response.url, '/admin/')
+                self.assertEqual([m.message for m in request._messages], ['This type of model is unknown.'])
+
+    async def test_export_invalid_filter(self):
+        expr = await DynamicFilterExpr.objects.acreate(name='invalid', model='dynfilters.Dynamicfilterexpr', user=self.user, ast=['-', 'nope', '=', 'x'])
+
+        request = AsyncRequestFactory().get('/', headers={'referer': '/admin/'})
+        request.user = self.user
+        request._messages = CookieStorage(request)
+
+        response = await async_views.dynfilters_export(request, expr.pk, 'csv')
+
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('cannot be exported', [m.message for m in request._messages][0])
+
+
+class ExportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='test', is_staff=True, is_superuser=True)
+
+        cls.expr = DynamicFilterExpr.objects.create(name='match 1', model='dynfilters.Dynamicfilterexpr', user=cls.user)
+        DynamicFilterTerm.objects.create(filter=cls.expr, field='name', lookup='istartswith', value='match', order=1)
+        DynamicFilterColumn.objects.create(filter=cls.expr, field='name|is_global', order=1)
+        DynamicFilterColumnSortOrder.objects.create(filter=cls.expr, field='-name', order=1)
+
+        DynamicFilterExpr.objects.create(name='match 2', model='x.Y', user=cls.user, is_global=True)
+        DynamicFilterExpr.objects.create(name='other', model='x.Y', user=cls.user)
+
+    def setUp(self):
+        compiled_filters.clear()
+
+    def export(self, expr, format):
+        request = RequestFactory().get('/', headers={'referer': '/admin/'})
+        request.user = self.user
+        request._messages = CookieStorage(request)
+
+        return request, views.dynfilters_export(request, expr.pk, format)
+
+    def test_csv(self):
+        request, response = self.export(self.expr, 'csv')
+
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="match-1.csv"')
+        self.assertEqual(
+            b''.join(response.streaming_content).decode().splitlines(),
+            ['name,is_global', 'match 2,True', 'match 1,False'],
+        )
+
+    def test_jsonl(self):
+        request, response = self.export(self.expr, 'jsonl')
+
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(
+            b''.join(response.streaming_content).decode(),
+            '{"name": "match 2", "is_global": true}\n{"name": "match 1", "is_global": false}\n',
+        )
+
+    def test_streaming(self):
+        # The rows are only read once the response is iterated.
+        with CaptureQueriesContext(connections['default']) as queries:
+            request, response = self.export(self.expr, 'csv')
+
+        count = len(queries)
+
+        with CaptureQueriesContext(connections['default']) as queries:
+            lines = list(response.streaming_content)
+
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(len(lines), 3)
+        self.assertGreater(count, 0)
+
+    def test_invalid_filter(self):
+        for ast, column in ((['-', 'nope', '=', 'x'], 'name'), (None, 'nope')):
+            expr = DynamicFilterExpr.objects.create(name='invalid', model='dynfilters.Dynamicfilterexpr', user=self.user, ast=ast)
+            DynamicFilterColumn.objects.create(filter=expr, field=column, order=1)
+
+            request, response = self.export(expr, 'csv')
+
+            with self.subTest(ast=ast, column=column):
+                self.assertEqual(response.status_code, 302)
+                self.assertEqual(response.url, '/admin/')
+                self.assertIn('cannot be exported', [m.message for m in request._messages][0])
+
+    def test_unknown_format(self):
+        with self.assertRaises(Http404):
+            self.export(self.expr, 'xml')
+
+
+class FacetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='test')
+        cls.expr = DynamicFilterExpr.objects.create(model='dynfilters.Dynamicfilterterm', user=cls.user)
+
+        DynamicFilterTerm.objects.bulk_create([
+            DynamicFilterTerm(filter=cls.expr, field=field, value=value, order=i)
+            for i, (field, value) in enumerate([('a', 'x'), ('a', 'y'), ('b', 'x'), ('a', 'x'), ('c', None)])
+        ])
+
+        cls.scope = DynamicFilterExpr.objects.create(model='dynfilters.Dynamicfilterterm', user=cls.user)
+        DynamicFilterTerm.objects.create(filter=cls.scope, field='value', lookup='=', value='x', order=1)
+
+    def setUp(self):
+        caches[get_setting('COUNTS_CACHE')].clear()
+
+        self.request = RequestFactory().get('/')
+        self.request.user = self.user
+
+        self.model_admin = admin.ModelAdmin(DynamicFilterTerm, admin.site)
+        self.model_admin.dynfilters_fields = ['-', 'field', 'field|value']
+
+    def get_facets(self, field, scoped=False):
+        fields = facets.get_facet_fields(self.model_admin, field)
+        queryset = DynamicFilterTerm.objects.filter(filter=self.expr)
+
+        self.model_admin.get_queryset = lambda request: queryset
+        return facets.get_facets(self.request, self.scope, self.model_admin, fields, 10, scoped)
+
+    def test_fields(self):
+        self.assertEqual(facets.get_facet_fields(self.model_admin, 'field|value'), ['field', 'value'])
+        self.assertEqual(facets.get_facet_fields(self.model_admin, 'value'), ['value'])
+        self.assertIsNone(facets.get_facet_fields(self.model_admin, 'lookup'))
+        self.assertIsNone(facets.get_facet_fields(self.model_admin, '-'))
+
+    def test_facets(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get_facets('field'), [
+                {'value': 'a', 'count': 3},
+                {'value': 'b', 'count': 1},
+                {'value': 'c', 'count': 1},
+            ])
+
+        # Cached for the version of the filter.
+        with self.assertNumQueries(0):
+            self.get_facets('field')
+
+    def test_scoped(self):
+        self.assertEqual(self.get_facets('field', scoped=True), [
+            {'value': 'a', 'count': 2},
+            {'value': 'b', 'count': 1},
+        ])
+
+    def test_several_fields(self):
+        # Rows with the value in both fields are counted once.
+        DynamicFilterTerm.objects.bulk_create([DynamicFilterTerm(filter=self.expr, field='x', value='x', order=5)])
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get_facets('field|value')[:2], [
+                {'value': 'x', 'count': 4},
+                {'value': 'a', 'count': 3},
+            ])
+
+        self.assertEqual(self.get_facets('field|value', scoped=True), [
+            {'value': 'x', 'count': 4},
+            {'value': 'a', 'count': 2},
+            {'value': 'b', 'count': 1},
+        ])
+
+    async def test_async(self):
+        queryset = DynamicFilterTerm.objects.filter(filter=self.expr)
+        self.model_admin.get_queryset = lambda request: queryset
+
+        for field, expected in (('field', {'value': 'a', 'count': 3}), ('field|value', {'value': 'a', 'count': 3})):
+            fields = facets.get_facet_fields(self.model_admin, field)
+            result = await facets.aget_facets(self.request, self.scope, self.model_admin, fields, 10)
+
+            self.assertEqual(result[0], expected)
+
+    def test_fields_of_different_types(self):
+        self.model_admin.dynfilters_fields = ['value|order', 'order|filter']
+
+        facets = self.get_facets('value|order')
+        self.assertEqual(facets[0], {'value': 'x', 'count': 3})
+        self.assertIn({'value': '4', 'count': 1}, facets)
+        self.assertEqual(self.get_facets('order|filter')[0], {'value': str(self.expr.pk), 'count': 5})
+
+
+class FacetViewTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='test', is_staff=True, is_superuser=True)
+        cls.expr = DynamicFilterExpr.objects.create(name='a', model='dynfilters.Dynamicfilterexpr', user=cls.user)
+        DynamicFilterExpr.objects.create(name='a', model='x.Y', user=cls.user)
+        DynamicFilterExpr.objects.create(name='b', model='dynfilters.Dynamicfilterexpr', user=cls.user)
+
+    def setUp(self):
+        caches[get_setting('COUNTS_CACHE')].clear()
+
+        model_admin = admin.site._registry[DynamicFilterExpr]
+        model_admin.dynfilters_fields = ['-', 'name', 'name|model']
+        self.addCleanup(vars(model_admin).pop, 'dynfilters_fields', None)
+
+    def get(self, user=None, **params):
+        request = RequestFactory().get('/', params)
+        request.user = user or self.user
+
+        return views.dynfilters_facets(request, self.expr.pk)
+
+    def test_facets(self):
+        response = self.get(field='name', limit='1')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content), {
+            'field': 'name',
+            'facets': [{'value': 'a', 'count': 2}],
+        })
+
+    def test_several_fields(self):
+        response = self.get(field='name|model')
+
+        self.assertEqual(json.loads(response.content), {
+            'field': 'name|model',
+            'facets': [
+                {'value': 'a', 'count': 2},
+                {'value': 'dynfilters.Dynamicfilterexpr', 'count': 2},
+                {'value': 'b', 'count': 1},
+                {'value': 'x.Y', 'count': 1},
+            ],
+        })
+
+    def test_unknown_field(self):
+        for field in ('user', 'name|user__password', ''):
+            response = self.get(field=field)
+
+            with self.subTest(field=field):
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(json.loads(response.content), {'error': 'Unknown field.'})
+
+    def test_permission(self):
+        user = User.objects.create(username='other')
+
+        with self.assertRaises(PermissionDenied):
+            self.get(user, field='name')
+
+    def test_unknown_filter(self):
+        request = RequestFactory().get('/', {'field': 'name'})
+        request.user = self.user
+
+        with self.assertRaises(Http404):
+            views.dynfilters_facets(request, 0)
+
+
+class TermAdmin(admin.ModelAdmin):
+    list_display = ('value', 'filter')
+    dynfilters_fields = [
+        '-', 'value', ('filter__name', 'Filter'), 'filter__user__username',
+        'filter__dynamicfiltercolumn__field',
+    ]
+    dynfilters_select_related = ['filter', 'value_set']
+    dynfilters_prefetch_related = ['filter']
+
+
+class ModelHelpersTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='test')
+        cls.expr = DynamicFilterExpr.objects.create(model='dynfilters.Dynamicfilterterm', user=cls.user)
+        DynamicFilterTerm.objects.create(filter=cls.expr, field='filter__user__username', lookup='=', value='test', order=1)
+        DynamicFilterColumn.objects.create(filter=cls.expr, field='value', order=1)
+        cls.expr.compile()
+        cls.expr.save(update_fields=['ast'])
+
+    def setUp(self):
+        # Plain site first, the one with dynamic filters takes precedence.
+        self.sites = [admin.AdminSite(name='plain'), admin.AdminSite(name='dynfilters')]
+        self.sites[0].register(DynamicFilterTerm)
+        self.sites[1].register(DynamicFilterTerm, TermAdmin)
+
+        # Sites are only forgotten once garbage collected.
+        for site in self.sites:
+            self.addCleanup(site.unregister, DynamicFilterTerm)
+
+        model_helpers.clear_model_registry()
+        self.addCleanup(model_helpers.clear_model_registry)
+
+        self.model_admin = self.sites[1]._registry[DynamicFilterTerm]
+
+        self.request = RequestFactory().get('/', {'filter': self.expr.pk})
+        self.request.user = self.user
+
+    def test_get_model_admins(self):
+        model_admins = model_helpers.get_model_admins()
+
+        self.assertIs(model_admins[DynamicFilterTerm], self.model_admin)
+        self.assertIs(model_admins[DynamicFilterExpr], admin.site._registry[DynamicFilterExpr])
+        self.assertIs(model_helpers.get_model_admins(), model_admins)
+
+        with self.assertRaises(TypeError):
+            model_admins[DynamicFilterTerm] = None
+
+    def test_get_dynfilters_fields(self):
+        self.assertEqual(model_helpers.get_dynfilters_fields(self.model_admin), (
+            ('-', '---------'),
+            ('value', 'Value'),
+            ('filter__name', 'Filter'),
+            ('filter__user__username', 'Filter user username'),
+            ('filter__dynamicfiltercolumn__field', 'Filter dynamicfiltercolumn field'),
+        ))
+
+    def test_get_relation_plan(self):
+        plan = model_helpers.get_relation_plan(self.model_admin)
+
+        self.assertEqual(plan['select_related'], ('filter',))
+        self.assertEqual(plan['prefetch_related'], ('filter',))
+        self.assertEqual(dict(plan['paths']), {
+            'filter__name': 'filter',
+            'filter__user__username': 'filter__user',
+            'filter__dynamicfiltercolumn__field': 'filter',
+        })
+        self.assertIs(model_helpers.get_relation_plan(self.model_admin), plan)
+
+    def test_get_projection(self):
+        self.assertEqual(
+            model_helpers.get_projection(self.model_admin, self.request, {'filter__user'}),
+            (['id', 'value', 'filter', 'filter__user'], {'filter'}),
+        )
+
+        self.model_admin.list_display = ('__str__',)
+        self.assertIsNone(model_helpers.get_projection(self.model_admin, self.request, set()))
+
+        self.model_admin.dynfilters_only_fields = ['order']
+        self.assertEqual(
+            model_helpers.get_projection(self.model_admin, self.request, set()),
+            (['id', 'order'], set()),
+        )
+
+    def test_queryset(self):
+        spec = DynamicFilter(self.request, {'filter': [str(self.expr.pk)]}, DynamicFilterTerm, self.model_admin)
+        queryset = spec.queryset(self.request, DynamicFilterTerm.objects.all())
+
+        self.assertEqual(queryset.query.select_related, {'filter': {'user': {}}})
+        self.assertEqual(queryset.query.deferred_loading, ({'id', 'value', 'filter', 'filter__user'}, False))
+        self.assertEqual(queryset._prefetch_related_lookups, ('filter',))
+
+        # The filter columns are not displayed by the changelist.
+        self.assertEqual(list(queryset), [DynamicFilterTerm.objects.get()])
+        with self.assertNumQueries(0):
+            queryset[0].filter.user.username
+
+
+class GuardTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='test')
+
+    def check(self, node, model=DynamicFilterTerm):
+        expr = DynamicFilterExpr.objects.create(model=f'dynfilters.{model.__name__}', user=self.user)
+        DynamicFilterExpr.objects.filter(pk=expr.pk).update(ast=node)
+        expr.refresh_from_db()
+
+        guard.check(model.objects.order_by().filter(expr.as_q()), expr)
+
+    @override_settings(DYNFILTERS_GUARD_MAX_FULL_SCANS=0)
+    def test_full_scan(self):
+        with self.assertRaisesMessage(guard.FilterTooExpensive, '1 full table scans exceed 0. Consider changing: value equals "x".'):
+            self.check(['-', 'value', '=', 'x'])
+
+    @override_settings(DYNFILTERS_GUARD_MAX_FULL_SCANS=0)
+    def test_index(self):
+        self.check(['&', ['-', 'order', '=', 1], ['-', 'value', 'icontains', 'x']])
+
+    @override_settings(DYNFILTERS_GUARD_MAX_FULL_SCANS=0)
+    def test_culprits_from_plan(self):
+        # Only the term on a column without index is blamed.
+        with self.assertRaisesMessage(guard.FilterTooExpensive, 'Consider changing: NOT value equals "x".'):
+            self.check(['|', ['-', 'order', '=', 1], ['!', 'value', '=', 'x']])
+
+        # The filters are scanned, the terms are looked up by filter id.
+        with self.assertRaises(guard.FilterTooExpensive) as cm:
+            self.check(['-', 'dynamicfilterterm__value', '=', 'x'], DynamicFilterExpr)
+
+        self.assertNotIn('Consider', str(cm.exception))
+
+    @override_settings(DYNFILTERS_GUARD_MAX_FULL_SCANS=1)
+    def test_below_threshold(self):
+        self.check(['-', 'value', '=', 'x'])
+
+    def test_timeout_hint(self):
+        self.assertEqual(
+            guard.add_timeout_hint(' select "a" from "b"', 1000.0),
+            'SELECT /*+ MAX_EXECUTION_TIME(1000) */ "a" from "b"',
+        )
+
+    def test_timeout_only_marked(self):
+        statements = []
+
+        def execute(sql, params, many, context):
+            statements.append(sql)
+
+        wrapper = guard.StatementTimeout(RequestFactory().get('/'), SimpleNamespace(vendor='mysql'), 1000)
+        marked = str(mark(DynamicFilterTerm.objects.all()).query)
+        unmarked = str(DynamicFilterTerm.objects.all().query)
+
+        wrapper(execute, marked, [], False, {})
+        wrapper(execute, unmarked, [], False, {})
+
+        self.assertTrue(statements[0].startswith('SELECT /*+ MAX_EXECUTION_TIME(1000) */'))
+        self.assertEqual(statements[1], unmarked)
+
+    @override_settings(DYNFILTERS_STATEMENT_TIMEOUT=1000)
+    def test_timeout_not_supported(self):
+        connection = connections['default']
+        wrappers = list(connection.execute_wrappers)
+
+        guard.apply_statement_timeout(RequestFactory().get('/'), DynamicFilterTerm.objects.all())
+
+        self.assertEqual(connection.execute_wrappers, wrappers)
+
+    def test_request_wrappers(self):
+        statements = []
+
+        def wrapper(execute, sql, params, many, context):
+            statements.append(sql)
+            return execute(sql, params, many, context)
+
+        add_request_wrapper('default', wrapper)
+        DynamicFilterTerm.objects.count()
+        self.assertEqual(len(statements), 1)
+
+        request_finished.send(sender=self.__class__)
+        DynamicFilterTerm.objects.count()
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn(wrapper, connections['default'].execute_wrappers)
+
+
+class TimingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create(username='test')
+        cls.expr = DynamicFilterExpr.objects.create(name='slow', model='dynfilters.Dynamicfilterterm', user=user)
+        DynamicFilterTerm.objects.bulk_create([
+            DynamicFilterTerm(filter=cls.expr, field='value', lookup='=', value='x', order=1),
+            DynamicFilterTerm(filter=cls.expr, field='order', lookup='gte', value='1', order=2),
+        ])
+
+    def setUp(self):
+        self.received = []
+
+        def receiver(sender, **kwargs):
+            self.received.append(kwargs)
+
+        filter_timed.connect(receiver)
+        self.addCleanup(filter_timed.disconnect, receiver)
+
+    def filter_changelist(self):
+        request = RequestFactory().get('/', {'filter': self.expr.pk})
+        request.user = self.expr.user
+
+        model_admin = admin.ModelAdmin(DynamicFilterTerm, admin.site)
+        spec = DynamicFilter(request, {'filter': [str(self.expr.pk)]}, DynamicFilterTerm, model_admin)
+
+        queryset = spec.queryset(request, DynamicFilterTerm.objects.all())
+        self.assertEqual(queryset.count(), 1)
+        self.assertEqual(len(list(queryset)), 1)
+
+        request_finished.send(sender=self.__class__)
+
+    def test_signal(self):
+        self.filter_changelist()
+
+        self.assertEqual(len(self.received), 1)
+        kwargs = self.received[0]
+
+        self.assertEqual(kwargs['expr'].pk, self.expr.pk)
+        self.assertEqual(kwargs['model'], 'dynfilters.Dynamicfilterterm')
+        self.assertEqual(kwargs['term_count'], 2)
+        self.assertEqual(set(kwargs['timings']), set(PHASES))
+        self.assertGreater(kwargs['timings']['execute'], 0)
+        self.assertGreater(kwargs['timings']['compile'], 0)
+
+    def test_only_changelists(self):
+        compiled_filters.clear()
+        DynamicFilterTerm.objects.filter(compiled_filters.get(self.expr)).count()
+        request_finished.send(sender=self.__class__)
+
+        self.assertEqual(self.received, [])
+
+    def test_only_filtered_statements(self):
+        timings = new_timings()
+        time_queries(DynamicFilterTerm.objects.all(), self.expr, 2, timings)
+        self.addCleanup(request_finished.send, sender=self.__class__)
+
+        # e.g. the unfiltered count of the changelist
+        DynamicFilterTerm.objects.count()
+        self.assertEqual(timings['execute'], 0)
+
+        self.assertEqual(mark(DynamicFilterTerm.objects.all()).count(), 2)
+        self.assertGreater(timings['execute'], 0)
+
+    @override_settings(DYNFILTERS_SLOW_FILTER_MS=0)
+    def test_slow_log(self):
+        self.filter_changelist()
+
+        log = DynamicFilterSlowLog.objects.get()
+        timings = self.received[0]['timings']
+
+        self.assertEqual((log.filter_id, log.name, log.term_count), (self.expr.pk, 'slow', 2))
+        self.assertEqual(log.execute_ms, timings['execute'])
+        self.assertAlmostEqual(log.total_ms, sum(timings.values()))
+
+    @override_settings(DYNFILTERS_SLOW_FILTER_MS=60000)
+    def test_fast_filter(self):
+        self.filter_changelist()
+        self.assertFalse(DynamicFilterSlowLog.objects.exists())
+
+    @override_settings(DYNFILTERS_SLOW_FILTER_MS=None)
+    def test_slow_log_disabled(self):
+        self.filter_changelist()
+        self.assertFalse(DynamicFilterSlowLog.objects.exists())
+
+
+class UseCountTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create(username='test')
+
+        cls.exprs = []
+        for lookup, field, value in (
+            ('=', 'value', 'x'),
+            ('istartswith', 'value', 'x'),
+            ('gte', 'order', '1'),
+            ('month', 'filter__updated_at', '1'),
+            ('icontains', 'field', 'x'),
+        ):
+            expr = DynamicFilterExpr.objects.create(model='dynfilters.Dynamicfilterterm', user=user)
+            DynamicFilterTerm.objects.create(filter=expr, field=field, lookup=lookup, value=value, order=1)
+            cls.exprs.append(expr)
+
+    def setUp(self):
+        caches[get_setting('USE_COUNT_CACHE')].clear()
+
+    def advise(self, *args):
+        stdout = StringIO()
+        call_command('dynfilters_index_advisor', *args, stdout=stdout)
+        return stdout.getvalue()
+
+    def test_count_use(self):
+        expr = self.exprs[0]
+
+        with self.assertNumQueries(0):
+            expr.count_use()
+            expr.count_use()
+
+        DynamicFilterExpr.flush_use_counts()
+        expr.refresh_from_db()
+        self.assertEqual(expr.use_count, 2)
+
+        # Flushed counts are not added twice.
+        expr.count_use()
+        DynamicFilterExpr.flush_use_counts()
+        DynamicFilterExpr.flush_use_counts()
+        expr.refresh_from_db()
+        self.assertEqual(expr.use_count, 3)
+
+    def test_evicted_while_flushing(self):
+        cache = caches[get_setting('USE_COUNT_CACHE')]
+        expr = self.exprs[0]
+        expr.count_use()
+
+        # The key is evicted between the read and the decrement.
+        get_many = cache.get_many
+
+        def evicting_get_many(keys):
+            values = get_many(keys)
+            cache.delete_many(keys)
+            return values
+
+        cache.get_many = evicting_get_many
+        self.addCleanup(vars(cache).pop, 'get_many')
+
+        DynamicFilterExpr.flush_use_counts()
+
+        expr.refresh_from_db()
+        self.assertEqual(expr.use_count, 1)
+
+    def test_changelist(self):
+        expr = self.exprs[0]
+        expr.refresh_from_db()
+        expr.get_ast() # stored once, on first use
+
+        request = RequestFactory().get('/', {'filter': expr.pk})
+        request.user = expr.user
+        model_admin = admin.ModelAdmin(DynamicFilterTerm, admin.site)
+        spec = DynamicFilter(request, {'filter': [str(expr.pk)]}, DynamicFilterTerm, model_admin)
+
+        with CaptureQueriesContext(connections['default']) as queries:
+            spec.queryset(request, DynamicFilterTerm.objects.all())
+
+        self.assertFalse([q for q in queries if q['sql'].startswith('UPDATE')])
+
+        self.advise()
+        expr.refresh_from_db()
+        self.assertEqual(expr.use_count, 1)
+
+    def test_suggestions(self):
+        for i in range(4):
+            self.exprs[0].count_use()
+
+        lines = self.advise().splitlines()
+
+        # Weighted by runs, 'order' is already indexed, and the
+        # case-insensitive lookups compare the column on SQLite.
+        self.assertEqual([line.split()[:3] for line in lines], [
+            ['dynfilters.DynamicFilterTerm.value', 'btree', 'weight=6'],
+            ['dynfilters.DynamicFilterExpr.updated_at', 'month', 'weight=1'],
+        ])
+        self.assertIn('lookups==,istartswith', lines[0])
+
+    def test_migration(self):
+        output = self.advise('--migration')
+
+        self.assertIn("model_name='dynamicfilterterm',", output)
+        self.assertIn("index=models.Index(fields=['value'], name=", output)
+        self.assertIn('from django.db.models.functions import ExtractMonth', output)
+        self.assertIn("index=models.Index(ExtractMonth('updated_at'), name=", output)
+
+    def test_postgresql_indexes(self):
+        advisor = import_module('dynfilters.management.commands.dynfilters_index_advisor')
+        field = DynamicFilterTerm._meta.get_field('value')
+
+        self.assertIn(
+            "models.Index(OpClass(Upper('value'), name='text_pattern_ops'), name=",
+            advisor.index_code(DynamicFilterTerm, field, 'upper'),
+        )
+        self.assertIn(
+            "GinIndex(OpClass(Upper('value'), name='gin_trgm_ops'), name=",
+            advisor.index_code(DynamicFilterTerm, field, 'trigram'),
+        )
+
+
+class CountingFilter(DynamicFilter):
+    show_counts = True
+
+
+class CountsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='test')
+
+        for value in ('a', 'b', 'c'):
+            expr = DynamicFilterExpr.objects.create(name=value, model='dynfilters.Dynamicfilterterm', user=cls.user)
+            DynamicFilterTerm.objects.create(filter=expr, field='value', lookup='=', value=value, order=1)
+            expr.compile()
+            expr.save(update_fields=['ast'])
+
+    def setUp(self):
+        caches[get_setting('LOOKUPS_CACHE')].clear()
+        caches[get_setting('COUNTS_CACHE')].clear()
+        compiled_filters.clear()
+
+        self.request = RequestFactory().get('/')
+        self.request.user = self.user
+        self.model_admin = admin.ModelAdmin(DynamicFilterTerm, admin.site)
+
+    def get_counts(self):
+        spec = CountingFilter(self.request, {}, DynamicFilterTerm, self.model_admin)
+        return spec.get_counts()
+
+    def test_cold_cache(self):
+        # SELECT filters, SELECT counts
+        with self.assertNumQueries(2):
+            counts = self.get_counts()
+
+        self.assertEqual(sorted(counts.values()), [1, 1, 1])
+
+        # The counts are cached, the lookups too.
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_counts(), counts)
+
+    def test_invalid_filter(self):
+        expr = DynamicFilterExpr.objects.create(name='d', model='dynfilters.Dynamicfilterterm', user=self.user)
+        DynamicFilterExpr.objects.filter(pk=expr.pk).update(ast=['-', 'nope', '=', 'x'])
+
+        counts = self.get_counts()
+
+        self.assertEqual(len(counts), 3)
+        self.assertNotIn(expr.pk, counts)
+
+
+    def test_negated_multivalued(self):
+        # Counts match filter(), with the joins of several filters.
+        model_admin = admin.site._registry[DynamicFilterExpr]
+        model_admin.dynfilters_multivalued = 'join'
+        self.addCleanup(vars(model_admin).pop, 'dynfilters_multivalued', None)
+
+        other = DynamicFilterExpr.objects.create(name='other', model='dynfilters.Dynamicfilterexpr', user=self.user)
+        DynamicFilterTerm.objects.create(filter=other, field='field', value='x', order=1)
+        DynamicFilterTerm.objects.create(filter=other, field='value', value='a', order=2)
+
+        exprs = [
+            DynamicFilterExpr.objects.create(name=str(i), model='dynfilters.Dynamicfilterexpr', user=self.user, ast=node)
+            for i, node in enumerate((
+                ['!', 'dynamicfilterterm__value', '=', 'a'],
+                ['-', 'dynamicfilterterm__order', 'gte', 1],
+                ['&', ['!', 'dynamicfilterterm__value', '=', 'b'], ['-', 'dynamicfilterterm__field', '=', 'x']],
+            ))
+        ]
+
+        request = RequestFactory().get('/')
+        request.user = self.user
+        spec = CountingFilter(request, {}, DynamicFilterExpr, model_admin)
+        counts = spec.get_counts()
+
+        queryset = DynamicFilterExpr.objects.all()
+        for expr in exprs:
+            with self.subTest(ast=expr.ast):
+                self.assertEqual(counts[expr.pk], len(set(queryset.filter(expr.as_q()).values_list('pk', flat=True))))
+
+
+class LookupsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='test')
+        cls.expr = DynamicFilterExpr.objects.create(name='a', model='dynfilters.Dynamicfilterterm', user=cls.user)
+        cls.other = DynamicFilterExpr.objects.create(name='b', model='dynfilters.Dynamicfilterexpr', user=cls.user)
+
+    def setUp(self):
+        caches[get_setting('LOOKUPS_CACHE')].clear()
+
+        self.request = RequestFactory().get('/')
+        self.request.user = self.user
+        self.model_admin = admin.ModelAdmin(DynamicFilterTerm, admin.site)
+
+    def get_lookups(self):
+        spec = DynamicFilter(self.request, {}, DynamicFilterTerm, self.model_admin)
+        return [obj for obj, title in spec.lookup_choices]
+
+    def test_cached(self):
+        with self.assertNumQueries(1):
+            objs = self.get_lookups()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_lookups(), objs)
+
+        obj = objs[0]
+        self.assertEqual(obj, self.expr)
+        self.assertEqual(obj._state.db, 'default')
+        self.assertFalse(obj._state.adding)
+
+        # The fields used by the sidebar and the counts are loaded.
+        with self.assertNumQueries(0):
+            obj.version, obj.ast, obj.refreshed_version, materialize.is_fresh(obj)
+
+    def test_invalidation(self):
+        self.get_lookups()
+
+        # Filters on other models leave the list cached.
+        self.other.save()
+        DynamicFilterTerm.objects.create(filter=self.other, field='name', lookup='=', value='x', order=1)
+
+        with self.assertNumQueries(0):
+            self.get_lookups()
+
+        # Filters on the model, and their terms, invalidate it.
+        DynamicFilterExpr.objects.create(name='c', model='dynfilters.Dynamicfilterterm', user=self.user)
+
+        with self.assertNumQueries(1):
+            self.assertEqual([obj.name for obj in self.get_lookups()], ['a', 'c'])
+
+        term = DynamicFilterTerm.objects.create(filter=self.expr, field='value', lookup='=', value='x', order=1)
+
+        with self.assertNumQueries(1):
+            version = self.get_lookups()[0].version
+
+        self.assertEqual(version, DynamicFilterExpr.objects.get(pk=self.expr.pk).version)
+
+        term.delete()
+
+        with self.assertNumQueries(1):
+            self.get_lookups()
+
+
+class OtherDatabaseRouter:
+    def db_for_read(self, model, **hints):
+        if 'dynfilter' in hints:
+            return 'other'
+
+
+@skipUnless('other' in settings.DATABASES, "requires an 'other' database")
+class DatabaseRoutingTests(TestCase):
+    databases = {'default', 'other'}
+
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create(username='test')
+        cls.expr = DynamicFilterExpr.objects.create(model='dynfilters.Dynamicfilterterm', user=user)
+        DynamicFilterTerm.objects.create(filter=cls.expr, field='value', lookup='=', value='x', order=1)
+        cls.expr.compile()
+        cls.expr.save(update_fields=['ast'])
+
+        # Only rows of the 'other' database should be matched.
+        user = User.objects.using('other').create(username='test')
+        expr = DynamicFilterExpr.objects.using('other').create(model='dynfilters.Dynamicfilterterm', user=user)
+        DynamicFilterTerm.objects.using('other').bulk_create([
+            DynamicFilterTerm(filter=expr, value='x', order=1),
+            DynamicFilterTerm(filter=expr, value='x', order=2),
+            DynamicFilterTerm(filter=expr, value='y', order=3),
+        ])
+
+    def filter_queryset(self):
+        request = RequestFactory().get('/', {'filter': self.expr.pk})
+        request.user = self.expr.user
+
+        model_admin = admin.ModelAdmin(DynamicFilterTerm, admin.site)
+        spec = DynamicFilter(request, {'filter': [str(self.expr.pk)]}, DynamicFilterTerm, model_admin)
+
+        return spec.queryset(request, DynamicFilterTerm.objects.all())
+
+    def assertRouted(self, queryset):
+        with CaptureQueriesContext(connections['default']) as default:
+            with CaptureQueriesContext(connections['other']) as other:
+                self.assertEqual(queryset.count(), 2)
+
+        self.assertEqual(len(default), 0)
+        self.assertEqual(len(other), 1)
+
+    @override_settings(DYNFILTERS_DATABASE='other')
+    def test_setting(self):
+        self.assertRouted(self.filter_queryset())
+
+    @override_settings(DATABASE_ROUTERS=[f'{__name__}.OtherDatabaseRouter'])
+    def test_router(self):
+        self.assertRouted(self.filter_queryset())
+
+    def test_default(self):
+        queryset = self.filter_queryset()
+        self.assertEqual(queryset.db, 'default')
+        self.assertEqual(queryset.count(), 1)
+
+    def test_as_sql(self):
+        self.assertIn('"value" = x', self.expr.as_sql(using='other'))
+
+
+class CloneTests(TestCase):
+    def create_filter(self, user, size):
+        expr = DynamicFilterExpr.objects.create(name=f'size{size}', model='dynfilters.Dynamicfilterterm', user=user)
+
+        DynamicFilterTerm.objects.bulk_create([
+            DynamicFilterTerm(filter=expr, field='value', lookup='=', value=str(i), order=i)
+            for i in range(size)
+        ])
+        DynamicFilterColumn.objects.bulk_create([
+            DynamicFilterColumn(filter=expr, field='value', order=i)
+            for i in range(size)
+        ])
+        DynamicFilterColumnSortOrder.objects.bulk_create([
+            DynamicFilterColumnSortOrder(filter=expr, field='value', order=i)
+            for i in range(size)
+        ])
+
+        return expr
+
+    def test_constant_queries(self):
+        owner = User.objects.create(username='owner')
+        user = User.objects.create(username='user')
+
+        for size in (1, 10, 100):
+            expr = self.create_filter(owner, size)
+
+            # SAVEPOINT, SELECT x 3, INSERT filter, INSERT x 3, RELEASE
+            with self.assertNumQueries(9):
+                clone = clone_filter(expr, {'user': user})
+
+            self.assertNotEqual(clone.pk, expr.pk)
+            self.assertEqual(clone.user, user)
+            self.assertEqual(clone.name, expr.name)
+
+            for related_set in ('dynamicfilterterm_set', 'dynamicfiltercolumn_set', 'dynamicfiltercolumnsortorder_set'):
+                self.assertEqual(
+                    list(getattr(clone, related_set).values_list('field', 'order')),
+                    list(getattr(expr, related_set).values_list('field', 'order')),
+                )
+
+            self.assertEqual(expr.dynamicfilterterm_set.count(), size)
@@ -0,0 +1,58 @@
+# Per-phase timings of filtered changelists: 'load' (filter and terms),
+# 'normalize', 'compile' and 'execute' (SQL), in milliseconds.
+
+from django.dispatch import Signal
+
+from .utils import timer
+from .wrappers import add_request_wrapper, is_marked
+
+
+PHASES = ('load', 'normalize', 'compile', 'execute')
+
+# Sent with: expr, model, term_count, timings.
+filter_timed = Signal()
+
+
+def new_timings():
+    return dict.fromkeys(PHASES, 0)
+
+
+def send_timings(expr, term_count, timings):
+    filter_timed.send(
+        sender=type(expr),
+        expr=expr,
+        model=expr.model,
+        term_count=term_count,
+        timings=timings,
+    )
+
+
+class QueryTimer:
+    """
+    Execute wrapper accumulating the time spent executing the statements
+    of the filtered queryset (see wrappers.mark()) into the 'execute'
+    phase, for the rest of the request. The timings are sent once the
+    request has finished, see time_queries().
+    """
+
+    def __init__(self, expr, term_count, timings):
+        self.expr = expr
+        self.term_count = term_count
+        self.timings = timings
+
+    def __call__(self, execute, sql, params, many, context):
+        if many or not is_marked(sql):
+            return execute(sql, params, many, context)
+
+        with timer(self.timings, 'execute'):
+            return execute(sql, params, many, context)
+
+    def finish(self):
+        send_timings(self.expr, self.term_count, self.timings)
+
+
+# Times the queries of 'queryset', a filtered changelist queryset marked
+# with wrappers.mark(), along with the phases already in 'timings'.
+def time_queries(queryset, expr, term_count, timings):
+    wrapper = QueryTimer(expr, term_count, timings)
+    add_request_wrapper(queryset.db, wrapper)
@@ -1,20 +1,8 @@
+from contextlib import contextmanager
 from itertools import tee, chain
-import collections
-import datetime
+import collections.abc
 import itertools
-
-
-def str_as_date(value):
-    return datetime.datetime.strptime(value, '%d/%m/%Y').date()
-
-def str_as_date_range(value):
-    d1, d2 = value.split(',')
-    d1, d2 = d1.strip(), d2.strip()
-
-    return [
-        datetime.datetime.strptime(d1, '%d/%m/%Y').date(),
-        datetime.datetime.strptime(d2, '%d/%m/%Y').date(),
-    ]
+import time
 
 
 def previous(some_iterable):
@@ -23,7 +11,7 @@ def previous(some_iterable):
     return zip(prevs, items)
 
 
-def flatten(iterable, ltypes=collections.Iterable):
+def flatten(iterable, ltypes=collections.abc.Iterable):
     remainder = iter(iterable)
     while True:
         try:
@@ -49,3 +37,15 @@ def to_int(value):
                 return int(s)
 
     return None
+
+
+# Accumulate the time spent in the block, in milliseconds, into timings[name].
+@contextmanager
+def timer(timings, name):
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[name] = timings.get(name, 0) + (time.perf_counter() - start) * 1000
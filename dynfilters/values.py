@@ -0,0 +1,192 @@
+# Term values are parsed once, when the term is saved, according to the
+# model field they are compared with. They are stored as JSON: dates as
+# ISO strings, numbers as numbers, 'in' values as lists and ranges as
+# pairs, so that evaluating a filter requires no parsing.
+
+import datetime
+import decimal
+import re
+import uuid
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db import models
+
+
+DATE_INPUT_FORMATS = ('%d/%m/%Y', '%Y-%m-%d')
+
+BOOLEAN_LOOKUPS = {
+    'isnull': True,
+    'istrue': True,
+    'isnotnull': False,
+    'isfalse': False,
+}
+
+TEXT_LOOKUPS = ('icontains', 'istartswith', 'iendswith')
+
+DATE_PART_LOOKUPS = ('year', 'month', 'day')
+
+# Auto fields cannot be used as cast targets.
+CAST_TYPES = {
+    'AutoField': 'IntegerField',
+    'BigAutoField': 'BigIntegerField',
+    'SmallAutoField': 'SmallIntegerField',
+}
+
+
+# Model field at the end of a lookup path, e.g. 'address__town'.
+# Returns None if the path does not lead to a concrete field.
+def get_model_field(model, path):
+    opts = model._meta
+    f = None
+
+    for name in path.split('__'):
+        if f is not None:
+            if not f.is_relation or f.related_model is None:
+                return None
+
+            opts = f.related_model._meta
+
+        try:
+            f = opts.get_field(name)
+        except FieldDoesNotExist:
+            return None
+
+    if f.is_relation and not f.concrete:
+        return None # reverse relation, compared by pk
+
+    return f
+
+# Relations are compared with the field they point to.
+def get_compared_field(model_field):
+    if isinstance(model_field, models.ForeignObject):
+        return model_field.target_field
+
+    if model_field.is_relation:
+        return model_field.related_model._meta.pk
+
+    return model_field
+
+def parse_date(value):
+    for fmt in DATE_INPUT_FORMATS:
+        try:
+            return datetime.datetime.strptime(value.strip(), fmt).date()
+        except ValueError:
+            pass
+
+    raise ValidationError('Should be "DD/MM/YYYY"')
+
+def as_json(value):
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+
+    if isinstance(value, (decimal.Decimal, uuid.UUID)):
+        return str(value)
+
+    return value
+
+def parse_scalar(model_field, value):
+    if model_field is None:
+        return value
+
+    model_field = get_compared_field(model_field)
+
+    if isinstance(model_field, models.DateField): # and DateTimeField
+        return as_json(parse_date(value))
+
+    return as_json(model_field.to_python(value))
+
+# Type the values of a value set are cast to, when compared with
+# 'model_field' (they are stored as text).
+def get_cast_type(model_field):
+    if model_field is None:
+        return None
+
+    model_field = get_compared_field(model_field)
+    internal_type = model_field.get_internal_type()
+
+    if internal_type in ('CharField', 'TextField', 'SlugField', 'EmailField'):
+        return None
+
+    return CAST_TYPES.get(internal_type, internal_type if hasattr(models, internal_type) else None)
+
+# Field the values of a value set are cast to, when compared with
+# 'model_field'. It is a copy of the compared field, so that it keeps 
+# its parameters, e.g. the digits of a DecimalField. None if they are
+# compared as text.
+def get_cast_field(model_field):
+    cast = get_cast_type(model_field)
+    if cast is None:
+        return None
+
+    model_field = get_compared_field(model_field)
+
+    if cast != model_field.get_internal_type():
+        return getattr(models, cast)() # auto field
+
+    return model_field.clone()
+
+# Split pasted or uploaded values, one per line or comma separated,
+# and parse them for 'model_fields'. Returns the values as text.
+def parse_value_list(model_fields, text):
+    value_list = {}
+
+    for value in re.split(r'[\r\n,]+', text):
+        value = value.strip()
+
+        if not value:
+            continue
+
+        # Checked against each field, stored as parsed for the first one.
+        parsed = [
+            str(parse_scalar(model_field, value))
+            for model_field in model_fields
+        ]
+
+        value_list[parsed[0] if parsed else value] = None
+
+    return list(value_list)
+
+# Parse 'value' for 'lookup' on 'model_field'. When the field is unknown
+# (None), scalar values are kept as strings.
+def parse_value(model_field, lookup, value):
+    if lookup in BOOLEAN_LOOKUPS:
+        return BOOLEAN_LOOKUPS[lookup]
+
+    if value is None:
+        return None
+
+    if lookup in TEXT_LOOKUPS:
+        return value
+
+    if lookup in DATE_PART_LOOKUPS:
+        try:
+            return int(value)
+        except ValueError:
+            raise ValidationError('Should be a number')
+
+    if lookup == 'in':
+        return [parse_scalar(model_field, v.strip()) for v in value.split(',')]
+
+    if lookup == 'range':
+        values = value.split(',')
+
+        if len(values) != 2:
+            raise ValidationError('Should be two values separated by a comma')
+
+        return [parse_scalar(model_field, v.strip()) for v in values]
+
+    return parse_scalar(model_field, value)
+
+# Short description of a value list, shown as the value of the term.
+def summarize(value_list, max_length=100):
+    summary = f'{len(value_list)} values: '
+
+    for i, value in enumerate(value_list):
+        part = value if not i else f', {value}'
+
+        if len(summary) + len(part) > max_length - 4:
+            return summary + ', ...'
+
+        summary += part
+
+    return summary
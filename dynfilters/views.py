@@ -1,7 +1,14 @@
 from django.contrib import messages
+from django.core.exceptions import FieldError, PermissionDenied, ValidationError
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.utils.text import slugify
+from django.views.decorators.http import require_POST
 
-from .clone import clone_object
-from .model_helpers import get_model_obj
+from . import materialize
+from .clone import clone_filter
+from .export import EXPORT_ERRORS, FORMATS, get_export_columns, get_export_queryset, iter_lines
+from .facets import get_facet_fields, get_facets, get_limit
+from .model_helpers import get_model_admin, get_model_obj
 from .models import DynamicFilterExpr
 from .url_helpers import (
     referer,
@@ -13,8 +20,8 @@ from .url_helpers import (
 
 def dynfilters_add(request, model_name):
     try:
-        model_obj = get_model_obj(model_name)
-    except:
+        get_model_obj(model_name)
+    except (LookupError, ValueError):
         messages.error(request, 'This type of model is unknown.')
         return redirect_to_referer(request)
 
@@ -32,9 +39,7 @@ def dynfilters_share(request, id):
         messages.error(request, 'This filter does not exist.')
         return redirect_to_changelist(request)
 
-    clone = clone_object(expr)
-    clone.user = request.user
-    clone.save()
+    clone = clone_filter(expr, {'user': request.user})
 
     return redirect_to_change(request, clone.id)
 
@@ -51,3 +56,73 @@ def dynfilters_delete(request, id):
     expr.delete()
 
     return redirect_to_referer(request)
+
+@require_POST
+def dynfilters_refresh(request, id):
+    try:
+        expr = DynamicFilterExpr.objects.get(pk=id, materialized=True)
+    except DynamicFilterExpr.DoesNotExist:
+        messages.error(request, 'This filter does not exist, or is not materialized.')
+        return redirect_to_referer(request)
+
+    model_admin = get_model_admin(expr)
+    if model_admin is None or not model_admin.has_change_permission(request):
+        raise PermissionDenied
+
+    count = materialize.refresh(expr)
+    messages.success(request, f'The filter was refreshed, {count} rows.')
+
+    return redirect_to_referer(request)
+
+def dynfilters_export(request, id, format):
+    if format not in FORMATS:
+        raise Http404('Unknown export format.')
+
+    try:
+        expr = DynamicFilterExpr.objects.get(pk=id)
+    except DynamicFilterExpr.DoesNotExist:
+        messages.error(request, 'This filter does not exist.')
+        return redirect_to_changelist(request)
+
+    model_admin = get_model_admin(expr)
+    if model_admin is None or not model_admin.has_view_permission(request):
+        raise PermissionDenied
+
+    content_type, format_columns = FORMATS[format]
+
+    columns = get_export_columns(expr, model_admin)
+
+    try:
+        rows = get_export_queryset(request, expr, model_admin, columns)
+    except EXPORT_ERRORS as e:
+        messages.error(request, f'This filter cannot be exported: {e}')
+        return redirect_to_referer(request)
+
+    response = StreamingHttpResponse(iter_lines(format_columns, columns, rows), content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="{slugify(expr.name)}.{format}"'
+
+    return response
+
+# Most frequent values of the 'field' parameter, among the rows matched
+# by the filter if 'scoped' is 1, to suggest values for its terms.
+def dynfilters_facets(request, id):
+    try:
+        expr = DynamicFilterExpr.objects.get(pk=id)
+    except DynamicFilterExpr.DoesNotExist:
+        raise Http404('This filter does not exist.')
+
+    model_admin = get_model_admin(expr)
+    if model_admin is None or not model_admin.has_view_permission(request):
+        raise PermissionDenied
+
+    field = request.GET.get('field')
+    fields = get_facet_fields(model_admin, field)
+    if fields is None:
+        return JsonResponse({'error': 'Unknown field.'}, status=400)
+
+    try:
+        facets = get_facets(request, expr, model_admin, fields, get_limit(request), request.GET.get('scoped') == '1')
+    except (FieldError, ValidationError, ValueError, TypeError) as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    return JsonResponse({'field': field, 'facets': facets})
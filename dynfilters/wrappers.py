@@ -0,0 +1,50 @@
+# Execute wrappers (see connection.execute_wrapper()) installed for the
+# rest of a request, e.g. on the queries of a filtered changelist, which
+# are only run by the admin once the filter has returned its queryset.
+# They are removed when the request finishes, since connections may be
+# persistent.
+
+from django.core.signals import request_finished
+from django.db import connections
+from django.db.models import BooleanField
+from django.db.models.expressions import RawSQL
+from django.dispatch import receiver
+
+
+MARKER = '/* dynfilters */'
+
+
+def add_request_wrapper(using, wrapper):
+    connection = connections[using]
+    connection.execute_wrappers.append(wrapper)
+
+    if not hasattr(connection, 'dynfilters_wrappers'):
+        connection.dynfilters_wrappers = []
+
+    connection.dynfilters_wrappers.append(wrapper)
+
+# 'queryset' with its statements marked by a comment, see is_marked().
+def mark(queryset):
+    return queryset.filter(RawSQL(f'{MARKER} 1 = 1', [], output_field=BooleanField()))
+
+# Whether 'sql' is a SELECT of a queryset returned by mark(), rather than
+# another query of the request on the same tables, e.g. the unfiltered
+# count of the changelist.
+def is_marked(sql):
+    return sql.lstrip()[:6].upper() == 'SELECT' and MARKER in sql
+
+# Wrappers may define finish(), called once they are removed.
+@receiver(request_finished)
+def remove_request_wrappers(sender, **kwargs):
+    for connection in connections.all():
+        wrappers = getattr(connection, 'dynfilters_wrappers', None)
+        if not wrappers:
+            continue
+
+        connection.dynfilters_wrappers = []
+
+        for wrapper in wrappers:
+            connection.execute_wrappers.remove(wrapper)
+
+            if hasattr(wrapper, 'finish'):
+                wrapper.finish()